@@ -1,5 +1,7 @@
 import os
+import logging
 import shutil
+import threading
 import dash
 import base64
 import io
@@ -15,9 +17,9 @@ from dash.dependencies import Input, Output, State
 import plotly.graph_objs as go
 from dash.exceptions import PreventUpdate
 from shapely.geometry import Point
-from gisele.functions import load, sizing
+from gisele.functions import load, sizing, mesh_pyramid
 from gisele import initialization, clustering, processing, collecting, \
-    optimization, results, grid, branches
+    optimization, results, grid, branches, cache
 import pyutilib.subprocess.GlobalData
 
 pyutilib.subprocess.GlobalData.DEFINE_SIGNAL_HANDLERS_DEFAULT = False
@@ -48,6 +50,15 @@ load_profile['Power [p.u.]'] = input_profile.iloc[0:12, 0].values
 load_profile['Power (p.u.)'] = input_profile.iloc[12:24, 0].values
 lp_data = load_profile.to_dict('records')
 
+# clusters being edited and points of the cluster map, reprojected once and
+# kept for the zoom changes
+cluster_session = {'geo_df': None, 'clusters_list': None,
+                   'points': pd.DataFrame()}
+
+# sensitivity analysis running in the background and its partial results
+sensitivity_session = {'thread': None, 'results': {}, 'spans': None,
+                       'fig': None, 'lock': threading.Lock()}
+
 # configuration file, eps and pts values separated by - since they are a range
 config = pd.read_csv(r'Input/Configuration.csv')
 # config.loc[21, 'Value'] = sorted(list(map(int,
@@ -55,6 +66,17 @@ config = pd.read_csv(r'Input/Configuration.csv')
 # config.loc[20, 'Value'] = sorted(list(map(int,
 #                                           config.loc[20, 'Value'].split('-'))))
 
+
+def config_value(name, default):
+    """ Value of a parameter of the configuration, or default if its row is
+    missing or empty, as in the configurations of the older versions """
+    value = config.loc[config['Parameter'] == name, 'Value']
+    if value.empty or pd.isna(value.values[0]) or \
+            str(value.values[0]).strip() == '':
+        return default
+    return value.values[0]
+
+
 # empty map to show as initual output
 fig = go.Figure(go.Scattermapbox(
     lat=[''],
@@ -471,7 +493,7 @@ app.layout = html.Div([
                     ])
                 ]),
                 dbc.Collapse(id='collapse_merge', children=[
-                    html.H6(['Choose two clusters to merge'],
+                    html.H6(['Choose the clusters to merge (e.g. 1-3, 2-4)'],
                             style={'textAlign': 'center',
                                    'color': "#55b298",
                                    'margin': '5px'}),
@@ -483,8 +505,7 @@ app.layout = html.Div([
                                 bs_size='sm',
                                 id='c1_merge',
                                 placeholder='',
-                                type='number',
-                                min=0, max=99, step=1,
+                                type='text',
                                 value=''),
                         ], width={"size": 3, "offset": 0}, align='center'),
                         dbc.Col([
@@ -494,8 +515,7 @@ app.layout = html.Div([
                                 bs_size='sm',
                                 id='c2_merge',
                                 placeholder='',
-                                type='number',
-                                min=0, max=99, step=1,
+                                type='text',
                                 value=''),
                         ], width={"size": 3, "offset": 0}, align='center'),
                         dbc.Col([
@@ -510,6 +530,31 @@ app.layout = html.Div([
                                 className='button-primary'),
                         ], width={"size": 4, "offset": 0}, align='center')
                     ], justify="around", style={'height': -100}),
+                    html.H6(['Choose the clusters to split'],
+                            style={'textAlign': 'center',
+                                   'color': "#55b298",
+                                   'margin': '5px'}),
+                    dbc.Row([
+                        dbc.Col([
+                            dbc.Input(
+                                debounce=True,
+                                bs_size='sm',
+                                id='c_split',
+                                placeholder='',
+                                type='text',
+                                value=''),
+                        ], width={"size": 6, "offset": 0}, align='center'),
+                        dbc.Col([
+                            dbc.Button(
+                                'Split',
+                                color='warning',
+                                id='bt_split_clusters', n_clicks=0,
+                                disabled=False,
+                                style={'textAlign': 'center',
+                                       'margin': '0px'},
+                                className='button-primary'),
+                        ], width={"size": 4, "offset": 0}, align='center')
+                    ], justify="around", style={'height': -100}),
                 ]),
                 dbc.Row([
                     dbc.Col(
@@ -546,7 +591,9 @@ app.layout = html.Div([
                                 dcc.Graph(
                                     id='output_sens',
                                     figure=fig,
-                                )]
+                                ),
+                                dcc.Interval(id='sens_interval',
+                                             interval=2000, disabled=True)]
                                 ),
                     ]),
                 ])
@@ -1266,12 +1313,14 @@ def create_study_area(lat1, lat2, lat3, lat4, lon1, lon2, lon3, lon4):
                Input('c1_merge', 'value'),
                Input('c2_merge', 'value'),
                Input('landcover_option', 'value'),
-               Input('p_max_lines','value')])
+               Input('p_max_lines','value'),
+               Input('c_split', 'value')])
 def configuration(import_data, crs, resolution,
                   pop_thresh, line_bc, pop_load,
                   branch, pop_thresh_lr, line_bc_col, full_ele, wt, coe,
                   grid_ir, grid_om, grid_lifetime, eps, pts, spans, eps_final,
-                  pts_final, c1_merge, c2_merge, landcover_option,p_max_lines):
+                  pts_final, c1_merge, c2_merge, landcover_option,p_max_lines,
+                  c_split):
     """ Reads every change of input in the UI and updates the configuration
     file accordingly """
     ctx = dash.callback_context
@@ -1319,6 +1368,14 @@ def create_dataframe(create_df, import_pop_value):
     crs = int(config.iloc[3, 1])
     resolution = float(config.iloc[4, 1])
     landcover_option = (config.iloc[27, 1])
+    # number of mesh points on each side of a tile, 0 to build it at once
+    tile_size = int(config_value('tile_size', 0))
+    # weighted meshes are cached, 0 to build the mesh again anyway
+    mesh_cache = int(config_value('mesh_cache', 1))
+    # maximum size of the cache [MB]
+    mesh_cache_size = float(config_value('mesh_cache_size', 2000))
+    # 1 to take the weights from a cost surface computed once per area
+    cost_surface = int(config_value('cost_surface', 0))
     unit = 1
     step = 1
     if dash.callback_context.triggered[0]['prop_id'] == 'create_df.n_clicks':
@@ -1328,15 +1385,51 @@ def create_dataframe(create_df, import_pop_value):
         ###create new directories ####
         os.makedirs('Output/Datasets')
         os.makedirs('Output/Clusters')
+        ### look for the same mesh in the cache, only the meshing is ####
+        ### skipped and the layers are downloaded anyway ####
         if data_import == 'yes':
             collecting.data_gathering(crs, study_area)
             landcover_option = 'CGLS'
+            inputs = ['Input/Landcover.csv'] + processing.DATASETS
+            if import_pop_value:
+                inputs.append('Input/imported_pop.csv')
+        else:
+            inputs = ['Input/Landcover.csv', 'Input/' + input_csv + '.csv']
+        key = cache.mesh_key(study_area, crs, resolution, landcover_option,
+                             inputs, (cost_surface,))
+        # the cost surface depends on the downloaded layers as they are
+        # before the meshing, and not on the resolution
+        surface_key = cache.mesh_key(study_area, crs, 0, landcover_option,
+                                     ['Input/Landcover.csv'] +
+                                     processing.DATASETS, ('cost_surface',))
+        if mesh_cache:
+            meta = cache.load_mesh(key)
+            if meta is not None:
+                return round(meta['n_points'] / 13, 0) + 1
+        else:
+            cache.invalidate(key)
+        if data_import == 'yes':
             if not import_pop_value:
-                df = processing.create_mesh(study_area, crs, resolution)
+                df = processing.create_mesh(study_area, crs, resolution,
+                                            tile_size=tile_size)
             else:
                 imported_pop = pd.read_csv(r'Input/imported_pop.csv')
                 df = processing.create_mesh(study_area, crs, resolution,
-                                            imported_pop)
+                                            imported_pop, tile_size)
+            if cost_surface:
+                surface = 'Output/Datasets/CostSurface/cost_surface.tif'
+                if cache.load_mesh(surface_key,
+                                   'Output/Datasets/CostSurface') is None:
+                    os.makedirs('Output/Datasets/CostSurface',
+                                exist_ok=True)
+                    lookup = initialization.landcover_lookup(
+                        pd.read_csv('Input/Landcover.csv'), landcover_option)
+                    processing.cost_surface(crs, lookup, surface)
+                    cache.store_mesh(surface_key, ['cost_surface.tif'],
+                                     source='Output/Datasets/CostSurface',
+                                     max_size=mesh_cache_size * 2 ** 20)
+                df['Cost'] = processing.sample_cost_surface(
+                    surface, df['X'].values, df['Y'].values, resolution)
             df_weighted = initialization.weighting(df, resolution,
                                                    landcover_option)
 
@@ -1356,6 +1449,13 @@ def create_dataframe(create_df, import_pop_value):
                                                      unit, input_csv, step)
             geo_df.to_file(r"Output/Datasets/geo_df_json", driver='GeoJSON')
             initialization.roads_import(geo_df,crs)
+        mesh_pyramid(geo_df, resolution)
+        processing.write_mesh(geo_df, 'Output/Datasets/Mesh')
+        if mesh_cache:
+            cache.store_mesh(key, ['geo_df_json', 'Roads', 'Pyramid', 'Mesh',
+                                   input_csv + '_weighted.csv'],
+                             max_size=mesh_cache_size * 2 ** 20,
+                             n_points=geo_df.shape[0])
         geo_df = geo_df.to_crs(epsg=4326)
         # fig2 = go.Figure(go.Scattermapbox(
         #
@@ -1388,13 +1488,33 @@ def create_dataframe(create_df, import_pop_value):
         return 1
 
 
-@app.callback(Output('output_sens', 'figure'),
-              [Input('bt_cluster_sens', 'n_clicks')])
-def cluster_sensitivity(bt_cluster_sens):
-    """ Checks if the button SENSITIVITY was pressed, if yes run the code and
-     and changes the bt_out to a value that will call the change_interface
-     function """
-    if bt_cluster_sens > 0:
+def run_sensitivity(resolution, pop_points, geo_df, span_eps, span_pts,
+                    engine):
+    """ Runs the sensitivity analysis in the background, keeping the results
+    of each step so that the plot can be filled in while it runs """
+    print("2.Clustering - Sensitivity Analysis (" + engine + ")")
+    for step in clustering.sensitivity_steps(resolution, pop_points, geo_df,
+                                             span_eps, span_pts, engine):
+        with sensitivity_session['lock']:
+            sensitivity_session['results'].update(step)
+    tables = clustering.sensitivity_tables(
+        dict(sensitivity_session['results']), span_eps, span_pts)
+    sensitivity_session['fig'] = clustering.sensitivity_output(*tables)
+
+
+@app.callback([Output('output_sens', 'figure'),
+               Output('sens_interval', 'disabled')],
+              [Input('bt_cluster_sens', 'n_clicks'),
+               Input('sens_interval', 'n_intervals')])
+def cluster_sensitivity(bt_cluster_sens, n_intervals):
+    """ Checks if the button SENSITIVITY was pressed, if yes starts the
+     analysis in the background and the timer that shows its partial
+     results, until it is completed """
+    button_pressed = [p['prop_id'] for p in dash.callback_context.triggered][0]
+    if 'bt_cluster_sens' in button_pressed and bt_cluster_sens > 0:
+        if sensitivity_session['thread'] is not None and \
+                sensitivity_session['thread'].is_alive():
+            raise PreventUpdate
         resolution = float(config.iloc[4, 1])
         eps_1=float(config.iloc[20, 1])
         eps_2 = float(config.iloc[20, 2])
@@ -1409,25 +1529,87 @@ def cluster_sensitivity(bt_cluster_sens):
         geo_df = gpd.read_file(r"Output/Datasets/geo_df_json")
         loc = {'x': geo_df['X'], 'y': geo_df['Y'], 'z': geo_df['Elevation']}
         pop_points = pd.DataFrame(data=loc).values
-        fig_sens = clustering.sensitivity(resolution, pop_points, geo_df, eps,
-                                          pts,
-                                          int(spans))
-        return fig_sens
+        # dbscan or reachability, which allows a finer grid of eps
+        engine = config_value('sensitivity_engine', 'dbscan')
+        eps_spans = int(config_value('eps_spans', 0))
+        span_eps, span_pts = clustering.sensitivity_spans(eps, pts, spans)
+        if engine == 'reachability':
+            if eps_spans:
+                span_eps = clustering.sensitivity_spans(eps, pts,
+                                                        eps_spans)[0]
+            span_eps = sorted(set(span_eps))
+        else:
+            engine = 'dbscan'
+        sensitivity_session.update(results={}, fig=None,
+                                   spans=(span_eps, span_pts))
+        sensitivity_session['thread'] = threading.Thread(
+            target=run_sensitivity, args=(resolution, pop_points, geo_df,
+                                          span_eps, span_pts, engine),
+            daemon=True)
+        sensitivity_session['thread'].start()
+        return dash.no_update, False
+
+    elif 'sens_interval' in button_pressed:
+        if sensitivity_session['fig'] is not None:
+            return sensitivity_session['fig'], True
+        if not sensitivity_session['thread'].is_alive():
+            # the analysis stopped with an error
+            return dash.no_update, True
+        if not sensitivity_session['results']:
+            raise PreventUpdate
+        # partial results are handed over in memory, the tables are
+        # written only when the analysis is completed
+        with sensitivity_session['lock']:
+            results = dict(sensitivity_session['results'])
+        tables = clustering.sensitivity_tables(results,
+                                               *sensitivity_session['spans'])
+        return clustering.sensitivity_plot(*tables), False
     raise PreventUpdate
 
 
+def cluster_figure(geo_df_clustered, clusters_list):
+    """ Keeps the clusters in memory for the following edits, reprojects the
+    points of the cluster map for the following zoom changes and renders
+    the map """
+    max_points = int(config_value('map_max_points', 20000))
+    cluster_session['geo_df'] = geo_df_clustered
+    cluster_session['clusters_list'] = clusters_list
+    cluster_session['points'] = clustering.map_points(geo_df_clustered,
+                                                      clusters_list)
+    return clustering.render_clusters(cluster_session['points'],
+                                      max_points=max_points)
+
+
+def cluster_edit(clusters_list, changed, edits):
+    """ Stores an edit of the clusters (only the labels and the edits are
+    written) and renders the map again, updating only the edited points """
+    max_points = int(config_value('map_max_points', 20000))
+    geo_df_clustered = cluster_session['geo_df']
+    cluster_session['clusters_list'] = clusters_list
+    clustering.save_edits(geo_df_clustered, clusters_list, edits)
+    cluster_session['points'] = clustering.update_map_points(
+        cluster_session['points'], geo_df_clustered, changed)
+    return clustering.render_clusters(cluster_session['points'],
+                                      max_points=max_points)
+
+
 @app.callback(Output('output_cluster', 'figure'),
               [Input('cluster_analysis', 'n_clicks'),
                Input('bt_merge_clusters', 'n_clicks'),
-               Input('step' , 'value')])
-def analysis(cluster_analysis, bt_merge_clusters,step):
+               Input('bt_split_clusters', 'n_clicks'),
+               Input('step' , 'value'),
+               Input('output_cluster', 'relayoutData')])
+def analysis(cluster_analysis, bt_merge_clusters, bt_split_clusters, step,
+             relayout):
     """ Checks if the button RUN GISELE was pressed, if yes run the code and
      and changes the bt_out to a value that will call the change_interface
-     function """
+     function. When the map is zoomed or moved, it is rendered again from
+     the points kept in memory, with the detail suited to the zoom. Merges
+     and splits are applied to the clusters kept in memory """
     eps_final = int(config.iloc[23, 1])
     pts_final = int(config.iloc[24, 1])
-    c1_merge = int(config.iloc[25, 1])
-    c2_merge = int(config.iloc[26, 1])
+    c1_merge = clustering.parse_clusters(config.iloc[25, 1])
+    c2_merge = clustering.parse_clusters(config.iloc[26, 1])
     button_pressed = [p['prop_id'] for p in dash.callback_context.triggered][0]
     pop_load = float(config.iloc[6, 1])
     #todo -> improve this visualization, not loading the graph each time this page is entered
@@ -1439,49 +1621,71 @@ def analysis(cluster_analysis, bt_merge_clusters,step):
         loc = {'x': geo_df['X'], 'y': geo_df['Y'], 'z': geo_df['Elevation']}
         pop_points = pd.DataFrame(data=loc).values
 
+        method = config_value('clustering_method', 'dbscan')
+        resolution = float(config.iloc[4, 1])
+        tile_size = int(config_value('tile_size', 0)) or 500
         geo_df_clustered, clusters_list = \
             clustering.analysis(pop_points, geo_df, pop_load,
-                                eps_final, pts_final)
+                                eps_final, pts_final, method, resolution,
+                                tile_size)
 
-        fig_clusters = clustering.plot_clusters(geo_df_clustered,
-                                                clusters_list)
+        fig_clusters = cluster_figure(geo_df_clustered, clusters_list)
         clusters_list.to_csv(r"Output/Clusters/clusters_list.csv",
                              index=False)
         geo_df_clustered.to_file(r"Output/Clusters/geo_df_clustered.json",
                                  driver='GeoJSON')
+        clustering.clear_edits()
         return fig_clusters
 
-    elif 'bt_merge_clusters' in button_pressed:
-        geo_df_clustered = \
-            gpd.read_file(r"Output/Clusters/geo_df_clustered.json")
-        geo_df_clustered.loc[geo_df_clustered['Cluster'] ==
-                             c2_merge, 'Cluster'] = c1_merge
-
-        clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
-        drop_index = \
-            clusters_list.index[clusters_list['Cluster'] == c2_merge][0]
-        clusters_list = clusters_list.drop(index=drop_index)
-
-        fig_merged = clustering.plot_clusters(geo_df_clustered,
-                                              clusters_list)
-
-        clusters_list.to_csv(r"Output/Clusters/clusters_list.csv",
-                             index=False)
-        geo_df_clustered.to_file(r"Output/Clusters/geo_df_clustered.json",
-                                 driver='GeoJSON')
-        return fig_merged
+    elif 'bt_merge_clusters' in button_pressed or \
+            'bt_split_clusters' in button_pressed:
+        if cluster_session['geo_df'] is None:
+            clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
+            clusters_list.index = clusters_list['Cluster'].values
+            cluster_figure(clustering.read_clustered(), clusters_list)
+        geo_df_clustered = cluster_session['geo_df']
+        if 'bt_merge_clusters' in button_pressed:
+            # one cluster kept for all the others, or one for each
+            if len(c1_merge) == 1:
+                c1_merge = c1_merge * len(c2_merge)
+            merges = list(zip(c1_merge, c2_merge))
+            clusters_list, changed = clustering.merge_clusters(
+                geo_df_clustered, cluster_session['clusters_list'], merges)
+            edits = pd.DataFrame({'Action': 'merge',
+                                  'Cluster': [m[0] for m in merges],
+                                  'Clusters': [m[1] for m in merges]})
+        else:
+            c_split = clustering.parse_clusters(config_value('c_split', ''))
+            old_clusters = set(cluster_session['clusters_list'].Cluster)
+            clusters_list, changed = clustering.split_clusters(
+                geo_df_clustered, cluster_session['clusters_list'], c_split,
+                eps_final / 2, pts_final, pop_load)
+            edits = pd.DataFrame({'Action': 'split', 'Cluster': c_split,
+                                  'Clusters': '-'.join(
+                                      str(c) for c in clusters_list.Cluster
+                                      if c not in old_clusters)})
+        return cluster_edit(clusters_list, changed, edits)
+
+    elif 'relayoutData' in button_pressed:
+        if relayout and 'mapbox.zoom' in relayout and \
+                not cluster_session['points'].empty:
+            max_points = int(config_value('map_max_points', 20000))
+            center = relayout.get('mapbox.center')
+            if center is not None:
+                center = (center['lon'], center['lat'])
+            return clustering.render_clusters(cluster_session['points'],
+                                              relayout['mapbox.zoom'], center,
+                                              max_points)
 
     elif step ==2:
         if os.path.isfile(r'Output/Clusters/geo_df_clustered.json') and os.path.isfile(r'Output/Clusters/clusters_list.csv'):
-            geo_df_clustered = \
-                gpd.read_file(r"Output/Clusters/geo_df_clustered.json")
+            geo_df_clustered = clustering.read_clustered()
             clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
+            clusters_list.index = clusters_list['Cluster'].values
 
-            fig_clusters = clustering.plot_clusters(geo_df_clustered,
-                                                  clusters_list)
+            fig_clusters = cluster_figure(geo_df_clustered, clusters_list)
             return fig_clusters
 
-
     raise PreventUpdate
 
 
@@ -1505,9 +1709,14 @@ def routing(grid_routing):
         pop_thresh_lr = float(config.iloc[12, 1])
         line_bc_col = float(config.iloc[13, 1])
         full_ele = config.iloc[14, 1]
+        memory_budget = float(config_value('routing_memory', 4000))
+        time_budget = float(config_value('routing_time', 600))
+        for cost in grid.routing_costs:
+            grid.routing_costs[cost] = float(
+                config_value('routing_' + cost, grid.routing_costs[cost]))
         geo_df = gpd.read_file(r"Output/Datasets/geo_df_json")
         geo_df_clustered = \
-            gpd.read_file(r"Output/Clusters/geo_df_clustered.json")
+            clustering.read_clustered()
         clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
         clusters_list.index = clusters_list.Cluster.values
 
@@ -1517,7 +1726,7 @@ def routing(grid_routing):
             grid_resume, gdf_roads, roads_segments = \
                 grid.routing(geo_df_clustered, geo_df, clusters_list,
                              resolution, pop_thresh, line_bc,
-                              full_ele)
+                              full_ele, memory_budget, time_budget)
 
             # grid_resume_opt = optimization.connections(geo_df, grid_resume,
             #                                            resolution, line_bc,
@@ -1540,7 +1749,8 @@ def routing(grid_routing):
                 branches.routing(geo_df_clustered, geo_df, clusters_list,
                                  resolution, pop_thresh, input_sub, line_bc,
                                  sub_cost_hv, sub_cost_mv, pop_load, gdf_lr,
-                                 pop_thresh_lr, line_bc_col, full_ele)
+                                 pop_thresh_lr, line_bc_col, full_ele,
+                                 memory_budget, time_budget)
 
             # grid_resume_opt = optimization.connections(geo_df, grid_resume,
             #                                            resolution, line_bc,
@@ -1571,7 +1781,7 @@ def microgrid_size(mg_sizing):
             os.makedirs('Output/Microgrids')
 
         geo_df_clustered = \
-            gpd.read_file(r"Output/Clusters/geo_df_clustered.json")
+            clustering.read_clustered()
 
         clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
 
@@ -1624,7 +1834,7 @@ def npc_computation(npc_btn):
 
         geo_df = gpd.read_file(r"Output/Datasets/geo_df_json")
         geo_df_clustered = \
-            gpd.read_file(r"Output/Clusters/geo_df_clustered.json")
+            clustering.read_clustered()
         clusters_list = pd.read_csv(r"Output/Clusters/clusters_list.csv")
         clusters_list.index = clusters_list.Cluster.values
         substations = pd.read_csv(r'Input/' + input_sub + '.csv')
@@ -1869,4 +2079,5 @@ def update_output(contents, filename, last_modified):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     app.run_server(debug=False)
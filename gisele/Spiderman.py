@@ -24,11 +24,8 @@ def spider(geo_df, gdf_cluster_pop, line_bc, resolution, gdf_roads,
     edges_matrix = cost_matrix(gdf_cluster_pop, dist_3d_matrix, line_bc)
     # edges_matrix = cost_matrix(df_box, dist_3d_matrix, line_bc)
     # edges_matrix = dist_3d_matrix
-    for i in branch_points:
-        if i[0] in edges_matrix.index.values and \
-                i[1] in edges_matrix.index.values:
-            edges_matrix.loc[i[0], i[1]] = 0.001
-            edges_matrix.loc[i[1], i[0]] = 0.001
+    edges_matrix = set_edges(edges_matrix, gdf_cluster_pop,
+                             edge_overlay(branch_points))
 
     edges_matrix_sparse = sparse.csr_matrix(dist_3d_matrix)
     graph = nx.from_scipy_sparse_matrix(edges_matrix_sparse)
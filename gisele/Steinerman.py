@@ -28,30 +28,17 @@ def steiner(geo_df, gdf_cluster_pop, line_bc, resolution, branch_points=None):
 
     start_time = time.time()
 
-    #  creating the box around the cluster and calculating edges matrix
+    #  creating the box around the cluster and taking its sparse edges
+    #  matrix from the routing graph (pairs closer than the length limit)
     df_box = create_box(gdf_cluster_pop, geo_df)
-    dist_2d_matrix = distance_2d(df_box, df_box, 'X', 'Y')
-    dist_3d_matrix = distance_3d(df_box, df_box, 'X', 'Y', 'Elevation')
-
-    edges_matrix = cost_matrix(df_box, dist_3d_matrix, line_bc)
-    length_limit = resolution * 1.5
-    edges_matrix[dist_2d_matrix > math.ceil(length_limit)] = 0
-
-    for i in branch_points:
-        if i[0] in edges_matrix.index.values and \
-                i[1] in edges_matrix.index.values:
-            edges_matrix.loc[i[0], i[1]] = 0.001
-            edges_matrix.loc[i[1], i[0]] = 0.001
-
-    edges_matrix_sparse = sparse.csr_matrix(edges_matrix)
-    graph = nx.from_scipy_sparse_matrix(edges_matrix_sparse)
+    edges_matrix = box_cost_matrix(df_box, line_bc, resolution,
+                                   edge_overlay(branch_points))
+    graph = nx.from_scipy_sparse_matrix(edges_matrix)
 
     # taking all cluster points inside the box (terminal nodes)
-    gdf_cluster_in_box = gpd.GeoDataFrame(crs=geo_df.crs, geometry=[])
-    for i in gdf_cluster_pop.ID:
-        point = df_box.loc[df_box['ID'] == i]
-        gdf_cluster_in_box = pd.concat([gdf_cluster_in_box, point], sort=True)
-    terminal_nodes = list(gdf_cluster_in_box.index)
+    box_index = pd.Series(df_box.index, index=df_box['ID'].values)
+    terminal_nodes = list(box_index.reindex(gdf_cluster_pop.ID).dropna()
+                          .astype(int))
     #check if graph is not empty
     if len(graph.edges) != 0:
         tree = steiner_tree(graph, terminal_nodes, weight='weight')
@@ -95,47 +82,24 @@ def steiner_roads(geo_df, gdf_cluster_pop, line_bc, resolution, gdf_roads,
     df_box_roads.index = pd.Series(range(df_box.index.shape[0],
                                          df_box.index.shape[0] +
                                          df_box_roads.index.shape[0]))
-    n_roads = df_box_roads.shape[0]
     df_box_segments = create_box(gdf_cluster_pop, roads_segments)
 
     df_box = df_box.append(df_box_roads)
     df_box = df_box.drop_duplicates('ID')
+    # positions in the box are the nodes of the graph
+    df_box.index = pd.Series(range(0, len(df_box.index)))
 
-    dist_2d_matrix = distance_2d(df_box, df_box, 'X', 'Y')
-    dist_3d_matrix = distance_3d(df_box, df_box, 'X', 'Y', 'Elevation')
-
-    costs_matrix = cost_matrix(df_box, dist_3d_matrix, line_bc)
-    edges_matrix = costs_matrix.copy()
-    for i in branch_points:
-        if i[0] in costs_matrix.index.values and \
-                i[1] in costs_matrix.index.values:
-            # reduce to zero the cost to be filtered later, but leaving
-            # the distance to be considered by the routing algorithm
-            costs_matrix.loc[i[0], i[1]] = 0.001
-            costs_matrix.loc[i[1], i[0]] = 0.001
-            edges_matrix.loc[i[0], i[1]] = dist_3d_matrix.loc[i[0], i[1]]
-            edges_matrix.loc[i[1], i[0]] = dist_3d_matrix.loc[i[0], i[1]]
-
-    length_limit = resolution * 1.5
-    edges_matrix[dist_2d_matrix > math.ceil(length_limit)] = 0
-    # removing connections between road points
-    edges_matrix.iloc[n:n + n_roads, n:n + n_roads] = 0
-    edges_matrix_sparse = sparse.csr_matrix(edges_matrix)
-    graph = nx.from_scipy_sparse_matrix(edges_matrix_sparse)
-
-    for x in range(df_box_segments.shape[0]):
-        # re-add segment of the road to the graph, with weight=distance[km]
-        graph.add_edge(
-            df_box.index[df_box['ID'] == df_box_segments.loc[x, 'ID1']][0],
-            df_box.index[df_box['ID'] == df_box_segments.loc[x, 'ID2']][0],
-            weight=df_box_segments.loc[x, 'length']*line_bc)
+    # reduce to zero the cost of the branches to be filtered later, but
+    # leaving the distance to be considered by the routing algorithm
+    costs_matrix, edges_matrix = road_box_matrices(
+        df_box, n, df_box_segments, line_bc, resolution,
+        edge_overlay(branch_points))
+    graph = nx.from_scipy_sparse_matrix(edges_matrix)
 
     # taking all cluster points inside the box (terminal nodes)
-    gdf_cluster_in_box = gpd.GeoDataFrame(crs=geo_df.crs, geometry=[])
-    for i in gdf_cluster_pop.ID:
-        point = df_box.loc[df_box['ID'] == i]
-        gdf_cluster_in_box = pd.concat([gdf_cluster_in_box, point], sort=True)
-    terminal_nodes = list(gdf_cluster_in_box.index)
+    box_index = pd.Series(df_box.index, index=df_box['ID'].values)
+    terminal_nodes = list(box_index.reindex(gdf_cluster_pop.ID).dropna()
+                          .astype(int))
 
     # df_box_roads.to_file('roads_box')
     # df_box_segments.to_file('roads_segments')
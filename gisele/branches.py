@@ -8,7 +8,8 @@ from gisele import Steinerman
 
 def routing(geo_df_clustered, geo_df, clusters_list, resolution,
             pop_thresh, input_sub, line_bc, limit_hv, limit_mv,
-            pop_load, gdf_lr, pop_thresh_lr, line_bc_col, full_ele='no'):
+            pop_load, gdf_lr, pop_thresh_lr, line_bc_col, full_ele='no',
+            memory_budget=4000, time_budget=600):
     s()
     print("4. Main Branch and Collateral's")
     s()
@@ -33,19 +34,23 @@ def routing(geo_df_clustered, geo_df, clusters_list, resolution,
     #                 roads.fclass != 'footway')]
 
     gdf_roads, roads_segments = create_roads(roads, geo_df)
+    # one graph of mesh and roads, sliced by all the routers
+    routing_graph(geo_df, resolution, gdf_roads, roads_segments)
 
     os.chdir(r'Output//Branches')
 
     grid_resume = main_branch(gdf_lr, geo_df_clustered, clusters_list,
                               resolution, pop_thresh_lr, line_bc, grid_resume,
-                              gdf_roads, roads_segments, geo_df)
+                              gdf_roads, roads_segments, geo_df,
+                              memory_budget, time_budget)
 
     grid_resume, all_collateral = collateral(geo_df_clustered, geo_df,
                                              clusters_list,
                                              resolution, pop_thresh,
                                              line_bc_col,
                                              grid_resume, pop_load, gdf_roads,
-                                             roads_segments)
+                                             roads_segments, memory_budget,
+                                             time_budget)
 
     if full_ele == 'yes':
         links(geo_df_clustered, geo_df, all_collateral, resolution, line_bc,
@@ -58,12 +63,14 @@ def routing(geo_df_clustered, geo_df, clusters_list, resolution,
 
 def main_branch(gdf_lr, geo_df_clustered, clusters_list, resolution,
                 pop_thresh_lr, line_bc, grid_resume, gdf_roads, roads_segments,
-                geo_df):
+                geo_df, memory_budget=4000, time_budget=600):
     all_branch = pd.DataFrame()
+    clusters = cluster_index(geo_df_clustered)
+    clusters_lr = cluster_index(gdf_lr)
     for i in clusters_list.Cluster:
 
-        gdf_cluster_only = geo_df_clustered[geo_df_clustered['Cluster'] == i]
-        gdf_lr_pop = gdf_lr[gdf_lr['Cluster'] == i]
+        gdf_cluster_only = cluster_points(geo_df_clustered, clusters, i)
+        gdf_lr_pop = cluster_points(gdf_lr, clusters_lr, i)
 
         gdf_lr_pop = gdf_lr_pop[gdf_lr_pop['Population'] >= pop_thresh_lr]
 
@@ -72,20 +79,17 @@ def main_branch(gdf_lr, geo_df_clustered, clusters_list, resolution,
         print("Creating main branch for Cluster n." + str(i) + " of "
               + str(len(clusters_list.Cluster)))
         l()
-        # lr = int(
-        #     (((math.sqrt(clusters_list.Size.min())) / 3) + 1) * resolution)
-        lr=resolution*3 #how much power more can the main branch supply
         if points_to_electrify > 1:
             #  cluster gdf is given instead of total gdf to force internal mb
 
             # branch, branch_cost, branch_length, branch_points = Steinerman. \
             #     steiner_roads(geo_df, gdf_lr_pop, line_bc,
             #             resolution, gdf_roads, roads_segments)
-            if points_to_electrify < lr / 5 and gdf_cluster_only.length.size < 500:
+            if routing_plan(gdf_cluster_only, gdf_lr_pop, memory_budget,
+                            time_budget)[0] == 'steiner':
                 branch, branch_cost, branch_length, branch_points = Steinerman. \
                     steiner(gdf_cluster_only, gdf_lr_pop, line_bc, resolution)
             else:
-                print('Cluster too big to use Steiner, use Spider')
                 branch, branch_cost, branch_length, branch_points = Spiderman. \
                     spider(gdf_cluster_only, gdf_lr_pop, line_bc, resolution, gdf_roads,
                            roads_segments)
@@ -110,13 +114,15 @@ def main_branch(gdf_lr, geo_df_clustered, clusters_list, resolution,
 
 
 def collateral(geo_df_clustered, geo_df, clusters_list,
-               resolution, pop_thresh, line_bc_col, grid_resume, pop_load, gdf_roads, roads_segments):
+               resolution, pop_thresh, line_bc_col, grid_resume, pop_load, gdf_roads, roads_segments,
+               memory_budget=4000, time_budget=600):
 
     all_connections = pd.DataFrame()
     all_collateral = pd.DataFrame()
+    clusters = cluster_index(geo_df_clustered)
     for i in clusters_list.Cluster:
 
-        gdf_cluster = geo_df_clustered[geo_df_clustered['Cluster'] == i]
+        gdf_cluster = cluster_points(geo_df_clustered, clusters, i)
         gdf_clusters_pop = gdf_cluster[gdf_cluster
                                             ['Population'] >= pop_thresh]
         l()
@@ -129,12 +135,12 @@ def collateral(geo_df_clustered, geo_df, clusters_list,
             #     Steinerman.steiner_roads(geo_df, gdf_clusters_pop, line_bc,
             #                              resolution, gdf_roads,
             #                              roads_segments)
-            if gdf_clusters_pop['Population'].size < resolution / 5 and gdf_cluster.length.size < 500:
+            if routing_plan(geo_df, gdf_clusters_pop, memory_budget,
+                            time_budget)[0] == 'steiner':
                 col, col_cost, col_length, col_points = \
                     Steinerman.steiner(geo_df, gdf_clusters_pop, line_bc_col,
                                        resolution, branch_points)
             else:
-                print('Cluster too big to use Steiner')
                 col, col_cost, col_length, col_points = \
                     Spiderman.spider(gdf_cluster, gdf_clusters_pop, line_bc_col,
                                        resolution, gdf_roads,
@@ -174,13 +180,12 @@ def collateral(geo_df_clustered, geo_df, clusters_list,
         #     Steinerman.steiner_roads(geo_df, gdf_clusters_pop, line_bc_col,
         #                        resolution, gdf_roads, roads_segments,
         #                        branch_points)
-        if gdf_clusters_pop[
-            'Population'].size < resolution / 5 and gdf_cluster.length.size < 500:
+        if routing_plan(geo_df, gdf_clusters_pop, memory_budget,
+                        time_budget)[0] == 'steiner':
             col, col_cost, col_length, col_points = \
                 Steinerman.steiner(geo_df, gdf_clusters_pop, line_bc_col,
                                    resolution, branch_points)
         else:
-            print('Cluster too big to use Steiner')
             col, col_cost, col_length, col_points = \
                 Spiderman.spider(gdf_cluster, gdf_clusters_pop, line_bc_col,
                                  resolution, gdf_roads,
@@ -279,52 +284,12 @@ def reduce_resolution(input_csv, geo_df, resolution, geo_df_clustered,
         return gdf_lr
 
     print('Creating a lower resolution geodataframe..')
-    min_x, min_y, max_x, max_y = geo_df.geometry.total_bounds
+    sizes = cluster_index(geo_df_clustered)[1]['Size']
     for i in clusters_list.Cluster:
-        size = geo_df_clustered[geo_df_clustered['Cluster'] == i].__len__()
-        clusters_list.loc[i, 'Size'] = size
-    lr = int((((math.sqrt(clusters_list.Size.min())) / 3) + 1) * resolution)
-    length = lr
-    wide = lr
-    cols = list(
-        range(int(np.floor(min_x - lr)), int(np.ceil(max_x + lr)), wide))
-    rows = list(
-        range(int(np.floor(min_y - lr)), int(np.ceil(max_y + lr)), length))
-    rows.reverse()
-    polygons = []
-    for x in cols:
-        for y in rows:
-            polygons.append(Polygon(
-                [(x, y), (x + wide, y), (x + wide, y - length),
-                 (x, y - length)]))
-
-    gdf_lr = gpd.GeoDataFrame({'geometry': polygons}, crs=geo_df.crs)
-    for i in gdf_lr.iterrows():
-
-        if geo_df.geometry.within(i[1][0]).any():
-            inner_points = geo_df_clustered[
-                geo_df_clustered.geometry.within(i[1][0])]
-            gdf_lr.loc[i[0], 'Population'] = inner_points.Population.sum()
-            gdf_lr.loc[i[0], 'Elevation'] = inner_points.Population.mean()
-            gdf_lr.loc[i[0], 'Weight'] = inner_points.Population.mean()
-            if not inner_points[inner_points.Cluster != -1].empty:
-                nearest_p = shapely.ops.\
-                    nearest_points(i[1][0].centroid,
-                                   inner_points[inner_points.Cluster != -1]
-                                   .unary_union)
-                cluster = inner_points[inner_points.geometry == nearest_p[1]]
-                gdf_lr.loc[i[0], 'Cluster'] = cluster.Cluster.values[0]
-                gdf_lr.loc[i[0], 'ID'] = cluster.ID.values[0]
-            else:
-                gdf_lr.loc[i[0], 'Cluster'] = -1
-        else:
-            gdf_lr.loc[i[0], 'Population'] = 0
-            gdf_lr.loc[i[0], 'Elevation'] = 0
-            gdf_lr.loc[i[0], 'Weight'] = 0
-    gdf_lr['geometry'] = gdf_lr['geometry'].centroid
-    gdf_lr.dropna(subset=["Cluster"], inplace=True)
-    gdf_lr['X'] = gdf_lr.geometry.x
-    gdf_lr['Y'] = gdf_lr.geometry.y
+        clusters_list.loc[i, 'Size'] = sizes.get(i, 0)
+    # nearest level of the pyramid stored with the mesh
+    factor = int(((math.sqrt(clusters_list.Size.min())) / 3) + 1)
+    gdf_lr = mesh_level(factor, geo_df, resolution, geo_df_clustered)
 
     gdf_lr.to_csv(r'Output/Branches/' + input_csv + '_lr.csv', index=False)
     gdf_lr.to_file(r'Output/Branches/' + input_csv + '_lr.shp')
@@ -0,0 +1,200 @@
+"""
+GIS For Electrification (GISEle)
+Developed by the Energy Department of Politecnico di Milano
+Mesh Cache Code
+
+Code for storing the weighted mesh of a study area and re-using it in the
+following runs, as long as the study area, the parameters and the input
+files do not change. Each entry is a folder of the cache named after the
+hash of all these inputs, so that changing any of them gives a new entry.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+
+CACHE_DIR = 'Cache'
+META_FILE = 'meta.json'
+
+
+def file_checksum(path, block_size=2 ** 20):
+    """
+    Checksum of the content of a file, or of all the files in a folder. Zip
+    archives are hashed by the names and CRCs of their members and dBase
+    tables without their date of last update, so that a layer downloaded
+    again with the same data gives the same checksum.
+    :param path: Path of the file or folder
+    :param block_size: Number of bytes read at a time
+    :return checksum: Hexadecimal sha1 digest
+    """
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                digest.update(file.encode())
+                digest.update(file_checksum(os.path.join(root, file),
+                                            block_size).encode())
+        return digest.hexdigest()
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in sorted(archive.infolist(), key=lambda i: i.filename):
+                digest.update(info.filename.encode())
+                digest.update(str(info.CRC).encode())
+        return digest.hexdigest()
+    with open(path, 'rb') as f:
+        if path.lower().endswith('.dbf'):
+            # bytes 1-3 of the header are the date of the last update
+            digest.update(f.read(4)[:1])
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def mesh_key(study_area, crs, resolution, landcover_option, inputs=(),
+             options=()):
+    """
+    Key of the cache entry of a weighted mesh.
+    :param study_area: Geodataframe with the polygon of the study area
+    :param crs: Coordinate Reference System of the electrification project
+    :param resolution: Resolution of the mesh [m]
+    :param landcover_option: Land cover classification used for the weights
+    :param inputs: Paths of the input files (or folders) the mesh depends on;
+        missing paths are part of the key as well
+    :param options: Other parameters the mesh depends on
+    :return key: Hexadecimal sha1 digest
+    """
+    digest = hashlib.sha1()
+    digest.update(study_area.to_crs(epsg=4326).geometry.unary_union.wkb)
+    digest.update(str(int(crs)).encode())
+    digest.update(repr(float(resolution)).encode())
+    digest.update(str(landcover_option).encode())
+    for option in options:
+        digest.update(repr(option).encode())
+    for path in inputs:
+        digest.update(path.encode())
+        if os.path.exists(path):
+            digest.update(file_checksum(path).encode())
+    return digest.hexdigest()
+
+
+def entry_size(path):
+    """
+    Size of a cache entry.
+    :param path: Folder of the entry
+    :return size: Size of all its files [bytes]
+    """
+    return sum(os.path.getsize(os.path.join(root, file))
+               for root, dirs, files in os.walk(path) for file in files)
+
+
+def load_mesh(key, destination='Output/Datasets', cache_dir=CACHE_DIR):
+    """
+    Copy the files of a cached mesh (or of another cached entry, such as a
+    cost surface) where GISEle expects them.
+    :param key: Key of the entry, as given by mesh_key
+    :param destination: Folder where the files are copied, it is created if
+        missing
+    :param cache_dir: Folder of the cache
+    :return meta: Dictionary stored with the entry, None if it is missing
+    """
+    entry = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry, META_FILE)
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    os.makedirs(destination, exist_ok=True)
+    for file in meta['files']:
+        source = os.path.join(entry, file)
+        target = os.path.join(destination, file)
+        if os.path.isdir(source):
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, target)
+        else:
+            shutil.copy2(source, target)
+    meta['last_used'] = time.time()
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    print('Loaded from the cache (' + key[:10] + ')')
+    return meta
+
+
+def store_mesh(key, files, source='Output/Datasets', cache_dir=CACHE_DIR,
+               max_size=2 * 1024 ** 3, **meta):
+    """
+    Store the files of a weighted mesh in the cache, then evict the least
+    recently used entries if the cache is larger than max_size.
+    :param key: Key of the entry, as given by mesh_key
+    :param files: Files or folders, relative to source, to be stored
+    :param source: Folder containing the files
+    :param cache_dir: Folder of the cache
+    :param max_size: Maximum size of the cache [bytes]
+    :param meta: Other values stored with the entry (e.g. number of points)
+    """
+    entry = os.path.join(cache_dir, key)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.makedirs(entry)
+    for file in files:
+        path = os.path.join(source, file)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(entry, file))
+        else:
+            shutil.copy2(path, os.path.join(entry, file))
+    meta.update({'files': list(files), 'created': time.time(),
+                 'last_used': time.time()})
+    # the meta file is written last, an entry without it is incomplete
+    with open(os.path.join(entry, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    evict(max_size, cache_dir, keep=key)
+
+
+def invalidate(key, cache_dir=CACHE_DIR):
+    """
+    Remove an entry from the cache.
+    :param key: Key of the entry, as given by mesh_key
+    :param cache_dir: Folder of the cache
+    """
+    shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+
+def clear(cache_dir=CACHE_DIR):
+    """
+    Remove all the entries of the cache.
+    :param cache_dir: Folder of the cache
+    """
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def evict(max_size, cache_dir=CACHE_DIR, keep=None):
+    """
+    Remove the least recently used entries until the cache is not larger
+    than max_size. Incomplete entries are always removed.
+    :param max_size: Maximum size of the cache [bytes]
+    :param cache_dir: Folder of the cache
+    :param keep: Key of an entry that must not be removed
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        meta_file = os.path.join(entry, META_FILE)
+        if not os.path.isfile(meta_file):
+            shutil.rmtree(entry, ignore_errors=True)
+            continue
+        with open(meta_file) as f:
+            last_used = json.load(f)['last_used']
+        entries.append((last_used, key, entry_size(entry)))
+    total_size = sum(entry[2] for entry in entries)
+    for last_used, key, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        if key == keep:
+            continue
+        invalidate(key, cache_dir)
+        total_size -= size
+        print('Entry ' + key[:10] + ' removed from the cache')
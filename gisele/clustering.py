@@ -9,28 +9,205 @@ DBSCAN algorithm with the possibility of merging clusters.
 """
 
 import os
+import hashlib
+import threading
 import pandas as pd
+import geopandas as gpd
 import numpy as np
 import plotly.express as px
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import radius_neighbors_graph
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.spatial import cKDTree
 import plotly.graph_objs as go
-from gisele.functions import l, s
+from gisele.functions import l, s, lattice_index, cluster_index
 
+SENSITIVITY_CACHE = 'Output/Clusters/Sensitivity/results.csv'
+# the cache and the tables of the sensitivity are written by the analysis
+# running in the background and read by the dashboard
+sensitivity_lock = threading.Lock()
 
-def sensitivity(resolution, pop_points, geo_df, eps, pts, spans):
+
+def sensitivity(resolution, pop_points, geo_df, eps, pts, spans, n_jobs=-1):
     """
     Sensitivity analysis performed to help the user chose the clustering
     parameters, from a range of values run the DBSCAN several times and exports
-    a table containing useful information.
+    a table containing useful information. The neighbours of all points are
+    found once, at the largest eps, and the values of eps are explored in
+    parallel on that graph (see sensitivity_steps).
     :param resolution: resolution of the dataframe df
     :param pop_points: array containing the 3 coordinates of all points
     :param geo_df: Input Geodataframe of points
+    :param n_jobs: number of parallel processes (-1 to use all cpus)
     """
     s()
     print("2.Clustering - Sensitivity Analysis")
+    span_eps, span_pts = sensitivity_spans(eps, pts, spans)
+    results = {}
+    for step in sensitivity_steps(resolution, pop_points, geo_df, span_eps,
+                                  span_pts, 'dbscan', n_jobs):
+        results.update(step)
+    return sensitivity_output(*sensitivity_tables(results, span_eps,
+                                                  span_pts))
+
+
+def sensitivity_steps(resolution, pop_points, geo_df, span_eps, span_pts,
+                      engine='dbscan', n_jobs=-1,
+                      cache_file=SENSITIVITY_CACHE):
+    """
+    Run the sensitivity analysis step by step, yielding the results as soon
+    as they are computed, so that they can be shown while the analysis goes
+    on. The results are cached: the ones already computed for the same
+    points (e.g. before widening the range) are yielded first, and only
+    the missing combinations are computed. The dbscan engine computes a
+    value of eps (all its pts) per job, the reachability engine a value of
+    pts (all its eps) per job; each step is a batch of parallel jobs.
+    :param resolution: resolution of the dataframe df
+    :param pop_points: array containing the 3 coordinates of all points
+    :param geo_df: Input Geodataframe of points
+    :param span_eps: list of values of the neighbourhood
+    :param span_pts: list of values of the minimum points
+    :param engine: dbscan (see sensitivity_eps) or reachability (see
+        sensitivity_pts)
+    :param n_jobs: number of parallel processes (-1 to use all cpus)
+    :param cache_file: csv file of the cached results
+    :return: for each step, a dictionary of the statistics (as given by
+        cluster_statistics) of each computed (eps, pts)
+    """
+    population = geo_df['Population'].values.astype(float)
+    total_people = int(population.sum())
+    key = sensitivity_key(pop_points, population, resolution)
+    cached = read_sensitivity_cache(key, cache_file)
+    cells = [(eps, pts) for eps in span_eps for pts in span_pts]
+    step = dict((cell, cached[cell]) for cell in cells if cell in cached)
+    if step:
+        print(str(len(step)) + ' combinations taken from the cache')
+        yield step
+    missing = [cell for cell in cells if cell not in cached]
+    if not missing:
+        return
+
+    graph = neighbour_graph(pop_points, max(cell[0] for cell in missing))
+    if engine == 'reachability':
+        graph = sorted_neighbours(graph, population)
+        tasks = [(pts, sorted(set(cell[0] for cell in missing
+                                  if cell[1] == pts)))
+                 for pts in sorted(set(cell[1] for cell in missing))]
+        job = delayed(sensitivity_pts)
+    else:
+        tasks = [(eps, sorted(set(cell[1] for cell in missing
+                                  if cell[0] == eps)))
+                 for eps in sorted(set(cell[0] for cell in missing))]
+        job = delayed(sensitivity_eps)
+    batch = effective_n_jobs(n_jobs)
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for first in range(0, len(tasks), batch):
+            results = parallel(job(graph, population, value, span,
+                                   resolution, total_people)
+                               for value, span in tasks[first:first + batch])
+            step = {}
+            for (value, span), results_value in zip(tasks[first:first + batch],
+                                                    results):
+                for other, result in zip(span, results_value):
+                    cell = (other, value) if engine == 'reachability' \
+                        else (value, other)
+                    step[cell] = result
+            write_sensitivity_cache(key, step, cache_file)
+            yield step
+
+
+def sensitivity_key(pop_points, population, resolution):
+    """
+    Key of the cached results of the sensitivity analysis, changing with the
+    points, their population and the resolution.
+    :param pop_points: array containing the 3 coordinates of all points
+    :param population: population of the points
+    :param resolution: resolution of the dataframe df
+    :return key: Hexadecimal sha1 digest
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(pop_points, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(population, dtype=float).tobytes())
+    digest.update(repr(float(resolution)).encode())
+    return digest.hexdigest()
+
+
+def read_sensitivity_cache(key, cache_file=SENSITIVITY_CACHE):
+    """
+    Results of the sensitivity analysis already computed for the same key.
+    :param key: key of the results, as given by sensitivity_key
+    :param cache_file: csv file of the cached results
+    :return cached: dictionary of the statistics of each (eps, pts)
+    """
+    with sensitivity_lock:
+        if not os.path.isfile(cache_file):
+            return {}
+        df = pd.read_csv(cache_file)
+    df = df[df['Key'] == key]
+    return dict(((row.Eps, row.MinPts),
+                 (row.Clusters, row.People, row.Area, row.People_area))
+                for row in df.itertuples())
+
+
+def write_sensitivity_cache(key, results, cache_file=SENSITIVITY_CACHE):
+    """
+    Append new results of the sensitivity analysis to the cache; the results
+    of other keys (i.e. other meshes) are dropped.
+    :param key: key of the results, as given by sensitivity_key
+    :param results: dictionary of the statistics of each (eps, pts)
+    :param cache_file: csv file of the cached results
+    """
+    df = pd.DataFrame([(key, eps, pts) + tuple(result)
+                       for (eps, pts), result in results.items()],
+                      columns=['Key', 'Eps', 'MinPts', 'Clusters', 'People',
+                               'Area', 'People_area'])
+    with sensitivity_lock:
+        if os.path.isfile(cache_file):
+            old = pd.read_csv(cache_file)
+            df = pd.concat([old[old['Key'] == key], df], ignore_index=True)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        df.to_csv(cache_file, index=False)
+
+
+def sensitivity_tables(results, span_eps, span_pts):
+    """
+    Tables of the sensitivity analysis, with the combinations not computed
+    yet left empty. Repeated values of the parameters (e.g. more spans than
+    values in the range) have a single row or column.
+    :param results: dictionary of the statistics of each (eps, pts)
+    :param span_eps: list of values of the neighbourhood
+    :param span_pts: list of values of the minimum points
+    :return: tables of the number of clusters, % of clustered people, % of
+        clustered area and people per km2, rows eps and columns pts
+    """
+    span_eps = list(dict.fromkeys(span_eps))
+    span_pts = list(dict.fromkeys(span_pts))
+    tab_area = pd.DataFrame(index=span_eps, columns=span_pts)
+    tab_people = pd.DataFrame(index=span_eps, columns=span_pts)
+    tab_people_area = pd.DataFrame(index=span_eps, columns=span_pts)
+    tab_cluster = pd.DataFrame(index=span_eps, columns=span_pts)
+    for (eps, pts), result in results.items():
+        n_clusters_, clustered_people, perc_area, people_area = result
+        tab_cluster.at[eps, pts] = n_clusters_
+        tab_people.at[eps, pts] = clustered_people
+        tab_area.at[eps, pts] = perc_area
+        tab_people_area.at[eps, pts] = people_area
+    return tab_cluster, tab_people, tab_area, tab_people_area
+
+
+def sensitivity_spans(eps, pts, spans):
+    """
+    Values of the two clustering parameters explored by the sensitivity.
+    :param eps: [min, max] of the neighbourhood
+    :param pts: [min, max] of the minimum points
+    :param spans: number of values of each parameter
+    :return span_eps: list of values of the neighbourhood
+    :return span_pts: list of values of the minimum points
+    """
     span_eps = []
     span_pts = []
-
     for j in range(1, spans + 1):
         if spans != 1:
             eps_ = int(eps[0] + (eps[1] - eps[0]) / (spans - 1) * (j - 1))
@@ -43,36 +220,213 @@ def sensitivity(resolution, pop_points, geo_df, eps, pts, spans):
         else:
             pts_ = int(pts[0] + (pts[1] - pts[0]) / spans * (i - 1))
         span_pts.append(pts_)
+    return span_eps, span_pts
 
-    tab_area = pd.DataFrame(index=span_eps, columns=span_pts)
-    tab_people = pd.DataFrame(index=span_eps, columns=span_pts)
-    tab_people_area = pd.DataFrame(index=span_eps, columns=span_pts)
-    tab_cluster = pd.DataFrame(index=span_eps, columns=span_pts)
-    total_people = int(geo_df['Population'].sum(axis=0))
 
+def neighbour_graph(pop_points, radius):
+    """
+    Sparse matrix with the distances between all the points closer than
+    radius, to be shared by all the DBSCAN runs with eps <= radius.
+    :param pop_points: array containing the 3 coordinates of all points
+    :param radius: largest neighbourhood that will be used
+    :return graph: sparse distance matrix (csr)
+    """
+    return radius_neighbors_graph(pop_points, radius, mode='distance',
+                                  metric='euclidean', n_jobs=-1)
+
+
+def cluster_statistics(n_clusters_, noise, population, resolution,
+                       total_people):
+    """
+    Statistics shown by the sensitivity analysis for a set of clusters.
+    :param n_clusters_: number of clusters
+    :param noise: boolean array, True for the points outside the clusters
+    :param population: population of the points
+    :param resolution: resolution of the dataframe df
+    :param total_people: total population of the points
+    :return: number of clusters, % of clustered people, % of clustered area
+             and people per km2 in the clusters
+    """
+    noise_people = round(population[noise].sum(), 0)
+    clustered_area = (noise.size - noise.sum()) * (resolution/1000)**2
+    perc_area = int(clustered_area / noise.size * 100)
+    clustered_people = int((1 - noise_people / total_people) * 100)
+    if clustered_area != 0:  # check to avoid crash by divide zero
+        people_area = (total_people - noise_people) / clustered_area
+    else:
+        people_area = 0
+    return n_clusters_, clustered_people, perc_area, people_area
+
+
+def sensitivity_eps(graph, population, eps, span_pts, resolution,
+                    total_people):
+    """
+    Run all the combinations of the sensitivity analysis with the same eps.
+    The results are the ones of DBSCAN, whose clusters are the connected
+    groups of core points (points whose neighbourhood has at least pts
+    people), while noise points are not core and have no core neighbour:
+    the neighbour graph is filtered once for eps and then only the core
+    points change with pts.
+    :param graph: sparse distance matrix, as given by neighbour_graph
+    :param population: population of the points
+    :param eps: neighbourhood
+    :param span_pts: list of values of the minimum points
+    :return results: statistics of the clusters for each value of pts, as
+        given by cluster_statistics
+    """
+    within = graph.copy()
+    within.data = (within.data <= eps).astype(float)
+    within.eliminate_zeros()
+    # people in the neighbourhood of each point, the point included
+    weight = within.dot(population) + population
+    results = []
+    for pts in span_pts:
+        core = weight >= pts
+        if core.any():
+            n_clusters_ = connected_components(within[core][:, core],
+                                               directed=False)[0]
+        else:
+            n_clusters_ = 0
+        noise = ~core & (within.dot(core.astype(float)) == 0)
+        results.append(cluster_statistics(n_clusters_, noise, population,
+                                          resolution, total_people))
+    return results
+
+
+def sensitivity_optics(resolution, pop_points, geo_df, eps, pts, spans,
+                       eps_spans=None, n_jobs=-1):
+    """
+    Alternative engine of the sensitivity analysis, giving the same tables.
+    For each value of pts the reachability of every point (OPTICS-like, with
+    the population as weight) is computed once on the shared neighbour
+    graph; the DBSCAN results for any eps are then read from it, so eps can
+    be explored with a much finer grid.
+    :param resolution: resolution of the dataframe df
+    :param pop_points: array containing the 3 coordinates of all points
+    :param geo_df: Input Geodataframe of points
+    :param eps_spans: number of values of eps (by default spans)
+    :param n_jobs: number of parallel processes (-1 to use all cpus)
+    """
+    s()
+    print("2.Clustering - Sensitivity Analysis (reachability)")
+    span_eps, span_pts = sensitivity_spans(eps, pts, spans)
+    if eps_spans:
+        span_eps = sensitivity_spans(eps, pts, eps_spans)[0]
+    span_eps = sorted(set(span_eps))
+    results = {}
+    for step in sensitivity_steps(resolution, pop_points, geo_df, span_eps,
+                                  span_pts, 'reachability', n_jobs):
+        results.update(step)
+    return sensitivity_output(*sensitivity_tables(results, span_eps,
+                                                  span_pts))
+
+
+def sorted_neighbours(graph, population):
+    """
+    Sort the neighbours of each point by distance and compute the people
+    within each of these distances, which is all that is needed to find the
+    core distance of the points for any value of pts.
+    :param graph: sparse distance matrix, as given by neighbour_graph
+    :param population: population of the points
+    :return graph: dictionary with the graph, the row of each of its
+        entries, the sorted distances and the cumulated people
+    """
+    graph = graph.tocsr()
+    rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    order = np.lexsort((graph.data, rows))
+    distance = graph.data[order]
+    people = np.cumsum(population[graph.indices[order]])
+    # people within each distance, the point itself included
+    start = np.concatenate(([0], people))[graph.indptr[:-1]]
+    people = people - start[rows] + population[rows]
+    return {'graph': graph, 'rows': rows, 'distance': distance,
+            'people': people}
+
+
+def row_min(values, graph):
+    """
+    Minimum of the values of the entries of each row of a sparse matrix.
+    :param values: array with a value for each entry of graph
+    :param graph: sparse matrix (csr)
+    :return minimum: array with the minimum of each row, inf if empty
+    """
+    minimum = np.full(graph.shape[0], np.inf)
+    not_empty = np.diff(graph.indptr) > 0
+    if not_empty.any():
+        minimum[not_empty] = np.minimum.reduceat(
+            values, graph.indptr[:-1][not_empty])
+    return minimum
+
+
+def reachability(graph, population, pts):
+    """
+    Core distance and reachability of each point for a value of pts: with
+    DBSCAN, a point is core for eps >= its core distance and it is part of
+    a cluster for eps >= its reachability, that is the smallest eps that
+    makes it core or puts it within eps of a core point.
+    :param graph: dictionary given by sorted_neighbours
+    :param population: population of the points
+    :param pts: minimum points (minimum population of a core neighbourhood)
+    :return core: core distance of each point (inf if not core at all)
+    :return reach: reachability of each point (inf if always noise)
+    """
+    core = row_min(np.where(graph['people'] >= pts, graph['distance'],
+                            np.inf), graph['graph'])
+    core[population >= pts] = 0
+    matrix = graph['graph']
+    reach = row_min(np.maximum(matrix.data, core[matrix.indices]), matrix)
+    return core, np.minimum(core, reach)
+
+
+def sensitivity_pts(graph, population, pts, span_eps, resolution,
+                    total_people):
+    """
+    Run all the combinations of the sensitivity analysis with the same pts.
+    Two core points are in the same cluster for eps >= max(distance, core
+    distances), so the number of merges of clusters up to eps is the number
+    of edges shorter than eps in the minimum spanning forest of these
+    weights (Kruskal), and the number of clusters is the number of core
+    points minus the merges.
+    :param graph: dictionary given by sorted_neighbours
+    :param population: population of the points
+    :param pts: minimum points
+    :param span_eps: sorted list of values of the neighbourhood
+    :return results: statistics of the clusters for each value of eps, as
+        given by cluster_statistics
+    """
+    core, reach = reachability(graph, population, pts)
+    matrix = graph['graph'].tocoo()
+    weight = np.maximum(matrix.data, np.maximum(core[matrix.row],
+                                                core[matrix.col]))
+    finite = np.isfinite(weight)
+    # zero weights would be taken as missing edges
+    weight = np.maximum(weight[finite], np.finfo(float).tiny)
+    forest = minimum_spanning_tree(coo_matrix(
+        (weight, (matrix.row[finite], matrix.col[finite])),
+        shape=matrix.shape))
+    merges = np.sort(forest.data)
+    core = np.sort(core)
+
+    results = []
     for eps in span_eps:
-        for pts in span_pts:
-            db = DBSCAN(eps=eps, min_samples=pts, metric='euclidean'). \
-                fit(pop_points, sample_weight=geo_df['Population'])
-            labels = db.labels_
-            n_clusters_ = int(len(set(labels)) -
-                              (1 if -1 in labels else 0))
-            geo_df['clusters'] = labels
-            gdf_pop_noise = geo_df[geo_df['clusters'] == -1]
-            noise_people = round(sum(gdf_pop_noise['Population']), 0)
-            clustered_area = (len(geo_df) - len(gdf_pop_noise)) * \
-                             (resolution/1000)**2
-            perc_area = int(clustered_area / len(geo_df) * 100)
-            clustered_people = int((1 - noise_people / total_people) * 100)
-            if clustered_area != 0:  # check to avoid crash by divide zero
-                people_area = (total_people - noise_people) \
-                              / clustered_area
-            else:
-                people_area = 0
-            tab_cluster.at[eps, pts] = n_clusters_
-            tab_people.at[eps, pts] = clustered_people
-            tab_area.at[eps, pts] = perc_area
-            tab_people_area.at[eps, pts] = people_area
+        n_clusters_ = int(np.searchsorted(core, eps, side='right') -
+                          np.searchsorted(merges, eps, side='right'))
+        results.append(cluster_statistics(n_clusters_, reach > eps,
+                                          population, resolution,
+                                          total_people))
+    return results
+
+
+def sensitivity_output(tab_cluster, tab_people, tab_area, tab_people_area):
+    """
+    Print and export the tables of the sensitivity analysis and create the
+    plot of its results.
+    :param tab_cluster: number of clusters, rows eps and columns pts
+    :param tab_people: % of clustered people
+    :param tab_area: % of clustered area
+    :param tab_people_area: people per km2 in the clusters
+    :return fig: 3D scatter plot of the results
+    """
     print(
         "Number of clusters - columns MINIMUM POINTS - rows NEIGHBOURHOOD")
     print(tab_cluster)
@@ -90,41 +444,49 @@ def sensitivity(resolution, pop_points, geo_df, eps, pts, spans):
     print("People per area - columns MINIMUM POINTS - rows NEIGHBOURHOOD")
     print(tab_people_area)
     l()
-    plt_sens = pd.DataFrame(index=range(tab_people_area.size),
-                            columns=['Eps', 'MinPts', 'People/km²',
-                                     '% of Clustered People',
-                                     'Electrification Filter',
-                                     'Number of Clusters',
-                                     '% of Area Clustered'],
-                            dtype=float)
-    count = 0
-    for i, row in tab_people_area.iterrows():
-        for j in row:
-            plt_sens.loc[count, 'Eps'] = i
-            plt_sens.loc[count, 'MinPts'] = int(row.index[row == j][0])
-            plt_sens.loc[count, 'People/km²'] = round(j, 4)
-            plt_sens.loc[count, '% of Clustered People'] = \
-                tab_people.loc[i, row.index[row == j]].values[0]
-            plt_sens.loc[count, 'Number of Clusters'] = \
-                tab_cluster.loc[i, row.index[row == j]].values[0]
-            plt_sens.loc[count, '% of Area Clustered'] = \
-                tab_area.loc[i, row.index[row == j]].values[0]
-            if plt_sens.loc[count, '% of Clustered People'] > 95:
-                plt_sens.loc[count, 'Electrification Filter'] = 'Over 95%'
-                count += 1
-                continue
-
-            if plt_sens.loc[count, '% of Clustered People'] > 85:
-                plt_sens.loc[count, 'Electrification Filter'] = '85-95%'
-                count += 1
-                continue
-            if plt_sens.loc[count, '% of Clustered People'] > 75:
-                plt_sens.loc[count, 'Electrification Filter'] = '75-85%'
-                count += 1
-                continue
-            else:
-                plt_sens.loc[count, 'Electrification Filter'] = 'Under 75%'
-                count += 1
+    fig = sensitivity_plot(tab_cluster, tab_people, tab_area,
+                           tab_people_area)
+    with sensitivity_lock:
+        if not os.path.exists('Output/Clusters/Sensitivity'):
+            os.makedirs('Output/Clusters/Sensitivity')
+        tab_cluster.to_csv(r"Output/Clusters/Sensitivity/n_clusters.csv")
+        tab_people.to_csv(r"Output/Clusters/Sensitivity/%_peop.csv")
+        tab_area.to_csv(r"Output/Clusters/Sensitivity/%_area.csv")
+        tab_people_area.to_csv(
+            r"Output/Clusters/Sensitivity/people_area.csv")
+    print("Clustering sensitivity process completed.\n"
+          "You can check the tables in the Output folder.")
+    l()
+
+    return fig
+
+
+def sensitivity_plot(tab_cluster, tab_people, tab_area, tab_people_area):
+    """
+    Create the plot of the results of the sensitivity analysis, also while
+    it is running: the combinations not computed yet are missing.
+    :param tab_cluster: number of clusters, rows eps and columns pts
+    :param tab_people: % of clustered people
+    :param tab_area: % of clustered area
+    :param tab_people_area: people per km2 in the clusters
+    :return fig: 3D scatter plot of the results
+    """
+    people_area = tab_people_area.stack().dropna()
+    cells = people_area.index
+    plt_sens = pd.DataFrame({
+        'Eps': cells.get_level_values(0).astype(float),
+        'MinPts': cells.get_level_values(1).astype(int),
+        'People/km²': people_area.values.astype(float).round(4),
+        '% of Clustered People':
+            tab_people.stack().reindex(cells).values.astype(float),
+        'Number of Clusters':
+            tab_cluster.stack().reindex(cells).values.astype(float),
+        '% of Area Clustered':
+            tab_area.stack().reindex(cells).values.astype(float)})
+    people = plt_sens['% of Clustered People']
+    plt_sens['Electrification Filter'] = np.select(
+        [people > 95, people > 85, people > 75],
+        ['Over 95%', '85-95%', '75-85%'], 'Under 75%')
 
     fig = px.scatter_3d(plt_sens, x='Eps', y='MinPts',
                         z='People/km²',
@@ -142,34 +504,38 @@ def sensitivity(resolution, pop_points, geo_df, eps, pts, spans):
             xanchor="right",
             x=1
         ))
-    if not os.path.exists('Output/Clusters/Sensitivity'):
-        os.makedirs('Output/Clusters/Sensitivity')
-    tab_cluster.to_csv(r"Output/Clusters/Sensitivity/n_clusters.csv")
-    tab_people.to_csv(r"Output/Clusters/Sensitivity/%_peop.csv")
-    tab_area.to_csv(r"Output/Clusters/Sensitivity/%_area.csv")
-    tab_people_area.to_csv(r"Output/Clusters/Sensitivity/people_area.csv")
-    print("Clustering sensitivity process completed.\n"
-          "You can check the tables in the Output folder.")
-    l()
-
     return fig
 
 
-def analysis(pop_points, geo_df, pop_load, eps, pts):
+def analysis(pop_points, geo_df, pop_load, eps, pts, method='dbscan',
+             resolution=None, tile_size=500):
     """
     Running of the DBSCAN algorithm with specific parameters and the
     possibility of merging clusters by the user.
     :param pop_points: array containing the 3 coordinates of all points
     :param geo_df: Input Geodataframe of points
     :param pop_load: Estimated load per capita [kW/person]
+    :param method: dbscan, lattice to use lattice_clusters on regular
+            meshes or tiled to use tiled_clusters on large meshes
+    :param resolution: resolution of the mesh, needed by the lattice and
+            tiled methods
+    :param tile_size: number of mesh points on each side of a tile, for the
+            tiled method
     :return geo_df_clustered: Input Geodataframe of points with every point
             having a cluster assigned to it.
             (Cluster attribute = -1 means points outside of clustered areas.)
     :return clusters_list: List of all Clusters' ID
     """
-    db = DBSCAN(eps=eps, min_samples=pts, metric='euclidean').fit(
-        pop_points, sample_weight=geo_df['Population'])
-    labels = db.labels_
+    if method == 'lattice':
+        labels = lattice_clusters(pop_points, geo_df['Population'].values,
+                                  resolution, eps, pts)
+    elif method == 'tiled':
+        labels = tiled_clusters(pop_points, geo_df['Population'].values, eps,
+                                pts, tile_size * resolution)
+    else:
+        db = DBSCAN(eps=eps, min_samples=pts, metric='euclidean').fit(
+            pop_points, sample_weight=geo_df['Population'])
+        labels = db.labels_
     n_clusters = len(set(labels)) - (1 if -1 in labels else 0)  # ignore noise
     clusters_list = pd.DataFrame(index=range(n_clusters),
                                  columns=['Cluster', 'Population',
@@ -180,60 +546,499 @@ def analysis(pop_points, geo_df, pop_load, eps, pts):
     geo_df_clustered = geo_df
     geo_df_clustered['Cluster'] = labels
 
+    population = cluster_index(geo_df_clustered)[1]['Population']
     for cluster in clusters_list.Cluster:
         clusters_list.loc[cluster, 'Population'] = \
-            round(sum(geo_df_clustered.loc[geo_df_clustered
-                                           ['Cluster'] == cluster,
-                                           'Population']))
+            round(float(population[cluster]))
         clusters_list.loc[cluster, 'Load [kW]'] = \
             round(clusters_list.loc[cluster, 'Population'] * pop_load, 2)
 
     return geo_df_clustered, clusters_list
 
 
-def plot_clusters(geo_df_clustered, clusters_list):
+def parse_clusters(value):
+    """
+    List of clusters typed by the user, separated by - (as for the ranges
+    of the configuration) or by commas.
+    :param value: text (or number) with the clusters, None, NaN or blank
+        for no clusters
+    :return clusters: list of the clusters' ID
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return []
+    text = str(value).replace(',', '-')
+    return [int(float(c)) for c in text.split('-') if c.strip() != '']
 
-    gdf_clustered_clean = geo_df_clustered[
-        geo_df_clustered['Cluster'] != -1]
 
-    fig = go.Figure()
+def merge_clusters(geo_df_clustered, clusters_list, merges):
+    """
+    Merge several pairs of clusters at once, changing only the labels kept
+    in memory. The clusters list keeps one row per cluster (indexed by
+    cluster, as given by analysis), with the population and load of the
+    merged clusters summed.
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param clusters_list: List of all Clusters' ID
+    :param merges: list of (cluster kept, cluster merged into it)
+    :return clusters_list: updated list of the clusters
+    :return changed: boolean array, True for the points whose cluster changed
+    """
+    mapping = dict((merged, kept) for kept, merged in merges
+                   if kept != merged)
+    for merged in mapping:
+        # follow chains of merges (e.g. 3 into 2 and 2 into 1)
+        kept = mapping[merged]
+        while kept in mapping:
+            kept = mapping[kept]
+        mapping[merged] = kept
+    labels = geo_df_clustered['Cluster'].values
+    new_labels = pd.Series(labels).replace(mapping).values
+    changed = new_labels != labels
+    geo_df_clustered['Cluster'] = new_labels
 
-    for cluster_n in clusters_list.Cluster:
-        plot_cluster = gdf_clustered_clean[gdf_clustered_clean
-                                           ['Cluster'] == cluster_n]
-        plot_cluster = plot_cluster.to_crs(epsg=4326)
-        plot_cluster.X = plot_cluster.geometry.x
-        plot_cluster.Y = plot_cluster.geometry.y
-        fig.add_trace(go.Scattermapbox(
-            lat=plot_cluster.Y,
-            lon=plot_cluster.X,
-            mode='markers',
-            name='Cluster ' + str(cluster_n),
-            marker=go.scattermapbox.Marker(
-                size=10,
-                color=cluster_n,
-                opacity=0.9
-            ),
-            text=plot_cluster.Cluster,
-            hoverinfo='text',
-            below="''"
-        ))
-        fig.update_layout(mapbox_style="carto-positron",
-                          mapbox_zoom=8.5)
-        fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
-                          mapbox_center={"lat": plot_cluster.Y.values[0],
-                                         "lon": plot_cluster.X.values[0]})
-
-        fig.update_layout(clickmode='event+select')
-        # fig.show()
-    plot_population = geo_df_clustered[geo_df_clustered
-                                       ['Population'] > 0]
-    plot_population = plot_population.to_crs(epsg=4326)
-    plot_population.X = plot_population.geometry.x
-    plot_population.Y = plot_population.geometry.y
+    clusters_list = clusters_list.copy()
+    clusters_list['Cluster'] = clusters_list['Cluster'].replace(mapping)
+    clusters_list = clusters_list.groupby('Cluster', sort=False,
+                                          as_index=False)\
+        .agg({'Population': 'sum', 'Load [kW]': 'sum'})
+    clusters_list.index = clusters_list['Cluster'].values
+    return clusters_list, changed
+
+
+def split_clusters(geo_df_clustered, clusters_list, clusters, eps, pts,
+                   pop_load):
+    """
+    Split clusters by running DBSCAN on the points of each one of them
+    (usually with a smaller eps or a larger pts than the whole analysis).
+    The first new cluster keeps the ID of the original one and the others
+    take new IDs; the points that DBSCAN leaves out join the nearest new
+    cluster, so that no point leaves the original cluster.
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param clusters_list: List of all Clusters' ID
+    :param clusters: list of the clusters to be split
+    :param eps: neighbourhood
+    :param pts: minimum points
+    :param pop_load: Estimated load per capita [kW/person]
+    :return clusters_list: updated list of the clusters
+    :return changed: boolean array, True for the points whose cluster changed
+    """
+    labels = geo_df_clustered['Cluster'].values.copy()
+    order, table = cluster_index(geo_df_clustered)
+    next_cluster = max(clusters_list['Cluster'].max(), labels.max()) + 1
+    clusters_list = clusters_list.copy()
+    for cluster in clusters:
+        if cluster == -1 or cluster not in table.index:
+            continue
+        rows = order[table.at[cluster, 'Start']:table.at[cluster, 'End']]
+        points = geo_df_clustered[['X', 'Y', 'Elevation']].values[rows]
+        population = geo_df_clustered['Population'].values[rows]
+        parts = DBSCAN(eps=eps, min_samples=pts, metric='euclidean').fit(
+            points, sample_weight=population).labels_
+        if parts.max() < 1:
+            print('Cluster ' + str(cluster) + ' cannot be split further')
+            continue
+        if (parts == -1).any():
+            tree = cKDTree(points[parts != -1])
+            nearest = tree.query(points[parts == -1])[1]
+            parts[parts == -1] = parts[parts != -1][nearest]
+        new_clusters = np.append(cluster, next_cluster +
+                                 np.arange(parts.max()))
+        next_cluster += parts.max()
+        labels[rows] = new_clusters[parts]
+        for part, new_cluster in enumerate(new_clusters):
+            people = round(float(population[parts == part].sum()))
+            clusters_list.loc[new_cluster, 'Cluster'] = new_cluster
+            clusters_list.loc[new_cluster, 'Population'] = people
+            clusters_list.loc[new_cluster, 'Load [kW]'] = \
+                round(people * pop_load, 2)
+        print('Cluster ' + str(cluster) + ' split in ' +
+              str(new_clusters.size))
+    clusters_list['Cluster'] = clusters_list['Cluster'].astype(int)
+    changed = labels != geo_df_clustered['Cluster'].values
+    geo_df_clustered['Cluster'] = labels
+    return clusters_list, changed
+
+
+def save_edits(geo_df_clustered, clusters_list, edits,
+               folder='Output/Clusters'):
+    """
+    Store the result of a set of edits of the clusters without writing the
+    whole geodataframe again: only the label column (labels.csv), the
+    clusters list and the edits themselves, appended to edits.csv, are
+    written. read_clustered applies the labels when the clusters are read.
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param clusters_list: List of all Clusters' ID
+    :param edits: Dataframe of the edits (Action, Cluster, Clusters)
+    :param folder: Folder of the clustering outputs
+    """
+    geo_df_clustered[['ID', 'Cluster']].to_csv(folder + '/labels.csv',
+                                               index=False)
+    clusters_list.to_csv(folder + '/clusters_list.csv', index=False)
+    file = folder + '/edits.csv'
+    edits.to_csv(file, index=False, mode='a',
+                 header=not os.path.isfile(file))
+
+
+def read_clustered(folder='Output/Clusters'):
+    """
+    Geodataframe of the clustered points, with the labels of the last edits
+    of the clusters if there are any.
+    :param folder: Folder of the clustering outputs
+    :return geo_df_clustered: Geodataframe of points with their cluster
+    """
+    geo_df_clustered = gpd.read_file(folder + '/geo_df_clustered.json')
+    if os.path.isfile(folder + '/labels.csv'):
+        labels = pd.read_csv(folder + '/labels.csv')
+        if np.array_equal(labels['ID'].values,
+                          geo_df_clustered['ID'].values):
+            geo_df_clustered['Cluster'] = labels['Cluster'].values
+        else:
+            geo_df_clustered['Cluster'] = geo_df_clustered['ID'].map(
+                labels.set_index('ID')['Cluster']).fillna(-1).astype(int)
+    return geo_df_clustered
+
+
+def clear_edits(folder='Output/Clusters'):
+    """
+    Remove the edits of the clusters, once the whole geodataframe of the
+    clustered points is written again.
+    :param folder: Folder of the clustering outputs
+    """
+    for file in ('labels.csv', 'edits.csv'):
+        if os.path.isfile(folder + '/' + file):
+            os.remove(folder + '/' + file)
+
+
+def lattice_clusters(pop_points, population, resolution, eps, pts):
+    """
+    DBSCAN for meshes on a regular lattice, with the neighbours of each
+    point found by shifting the lattice by the offsets of a disk of radius
+    eps instead of a neighbour search, so that the time grows linearly with
+    the number of points. The neighbours are checked with the 3D distance,
+    core points are joined with connected_components on the sparse graph of
+    the core points closer than eps, and each border point joins the first
+    cluster reaching it, as DBSCAN does: the labels are the same given by
+    DBSCAN with the population as sample weight.
+    :param pop_points: array containing the 3 coordinates of all points
+    :param population: population of each point
+    :param resolution: resolution of the lattice
+    :param eps: neighbourhood
+    :param pts: minimum points (minimum population of a core neighbourhood)
+    :return labels: cluster of each point, -1 for noise
+    """
+    pop_points = np.asarray(pop_points, dtype=float)
+    population = np.asarray(population, dtype=float)
+    n = len(pop_points)
+    col, row = lattice_index(pop_points[:, 0], pop_points[:, 1], resolution,
+                             pop_points[:, :2].min(axis=0))
+    grid = np.full((row.max() + 1, col.max() + 1), -1)
+    grid[row, col] = np.arange(n)
+    if (grid >= 0).sum() < n:
+        print('More points in a cell of the lattice, using DBSCAN')
+        return DBSCAN(eps=eps, min_samples=pts, metric='euclidean').fit(
+            pop_points, sample_weight=population).labels_
+
+    # one more cell of margin for the points not exactly on the lattice
+    kernel = disk(eps / resolution + 1)
+    offsets = np.argwhere(kernel) - kernel.shape[0] // 2
+
+    def neighbours(d_row, d_col):
+        """ Pairs of points (p, q) with q at the given offset from p and
+        closer than eps """
+        r, c = row + d_row, col + d_col
+        inside = np.flatnonzero((r >= 0) & (r < grid.shape[0]) &
+                                (c >= 0) & (c < grid.shape[1]))
+        q = grid[r[inside], c[inside]]
+        p, q = inside[q >= 0], q[q >= 0]
+        near = ((pop_points[p] - pop_points[q]) ** 2).sum(axis=1) <= eps ** 2
+        return p[near], q[near]
+
+    # people within eps of each point, the point included
+    people = np.zeros(n)
+    for d_row, d_col in offsets:
+        p, q = neighbours(d_row, d_col)
+        people += np.bincount(p, weights=population[q], minlength=n)
+    core = people >= pts
+    if not core.any():
+        return np.full(n, -1)
+
+    first, second, border, reached = [], [], [], []
+    for d_row, d_col in offsets:
+        p, q = neighbours(d_row, d_col)
+        joined = core[p] & core[q]
+        first.append(p[joined])
+        second.append(q[joined])
+        border.append(p[~core[p] & core[q]])
+        reached.append(q[~core[p] & core[q]])
+    first, second = np.concatenate(first), np.concatenate(second)
+    graph = coo_matrix((np.ones(first.size), (first, second)), shape=(n, n))
+    components = connected_components(graph, directed=False)[1]
+
+    # clusters numbered in order of their first core point, as DBSCAN
+    # expands them
+    cores = np.flatnonzero(core)
+    used, start = np.unique(components[cores], return_index=True)
+    numbers = np.full(components.max() + 1, -1)
+    numbers[used[np.argsort(start)]] = np.arange(used.size)
+    labels = np.full(n, -1)
+    labels[cores] = numbers[components[cores]]
+
+    # a border point joins the first cluster expanded among its cores
+    border, reached = np.concatenate(border), np.concatenate(reached)
+    nearest = np.full(n, n)
+    np.minimum.at(nearest, border, labels[reached])
+    labels[nearest < n] = nearest[nearest < n]
+    return labels
+
+
+def disk(radius):
+    """
+    Boolean disk of the cells of a lattice within radius (in cells) of the
+    central one.
+    :param radius: radius of the disk, in cells
+    :return disk: square boolean array
+    """
+    size = int(np.floor(radius))
+    offsets = np.arange(-size, size + 1)
+    return np.hypot(offsets[:, None], offsets[None, :]) <= radius
+
+
+def tiled_clusters(pop_points, population, eps, pts, tile_length,
+                   n_jobs=-1):
+    """
+    DBSCAN run tile by tile, so that only the neighbour graph of one tile
+    (with its halo) is kept in memory by each job. Each tile finds the core
+    points it owns and how they are connected to the core points of its
+    halo, then the clusters crossing the tiles are merged with a single
+    connected components pass. The labels are the same of a global run of
+    DBSCAN: clusters are numbered in order of their first core point and
+    border points join the first of the clusters they are close to.
+    :param pop_points: array containing the 3 coordinates of all points
+    :param population: population of the points
+    :param eps: neighbourhood
+    :param pts: minimum points (minimum population of a core neighbourhood)
+    :param tile_length: side of the tiles [m], at least 2*eps
+    :param n_jobs: number of tiles clustered at the same time
+    :return labels: cluster of each point, -1 for noise
+    """
+    n = len(pop_points)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(tile_clusters)(*tile, eps, pts)
+        for tile in halo_tiles(pop_points, population, eps,
+                               max(tile_length, 2 * eps)))
+    core = np.concatenate([result[0] for result in results])
+    links = np.concatenate([result[1] for result in results], axis=1)
+    borders = np.concatenate([result[2] for result in results], axis=1)
+
+    # union of the clusters of all tiles, through the shared core points
+    graph = coo_matrix((np.ones(links.shape[1]), (links[0], links[1])),
+                       shape=(n, n))
+    components = connected_components(graph, directed=False)[1]
+    core = np.sort(core)
+    labels = np.full(n, -1)
+    if core.size == 0:
+        return labels
+    first = np.unique(components[core], return_index=True)
+    numbers = np.empty(components.max() + 1, dtype=int)
+    numbers[first[0][np.argsort(first[1])]] = np.arange(first[0].size)
+    labels[core] = numbers[components[core]]
+
+    # border points join the cluster with the lowest number
+    border_labels = np.full(n, n)
+    np.minimum.at(border_labels, borders[0], labels[borders[1]])
+    touched = border_labels < n
+    labels[touched] = border_labels[touched]
+    return labels
+
+
+def halo_tiles(pop_points, population, eps, tile_length):
+    """
+    Split the points in square tiles, each one with the points within 2*eps
+    of it: the neighbourhoods of the points within eps of the tile are then
+    complete, so their core flags are exact.
+    :param pop_points: array containing the 3 coordinates of all points
+    :param population: population of the points
+    :param eps: neighbourhood
+    :param tile_length: side of the tiles [m], at least 2*eps
+    :return: for each tile, the coordinates, population and indices of its
+        points, the mask of the points it owns and the mask of the points
+        within eps of it
+    """
+    x = pop_points[:, 0] - pop_points[:, 0].min()
+    y = pop_points[:, 1] - pop_points[:, 1].min()
+    tile_x = (x // tile_length).astype(int)
+    tile_y = (y // tile_length).astype(int)
+    n_x = tile_x.max() + 1
+    index = np.arange(len(pop_points))
+
+    # with a halo not larger than the tile, a point can only be in the halo
+    # of the tiles around its own
+    members = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            gap = np.maximum(np.abs(x - (tile_x + dx + 0.5) * tile_length),
+                             np.abs(y - (tile_y + dy + 0.5) * tile_length)) \
+                - tile_length / 2
+            inside = (gap <= 2 * eps) & (tile_x + dx >= 0) & \
+                (tile_y + dy >= 0)
+            members.append(((tile_y + dy) * n_x + tile_x + dx)[inside])
+            members.append(index[inside])
+            members.append(gap[inside])
+    tiles = np.concatenate(members[0::3])
+    points = np.concatenate(members[1::3])
+    gaps = np.concatenate(members[2::3])
+    order = np.argsort(tiles, kind='stable')
+    tiles, points, gaps = tiles[order], points[order], gaps[order]
+    starts = np.flatnonzero(np.diff(tiles, prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], tiles.size)):
+        tile = points[start:end]
+        gap = gaps[start:end]
+        owned = (tile_x[tile] + tile_y[tile] * n_x) == tiles[start]
+        if owned.any():
+            yield pop_points[tile], population[tile], tile, owned, \
+                gap <= eps
+
+
+def tile_clusters(points, population, index, owned, near, eps, pts):
+    """
+    Cluster the points of a tile.
+    :param points: coordinates of the points of the tile and of its halo
+    :param population: population of the points
+    :param index: index of the points in the whole mesh
+    :param owned: boolean array, True for the points of the tile
+    :param near: boolean array, True for the points within eps of the tile
+    :param eps: neighbourhood
+    :param pts: minimum points (minimum population of a core neighbourhood)
+    :return core: index of the core points of the tile
+    :return links: pairs of core points of the same cluster, the second one
+        being the same for all the core points of the cluster in the tile
+    :return borders: pairs of border points of the tile and of core points
+        of each of the clusters close to them
+    """
+    graph = radius_neighbors_graph(points, eps, mode='connectivity',
+                                   include_self=True)
+    core = near & (graph.dot(population) >= pts)
+    core_index = np.flatnonzero(core)
+    components = connected_components(graph[core][:, core],
+                                      directed=False)[1]
+    first = np.full(components.max() + 1 if core.any() else 0, len(index))
+    np.minimum.at(first, components, core_index)
+    links = np.array([index[core_index], index[first[components]]])
+
+    border = graph[owned & ~core][:, core].tocoo()
+    pairs = np.unique(np.array([border.row, components[border.col]]),
+                      axis=1)
+    borders = np.array([index[np.flatnonzero(owned & ~core)][pairs[0]],
+                        index[first[pairs[1]]]])
+    return index[owned & core], links, borders
+
+
+def plot_clusters(geo_df_clustered, clusters_list, zoom=8.5, center=None,
+                  max_points=20000):
+    """
+    Map of the clusters and of the populated points, with one trace per
+    layer. The points are reprojected once (see map_points) and decimated
+    according to the zoom level by render_clusters.
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param clusters_list: List of all Clusters' ID
+    :param zoom: zoom level of the map
+    :param center: (lon, lat) of the centre of the map, by default the
+        centre of the clustered points
+    :param max_points: maximum number of markers of each layer
+    :return fig: map of the clusters
+    """
+    points = map_points(geo_df_clustered, clusters_list)
+    fig = render_clusters(points, zoom, center, max_points)
+    print("Cluster plot created")
+    return fig
+
+
+def map_points(geo_df_clustered, clusters_list):
+    """
+    Coordinates in EPSG:4326 of the points to be mapped, reprojected once
+    so that the map can be rendered again at each zoom without touching
+    the geodataframe.
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param clusters_list: List of all Clusters' ID
+    :return points: Dataframe with lon, lat, Cluster (-1 for the points
+        outside the listed clusters) and Population of the points either
+        clustered or populated, indexed by their position in the
+        geodataframe
+    """
+    cluster = geo_df_clustered['Cluster'].values
+    cluster = np.where(np.isin(cluster, clusters_list.Cluster), cluster, -1)
+    shown = (cluster != -1) | (geo_df_clustered['Population'].values > 0)
+    geometry = geo_df_clustered.geometry[shown].to_crs(epsg=4326)
+    return pd.DataFrame({'lon': geometry.x.values, 'lat': geometry.y.values,
+                         'Cluster': cluster[shown],
+                         'Population':
+                             geo_df_clustered['Population'].values[shown]},
+                        index=np.flatnonzero(shown))
+
+
+def update_map_points(points, geo_df_clustered, changed):
+    """
+    Update the clusters of the mapped points after an edit of the clusters,
+    only for the points whose cluster changed.
+    :param points: Dataframe of the points, as given by map_points
+    :param geo_df_clustered: Geodataframe of points with their cluster
+    :param changed: boolean array, True for the points whose cluster changed
+    :return points: updated dataframe of the points
+    """
+    rows = points.index[changed[points.index]]
+    points.loc[rows, 'Cluster'] = geo_df_clustered['Cluster'].values[rows]
+    return points
+
+
+def render_clusters(points, zoom=8.5, center=None, max_points=20000):
+    """
+    Map of the clusters and of the populated points, one colour-coded trace
+    for the clusters and one for the population. When zoomed in, only the
+    points around the visible area are drawn; when a layer still has more
+    than max_points markers, it is decimated on a grid of cells a few pixels
+    wide at the current zoom (one marker per cluster in each cell, and the
+    population summed in each cell), doubling the cells until it fits.
+    :param points: Dataframe of the points, as given by map_points
+    :param zoom: zoom level of the map
+    :param center: (lon, lat) of the centre of the map, by default the
+        centre of the clustered points
+    :param max_points: maximum number of markers of each layer
+    :return fig: map of the clusters
+    """
+    clustered = points[points['Cluster'] != -1]
+    if center is None:
+        located = clustered if not clustered.empty else points
+        center = (located['lon'].mean(), located['lat'].mean())
+    # degrees per pixel at this zoom, with tiles of 512 pixels
+    pixel = 360 / (512 * 2 ** zoom)
+    # a generous margin around a large screen, so that panning a little
+    # does not show empty areas
+    half_width = 2000 * pixel
+    visible = points[(abs(points['lon'] - center[0]) <= half_width) &
+                     (abs(points['lat'] - center[1]) <= half_width)]
+    clustered = decimate(visible[visible['Cluster'] != -1], 3 * pixel,
+                         max_points, ['Cluster'])
+    populated = decimate(visible[visible['Population'] > 0], 3 * pixel,
+                         max_points)
+    palette = np.array(px.colors.qualitative.Alphabet)
+
+    fig = go.Figure()
     fig.add_trace(go.Scattermapbox(
-        lat=plot_population.Y,
-        lon=plot_population.X,
+        lat=clustered['lat'],
+        lon=clustered['lon'],
+        mode='markers',
+        name='Clusters',
+        marker=go.scattermapbox.Marker(
+            size=10,
+            color=palette[clustered['Cluster'].values % palette.size],
+            opacity=0.9
+        ),
+        text=clustered['Cluster'],
+        hoverinfo='text',
+        below="''"
+    ))
+    fig.add_trace(go.Scattermapbox(
+        lat=populated['lat'],
+        lon=populated['lon'],
         mode='markers',
         name='Populated points',
         marker=go.scattermapbox.Marker(
@@ -241,11 +1046,36 @@ def plot_clusters(geo_df_clustered, clusters_list):
             color='black',
             opacity=0.5
         ),
-        text=plot_population.Population,
+        text=populated['Population'].round(1),
         hoverinfo='text',
         below="''"
     ))
-
-    print("Cluster plot created")
+    fig.update_layout(mapbox_style="carto-positron", mapbox_zoom=zoom,
+                      mapbox_center={"lat": center[1], "lon": center[0]},
+                      margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                      clickmode='event+select', uirevision='clusters')
     return fig
 
+
+def decimate(points, cell, max_points, by=()):
+    """
+    Reduce the points to at most max_points, grouping them in square cells
+    (doubled until few enough remain). Each group keeps the mean position
+    of its points and their total population.
+    :param points: Dataframe with lon, lat and Population of the points
+    :param cell: initial side of the cells [degrees]
+    :param max_points: maximum number of points
+    :param by: other columns the points are grouped by (e.g. Cluster)
+    :return points: Dataframe of the remaining points
+    """
+    by = list(by)
+    while len(points) > max_points:
+        keys = [np.floor(points['lon'].values / cell),
+                np.floor(points['lat'].values / cell)] + \
+            [points[column].values for column in by]
+        points = points.groupby(keys).agg(
+            dict({'lon': 'mean', 'lat': 'mean', 'Population': 'sum'},
+                 **{column: 'first' for column in by}))\
+            .reset_index(drop=True)
+        cell *= 2
+    return points
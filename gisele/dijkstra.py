@@ -23,29 +23,16 @@ def dijkstra_connection(geo_df, connecting_point, assigned_substation,
 
     df_box = create_box(pd.concat([assigned_substation, connecting_point]),
                         geo_df)
-    dist_2d_matrix = distance_2d(df_box, df_box, 'X', 'Y')
-    dist_3d_matrix = distance_3d(df_box, df_box, 'X', 'Y', 'Elevation')
 
-    if np.any(dist_2d_matrix):
-
-        edges_matrix = cost_matrix(df_box, dist_3d_matrix, line_bc)
-        length_limit = resolution * 1.5
-        edges_matrix[dist_2d_matrix > math.ceil(length_limit)] = 0
+    if df_box[['X', 'Y']].drop_duplicates().shape[0] > 1:
 
         #  reduces the weights of edges already present in the cluster grid
-        for i in c_grid_points:
-            if i[0] in edges_matrix.index.values and \
-                    i[1] in edges_matrix.index.values:
-                edges_matrix.loc[i[0], i[1]] = 0.001
-                edges_matrix.loc[i[1], i[0]] = 0.001
-        for i in branch_points:
-            if i[0] in edges_matrix.index.values and \
-                    i[1] in edges_matrix.index.values:
-                edges_matrix.loc[i[0], i[1]] = 0.001
-                edges_matrix.loc[i[1], i[0]] = 0.001
-
-        edges_matrix_sparse = sparse.csr_matrix(edges_matrix)
-        graph = nx.from_scipy_sparse_matrix(edges_matrix_sparse)
+        if branch_points is None:
+            branch_points = []
+        overlay = edge_overlay(branch_points,
+                               overlay=edge_overlay(c_grid_points))
+        edges_matrix = box_cost_matrix(df_box, line_bc, resolution, overlay)
+        graph = nx.from_scipy_sparse_matrix(edges_matrix)
         source = df_box.loc[df_box['ID'] == int(assigned_substation['ID']), :]
         source = int(source.index.values)
         target = df_box.loc[df_box['ID'] == int(connecting_point['ID']), :]
@@ -104,59 +91,27 @@ def dijkstra_connection_roads(geo_df, connecting_point, assigned_substation,
     df_box_roads.index = pd.Series(range(df_box.index.shape[0],
                                          df_box.index.shape[0] +
                                          df_box_roads.index.shape[0]))
-    n_roads = df_box_roads.shape[0]
     df_box_segments = create_box(pd.concat([assigned_substation,
                                             connecting_point]), roads_segments)
 
     df_box = df_box.append(df_box_roads)
     df_box = df_box.drop_duplicates('ID')
+    # positions in the box are the nodes of the graph
+    df_box.index = pd.Series(range(0, len(df_box.index)))
 
-    dist_2d_matrix = distance_2d(df_box, df_box, 'X', 'Y')
-    dist_3d_matrix = distance_3d(df_box, df_box, 'X', 'Y', 'Elevation')
-    if branch_points!=None:
-        for i in branch_points:
-            for j, row in df_box_segments.iterrows():
-                if i[0] == row.ID1 and i[1] == row.ID2:
-                    df_box_segments.loc[j,'length'] = 0.001
-                elif i[0] == row.ID2 and i[1] == row.ID1:
-                    df_box_segments.loc[j,'length'] = 0.001
-
-    if np.any(dist_2d_matrix):
+    if df_box[['X', 'Y']].drop_duplicates().shape[0] > 1:
 
-        costs_matrix = cost_matrix(df_box, dist_3d_matrix, line_bc)
-        edges_matrix = costs_matrix.copy()
         #  reduces the weights of edges already present in the cluster grid
-        for i in c_grid_points:
-            if i[0] in costs_matrix.index.values and \
-                    i[1] in costs_matrix.index.values:
-                # reduce to zero the cost to be filtered later, but leaving
-                # the distance to be considered by the routing algorithm
-                costs_matrix.loc[i[0], i[1]] = 0.001
-                costs_matrix.loc[i[1], i[0]] = 0.001
-                edges_matrix.loc[i[0], i[1]] = dist_3d_matrix.loc[i[0], i[1]]
-                edges_matrix.loc[i[1], i[0]] = dist_3d_matrix.loc[i[0], i[1]]
-        if branch_points != None:
-            for i in branch_points:
-                if i[0] in edges_matrix.index.values and \
-                        i[1] in edges_matrix.index.values:
-                    edges_matrix.loc[i[0], i[1]] = 0.001
-                    edges_matrix.loc[i[1], i[0]] = 0.001
-                    costs_matrix.loc[i[0], i[1]] = 0.001
-                    costs_matrix.loc[i[1], i[0]] = 0.001
-
-        length_limit = resolution * 1.5
-        edges_matrix[dist_2d_matrix > math.ceil(length_limit)] = 0
-        edges_matrix.iloc[n:n + n_roads, n:n + n_roads] = 0
-
-        edges_matrix_sparse = sparse.csr_matrix(edges_matrix)
-        graph = nx.from_scipy_sparse_matrix(edges_matrix_sparse)
-        for x in range(df_box_segments.shape[0]):
-            # re-add segment of the road to the graph, with weight=distance[km]
-            graph.add_edge(
-                df_box.index[df_box['ID'] == int(df_box_segments.loc[x, 'ID1'])][0],
-                df_box.index[df_box['ID'] == int(df_box_segments.loc[x, 'ID2'])][0],
-                weight=df_box_segments.loc[x, 'length']*line_bc)
-
+        # reduce to zero the cost to be filtered later, but leaving
+        # the distance to be considered by the routing algorithm
+        overlay = edge_overlay(c_grid_points)
+        if branch_points is not None:
+            overlay = edge_overlay(branch_points, length=0.001,
+                                   overlay=overlay)
+        costs_matrix, edges_matrix = road_box_matrices(
+            df_box, n, df_box_segments, line_bc, resolution, overlay)
+
+        graph = nx.from_scipy_sparse_matrix(edges_matrix)
         source = df_box.loc[df_box['ID'] == int(assigned_substation['ID']), :]
         source = int(source.index.values)
         target = df_box.loc[df_box['ID'] == int(connecting_point['ID']), :]
@@ -7,6 +7,8 @@ Group of supporting functions used inside all the process of GISEle algorithm
 """
 #test comment
 import os
+import math
+import hashlib
 import requests
 import pandas as pd
 import geopandas as gpd
@@ -14,13 +16,27 @@ import numpy as np
 import json
 import shapely.ops
 import iso8601
-from scipy.spatial import distance_matrix
+from scipy import sparse
+from scipy.spatial import distance_matrix, cKDTree
 from scipy.spatial.distance import cdist
 from shapely.geometry import Point, box, LineString, MultiPoint
 from shapely.ops import split
 from gisele.michele.michele import start
 from gisele.data_import import import_pv_data, import_wind_data
 
+ROUTING_GRAPH = 'Output/Datasets/Roads/routing_graph.npz'
+# coarser levels of the mesh stored by mesh_pyramid, the mesh being level 1
+PYRAMID = 'Output/Datasets/Pyramid'
+PYRAMID_FACTORS = (3, 9)
+# routing graph used by the routers, the last one built or loaded
+routing_graphs = {}
+# spatial indexes of the dataframes boxed by create_box, hashed by the
+# content of their index and of their bounds, least recently used first,
+# each with the positions of its last boxes
+spatial_indexes = {}
+SPATIAL_INDEXES = 8
+BOX_CACHE_SIZE = 64
+
 
 def l():
     """Print long separating lines."""
@@ -117,6 +133,332 @@ def cost_matrix(gdf, dist_3d_matrix, line_bc):
     return value
 
 
+def sparse_cost_matrix(gdf, line_bc, length_limit, overlay=None):
+    """
+    Sparse version of the cost matrix, with only the pairs of points closer
+    (in 2D) than length_limit, found with a KD-tree: the distances and the
+    costs are computed only for them, so the memory grows with the number
+    of points instead of its square.
+    :param gdf: Geodataframe being analyzed
+    :param line_bc: line base cost for line deployment [€/km]
+    :param length_limit: maximum 2D length of an edge [meters]
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return value: Cost matrix [€] (csr), rows and columns in the order of
+        the points of gdf
+    """
+    n = gdf['X'].size
+    xy = gdf[['X', 'Y']].values.astype(float)
+    pairs = cKDTree(xy).query_pairs(length_limit, output_type='ndarray')
+    first, second = pairs[:, 0], pairs[:, 1]
+    xyz = gdf[['X', 'Y', 'Elevation']].values.astype(float)
+    weight = gdf['Weight'].values.astype(float)
+    dist_3d = np.sqrt(((xyz[first] - xyz[second]) ** 2).sum(axis=1))
+    cost = dist_3d * (weight[first] + weight[second]) / 2 * line_bc / 1000
+
+    value = sparse.coo_matrix((np.append(cost, cost),
+                               (np.append(first, second),
+                                np.append(second, first))),
+                              shape=(n, n)).tocsr()
+    # as in the dense matrix, zero costs are not edges
+    value.eliminate_zeros()
+    return set_edges(value, gdf, overlay)
+
+
+def routing_graph(geo_df, resolution, gdf_roads=None, roads_segments=None,
+                  file=ROUTING_GRAPH):
+    """
+    Graph of the whole study area shared by all the routers, built once
+    (after the roads are created) instead of computing the distance and
+    cost matrices of each box. Its nodes are the points of the mesh
+    followed by the vertices of the roads; points closer than 1.5 times the
+    resolution are connected, except pairs of road vertices, which are
+    connected only by the road segments. Each router takes the subgraph of
+    its box with box_graph.
+    :param geo_df: Geodataframe of the weighted mesh
+    :param resolution: Resolution of the mesh [m]
+    :param gdf_roads: Point geodataframe of the road vertices
+    :param roads_segments: Geodataframe of the road segments (ID1, ID2 and
+        length [km])
+    :param file: npz file where the graph is stored (it then becomes the one
+        used by box_graph), None for a graph used only by the caller
+    :return graph: dictionary with the ID of the nodes, the number of mesh
+        nodes and two csr matrices with the same edges: weighted, the cost
+        of each edge per unit of line base cost (3D distance [km] times the
+        average weight), and distance, its 3D length [m]
+    """
+    nodes = geo_df[['ID', 'X', 'Y', 'Elevation', 'Weight']]
+    n_mesh = nodes.shape[0]
+    if gdf_roads is not None:
+        nodes = pd.concat([nodes, gdf_roads[['ID', 'X', 'Y', 'Elevation',
+                                             'Weight']]])
+    nodes = nodes.drop_duplicates('ID')
+    n = nodes.shape[0]
+    xyz = nodes[['X', 'Y', 'Elevation']].values.astype(float)
+    weight = nodes['Weight'].values.astype(float)
+
+    pairs = cKDTree(xyz[:, :2]).query_pairs(math.ceil(resolution * 1.5),
+                                            output_type='ndarray')
+    first, second = pairs[:, 0], pairs[:, 1]
+    mesh_pair = (first < n_mesh) | (second < n_mesh)
+    first, second = first[mesh_pair], second[mesh_pair]
+    distance = np.sqrt(((xyz[first] - xyz[second]) ** 2).sum(axis=1))
+    weighted = distance * (weight[first] + weight[second]) / 2 / 1000
+
+    if roads_segments is not None and not roads_segments.empty:
+        position = pd.Index(nodes['ID'].values)
+        segment_first = position.get_indexer(
+            roads_segments['ID1'].values.astype(int))
+        segment_second = position.get_indexer(
+            roads_segments['ID2'].values.astype(int))
+        found = (segment_first >= 0) & (segment_second >= 0)
+        length = roads_segments['length'].values.astype(float)[found]
+        first = np.append(first, segment_first[found])
+        second = np.append(second, segment_second[found])
+        distance = np.append(distance, length * 1000)
+        weighted = np.append(weighted, length)
+
+    # zero costs are not edges, as in the dense cost matrices, and repeated
+    # segments are kept once
+    keys = np.minimum(first, second) * n + np.maximum(first, second)
+    edge = np.zeros(keys.size, dtype=bool)
+    edge[np.unique(keys, return_index=True)[1]] = True
+    edge &= weighted > 0
+    rows = np.append(first[edge], second[edge])
+    cols = np.append(second[edge], first[edge])
+    graph = {'ids': nodes['ID'].values.astype(int),
+             'xy': xyz[:, :2], 'n_mesh': n_mesh}
+    for name, values in (('weighted', weighted), ('distance', distance)):
+        matrix = sparse.coo_matrix((np.tile(values[edge], 2), (rows, cols)),
+                                   shape=(n, n)).tocsr()
+        graph[name] = matrix
+
+    if file is not None:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        np.savez(file, ids=graph['ids'], xy=graph['xy'], n_mesh=n_mesh,
+                 indptr=graph['weighted'].indptr,
+                 indices=graph['weighted'].indices,
+                 weighted=graph['weighted'].data,
+                 distance=graph['distance'].data)
+        print('Routing graph with ' + str(graph['weighted'].nnz // 2) +
+              ' edges stored')
+        routing_graphs['current'] = graph
+    return graph
+
+
+def load_routing_graph(file=ROUTING_GRAPH):
+    """
+    Load the stored routing graph, making it the one used by box_graph.
+    :param file: npz file where the graph is stored
+    :return graph: dictionary of the graph, as given by routing_graph, None
+        if the file is missing
+    """
+    if not os.path.isfile(file):
+        return None
+    data = np.load(file)
+    n = data['ids'].size
+    graph = {'ids': data['ids'], 'xy': data['xy'],
+             'n_mesh': int(data['n_mesh'])}
+    for name in ('weighted', 'distance'):
+        graph[name] = sparse.csr_matrix(
+            (data[name], data['indices'], data['indptr']), shape=(n, n))
+    routing_graphs['current'] = graph
+    return graph
+
+
+def box_graph(df_box, graph=None):
+    """
+    Subgraph of the routing graph with the points of a box, taken by
+    slicing the rows and columns of the points.
+    :param df_box: Points of the box (with ID, X and Y)
+    :param graph: routing graph, by default the last one built or loaded
+    :return: weighted and distance csr matrices in the order of df_box,
+        and boolean array, True for the road vertices; None if the graph
+        does not contain all the points of the box (e.g. it belongs to
+        another study area)
+    """
+    if graph is None:
+        graph = routing_graphs.get('current')
+    if graph is None:
+        return None
+    positions = pd.Index(graph['ids']).get_indexer(
+        df_box['ID'].values.astype(int))
+    if (positions < 0).any() or not np.allclose(
+            graph['xy'][positions], df_box[['X', 'Y']].values.astype(float),
+            atol=1e-3):
+        return None
+    return graph['weighted'][positions][:, positions], \
+        graph['distance'][positions][:, positions], \
+        positions >= graph['n_mesh']
+
+
+def edge_overlay(pairs, cost=0.001, length=np.nan, overlay=None):
+    """
+    Overlay of edge overrides: a dictionary hashed by pair of IDs (the
+    smaller first) with the replacement cost and length of the edge, so
+    that the segments of the existing grid and of the branches are stored
+    once and applied to any matrix with set_edges or overlay_entries.
+    :param pairs: pairs of IDs of points already connected
+    :param cost: replacement cost of their edges [€]
+    :param length: replacement length used by the routing, nan to keep the
+        real length of the edges
+    :param overlay: overlay to be extended, pairs already in it are replaced
+    :return overlay: dictionary {(ID1, ID2): (cost, length)}
+    """
+    if overlay is None:
+        overlay = {}
+    for pair in pairs:
+        # lists of pairs nested among the pairs are not pairs of points
+        if np.ndim(pair) != 1:
+            continue
+        first, second = sorted((int(pair[0]), int(pair[1])))
+        overlay[(first, second)] = (cost, length)
+    return overlay
+
+
+def overlay_positions(df, overlay):
+    """
+    Positions in df of the pairs of an overlay.
+    :param df: Points (with ID)
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return first, second: positions of the pairs found in df
+    :return values: replacement cost and length of each pair
+    """
+    ids = np.array(list(overlay.keys()), dtype=int).reshape(-1, 2)
+    values = np.array(list(overlay.values()), dtype=float).reshape(-1, 2)
+    position = pd.Index(df['ID'].values.astype(int))
+    first = position.get_indexer(ids[:, 0])
+    second = position.get_indexer(ids[:, 1])
+    found = (first >= 0) & (second >= 0)
+    return first[found], second[found], values[found]
+
+
+def overlay_entries(matrix, df, overlay):
+    """
+    Find the entries of a csr matrix overridden by an overlay, with a
+    single lookup of all the entries in the sorted keys of the overlay.
+    :param matrix: csr matrix, rows and columns in the order of df
+    :param df: Points of the matrix (with ID)
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return mask: boolean array over matrix.data, True for the overridden
+        entries (in both directions)
+    :return cost: replacement cost of the masked entries
+    :return length: replacement length of the masked entries (nan to keep)
+    :return missing: positions and cost of the pairs with no entry
+    """
+    n = matrix.shape[0]
+    first, second, values = overlay_positions(df, overlay)
+    keys = np.repeat(np.arange(n), np.diff(matrix.indptr)) * n + \
+        matrix.indices
+    pair_keys = np.append(first * n + second, second * n + first)
+    if pair_keys.size == 0:
+        return np.zeros(keys.size, dtype=bool), np.array([]), \
+            np.array([]), (first, second, values[:, 0])
+    order = np.argsort(pair_keys)
+    pair_keys = pair_keys[order]
+    pair_values = np.tile(values, (2, 1))[order]
+    where = np.searchsorted(pair_keys, keys).clip(max=pair_keys.size - 1)
+    mask = pair_keys[where] == keys
+    cost, length = pair_values[where[mask]].T
+    present = np.isin(first * n + second, keys)
+    return mask, cost, length, \
+        (first[~present], second[~present], values[~present, 0])
+
+
+def set_edges(matrix, df, overlay):
+    """
+    Set the cost of the edges of an overlay, adding the edges that are
+    missing. The entries of a csr matrix are changed in place: the routers
+    pass the matrix of their box, never the routing graph.
+    :param matrix: csr matrix, rows and columns in the order of df, or
+        dense cost matrix (dataframe) in the same order
+    :param df: Points of the matrix (with ID)
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return matrix: updated matrix
+    """
+    if not overlay:
+        return matrix
+    if not sparse.issparse(matrix):
+        first, second, values = overlay_positions(df, overlay)
+        costs = matrix.to_numpy(dtype=float, copy=True)
+        costs[first, second] = values[:, 0]
+        costs[second, first] = values[:, 0]
+        return pd.DataFrame(costs, index=matrix.index,
+                            columns=matrix.columns)
+    mask, cost, length, missing = overlay_entries(matrix, df, overlay)
+    matrix.data[mask] = cost
+    first, second, cost = missing
+    if first.size:
+        matrix = matrix + sparse.coo_matrix(
+            (np.append(cost, cost),
+             (np.append(first, second), np.append(second, first))),
+            shape=matrix.shape).tocsr()
+    return matrix
+
+
+def box_cost_matrix(df_box, line_bc, resolution, overlay=None):
+    """
+    Cost matrix of a box, sliced from the routing graph when it contains
+    the box and built with sparse_cost_matrix otherwise.
+    :param df_box: Points of the box
+    :param line_bc: line base cost for line deployment [€/km]
+    :param resolution: Resolution of the mesh [m]
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return value: Cost matrix [€] (csr), in the order of df_box
+    """
+    sub_graph = box_graph(df_box)
+    if sub_graph is None:
+        return sparse_cost_matrix(df_box, line_bc,
+                                  math.ceil(resolution * 1.5), overlay)
+    return set_edges(sub_graph[0] * line_bc, df_box, overlay)
+
+
+def road_box_matrices(df_box, n_mesh, df_box_segments, line_bc, resolution,
+                      overlay=None):
+    """
+    Cost and routing matrices of a box of mesh points followed by road
+    vertices, sliced from the routing graph when it contains the box and
+    built for the box alone otherwise.
+    :param df_box: Points of the box, indexed by position, with the mesh
+        points first
+    :param n_mesh: Number of mesh points of the box
+    :param df_box_segments: Road segments of the box (ID1, ID2 and length)
+    :param line_bc: line base cost for line deployment [€/km]
+    :param resolution: Resolution of the mesh [m]
+    :param overlay: overlay of edge overrides, as given by edge_overlay
+    :return costs: Cost matrix [€] (csr), in the order of df_box
+    :return edges: Weights used by the routing (csr), with the same entries:
+        the cost of the edges, the replacement length of the overridden
+        ones (their real length if it is nan) and, for the road segments,
+        their length [km] times the line base cost
+    """
+    sub_graph = box_graph(df_box)
+    if sub_graph is None:
+        sub_graph = box_graph(df_box, routing_graph(
+            df_box.iloc[:n_mesh], resolution, df_box.iloc[n_mesh:],
+            df_box_segments, file=None))
+    weighted, distance, road = sub_graph
+    costs = weighted * line_bc
+    edges = costs.copy()
+    if overlay:
+        mask, cost, length, missing = overlay_entries(costs, df_box, overlay)
+        # the cost is replaced, the routing keeps the length of the edge
+        # unless the overlay replaces it as well
+        costs.data[mask] = cost
+        edges.data[mask] = np.where(np.isnan(length), distance.data[mask],
+                                    length)
+    else:
+        mask, length = np.zeros(costs.nnz, dtype=bool), np.array([])
+    # edges between road vertices are the road segments, with
+    # weight=distance[km] (or the replacement length)
+    rows = np.repeat(np.arange(costs.shape[0]), np.diff(costs.indptr))
+    segments = road[rows] & road[costs.indices]
+    segment_length = weighted.data.copy()
+    segment_length[mask] = np.where(np.isnan(length),
+                                    segment_length[mask], length)
+    edges.data[segments] = segment_length[segments] * line_bc
+    return costs, edges
+
+
 def line_to_points(line, df):
     """
     Finds all the points of a linestring geodataframe correspondent to a
@@ -190,6 +532,53 @@ def create_roads(gdf_roads, geo_df):
     return line_gdf, segments
 
 
+def spatial_index(df):
+    """
+    Spatial index of a geodataframe: the bounds of its geometries sorted by
+    minimum X. It is built at the first box of the dataframe and kept for
+    the following ones, as long as the dataframe keeps the same index and
+    the same bounds; the dataframe itself is not kept.
+    :param df: Geodataframe to be indexed
+    :return index: dictionary with the sorted bounds, the positions of the
+        geometries in df in the same order and the cache of the boxes
+    """
+    bounds = df.geometry.bounds.values.astype(float)
+    key = hashlib.sha1(np.ascontiguousarray(bounds).tobytes())
+    key.update(pd.util.hash_pandas_object(df.index, index=False).values
+               .tobytes())
+    key = key.hexdigest()
+    entry = spatial_indexes.pop(key, None)
+    if entry is None:
+        order = np.argsort(bounds[:, 0], kind='stable')
+        entry = {'order': order, 'bounds': bounds[order], 'boxes': {}}
+    spatial_indexes[key] = entry
+    while len(spatial_indexes) > SPATIAL_INDEXES:
+        del spatial_indexes[next(iter(spatial_indexes))]
+    return entry
+
+
+def box_positions(index, df, bubble):
+    """
+    Positions of the geometries of df within a box, found with a binary
+    search of the box in the sorted X of the index and checked exactly only
+    for the geometries whose bounds are inside it.
+    :param index: Spatial index of df, as given by spatial_index
+    :param df: Geodataframe being analyzed
+    :param bubble: Polygon of the box
+    :return positions: Sorted positions of the geometries within the box
+    """
+    x_min, y_min, x_max, y_max = bubble.bounds
+    bounds = index['bounds']
+    start = np.searchsorted(bounds[:, 0], x_min, side='left')
+    stop = np.searchsorted(bounds[:, 0], x_max, side='right')
+    candidates = bounds[start:stop]
+    inside = (candidates[:, 1] >= y_min) & (candidates[:, 2] <= x_max) & \
+        (candidates[:, 3] <= y_max)
+    positions = np.sort(index['order'][start:stop][inside])
+    # geometries on the border of the box are not within it
+    return positions[df.geometry.iloc[positions].within(bubble).values]
+
+
 def create_box(limits, df):
     """
     Creates a delimiting box around a geodataframe.
@@ -212,7 +601,15 @@ def create_box(limits, df):
 
     bubble = box(minx=x_min - extension, maxx=x_max + extension,
                  miny=y_min - extension, maxy=y_max + extension)
-    df_box = df[df.within(bubble)]
+    index = spatial_index(df)
+    # repeated boxes (same cluster or line) are taken from the cache
+    positions = index['boxes'].pop(bubble.bounds, None)
+    if positions is None:
+        positions = box_positions(index, df, bubble)
+    index['boxes'][bubble.bounds] = positions
+    while len(index['boxes']) > BOX_CACHE_SIZE:
+        del index['boxes'][next(iter(index['boxes']))]
+    df_box = df.iloc[positions]
     df_box.index = pd.Series(range(0, len(df_box.index)))
 
     return df_box
@@ -225,6 +622,7 @@ def edges_to_line(path, df, edges_matrix):
     :param path: NetworkX graph edges sequence
     :param df: Point geodataframe to be used as reference
     :param edges_matrix: Matrix containing the cost to connect a pair of points
+        (dataframe indexed by ID, or sparse matrix in the order of df)
     :return line: Linestring geodataframe containing point IDs and its cost
     :return line_points: All points of df that are part of the linestring
     """
@@ -243,14 +641,253 @@ def edges_to_line(path, df, edges_matrix):
         # int here is necessary to use the command .to_file
         line.at[h, 'ID1'] = int(df.loc[path[h][0], 'ID'])
         line.at[h, 'ID2'] = int(df.loc[path[h][1], 'ID'])
-        line.at[h, 'Cost'] = int(edges_matrix.loc[df.loc[path[h][0], 'ID'],
-                                                  df.loc[path[h][1], 'ID']])
+        if sparse.issparse(edges_matrix):
+            line.at[h, 'Cost'] = int(edges_matrix[
+                df.index.get_loc(path[h][0]), df.index.get_loc(path[h][1])])
+        else:
+            line.at[h, 'Cost'] = int(
+                edges_matrix.loc[df.loc[path[h][0], 'ID'],
+                                 df.loc[path[h][1], 'ID']])
         line_points.append(list(df.loc[path[h], 'ID']))
     line.drop(line[line['Cost'] == 0].index, inplace=True)
     line.Cost = line.Cost.astype(int)
     return line, line_points
 
 
+def lattice_index(x, y, resolution, origin):
+    """
+    Position of the points in the regular lattice of the mesh.
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param resolution: Resolution of the mesh [m]
+    :param origin: (x, y) of the first point of the lattice
+    :return i, j: Integer arrays with the column and the row of each point
+    """
+    i = np.rint((np.asarray(x, dtype=float) - origin[0]) / resolution)
+    j = np.rint((np.asarray(y, dtype=float) - origin[1]) / resolution)
+    return i.astype(int), j.astype(int)
+
+
+def mesh_blocks(geo_df, resolution, factor, origin):
+    """
+    Block of each point of the mesh, in the lattice of square blocks of
+    factor x factor points of the mesh.
+    :param geo_df: Geodataframe of the mesh
+    :param resolution: Resolution of the mesh [m]
+    :param factor: Number of points of the lattice on each side of a block
+    :param origin: (x, y) of the first point of the lattice
+    :return df: Dataframe with the ID, the block (Block_x, Block_y), the
+        centre of the block (X, Y) and the distance from it (Dist) of each
+        point
+    """
+    i, j = lattice_index(geo_df['X'], geo_df['Y'], resolution, origin)
+    df = pd.DataFrame({'ID': geo_df['ID'].values,
+                       'Block_x': i // factor, 'Block_y': j // factor})
+    df['X'] = origin[0] + (df['Block_x'] * factor + (factor - 1) / 2) \
+        * resolution
+    df['Y'] = origin[1] + (df['Block_y'] * factor + (factor - 1) / 2) \
+        * resolution
+    df['Dist'] = np.hypot(geo_df['X'].values - df['X'],
+                          geo_df['Y'].values - df['Y'])
+    return df
+
+
+def block_representatives(gdf_lr, df, cluster=None):
+    """
+    Cluster and ID of the blocks of a coarser mesh: each block takes the
+    most frequent cluster of its points (-1 if they are all noise) and the
+    ID of its point, of that cluster, nearest to the centre of the block.
+    :param gdf_lr: Dataframe of the blocks, indexed by Block_x and Block_y
+    :param df: Blocks of the points, as given by mesh_blocks
+    :param cluster: Array with the cluster of each point, or None if the
+        mesh is not clustered
+    :return gdf_lr: The dataframe of the blocks with their Cluster (only
+        if the mesh is clustered) and ID
+    """
+    blocks = ['Block_x', 'Block_y']
+    if cluster is not None:
+        df = df.assign(Cluster=cluster)
+        counts = df[df['Cluster'] != -1].groupby(blocks + ['Cluster'])\
+            .size().reset_index(name='Count')\
+            .sort_values(['Count', 'Cluster'], ascending=[False, True])\
+            .drop_duplicates(blocks).set_index(blocks)
+        gdf_lr['Cluster'] = counts['Cluster']
+        gdf_lr['Cluster'] = gdf_lr['Cluster'].fillna(-1).astype(int)
+        df = df.join(gdf_lr['Cluster'].rename('Block_cluster'), on=blocks)
+        df = df[(df['Block_cluster'] == -1) |
+                (df['Cluster'] == df['Block_cluster'])]
+    # stable sort, so that ties are broken by the order of the mesh
+    representative = df.sort_values('Dist', kind='mergesort')\
+        .drop_duplicates(blocks).set_index(blocks)
+    gdf_lr['ID'] = representative['ID']
+    return gdf_lr
+
+
+def aggregate_mesh(geo_df, resolution, factor, origin=None):
+    """
+    Coarser version of the mesh, made of square blocks of factor x factor
+    points of the lattice. Population is summed, elevation and weight are
+    averaged and each block takes the most frequent cluster of its points
+    (-1 if they are all noise). The ID of a block is the one of its point,
+    of that cluster, nearest to the centre of the block.
+    :param geo_df: Geodataframe of the mesh (possibly with clusters)
+    :param resolution: Resolution of the mesh [m]
+    :param factor: Number of points of the lattice on each side of a block
+    :param origin: (x, y) of the first point of the lattice, by default the
+        minimum coordinates of the mesh
+    :return gdf_lr: Geodataframe with a point in the centre of each block
+        containing at least a point of the mesh
+    """
+    if origin is None:
+        origin = (geo_df['X'].min(), geo_df['Y'].min())
+    df = mesh_blocks(geo_df, resolution, factor, origin)
+    for column in ['Population', 'Elevation', 'Weight']:
+        df[column] = geo_df[column].values
+    gdf_lr = df.groupby(['Block_x', 'Block_y']).agg(
+        X=('X', 'first'), Y=('Y', 'first'),
+        Population=('Population', 'sum'), Elevation=('Elevation', 'mean'),
+        Weight=('Weight', 'mean'))
+    cluster = geo_df['Cluster'].values if 'Cluster' in geo_df.columns \
+        else None
+    gdf_lr = block_representatives(gdf_lr, df, cluster)
+    gdf_lr.reset_index(drop=True, inplace=True)
+
+    return gpd.GeoDataFrame(gdf_lr, geometry=gpd.points_from_xy(gdf_lr.X,
+                                                                 gdf_lr.Y),
+                            crs=geo_df.crs)
+
+
+def mesh_pyramid(geo_df, resolution, factors=PYRAMID_FACTORS,
+                 folder=PYRAMID):
+    """
+    Build and store in one go the coarser levels of the weighted mesh, all
+    of them on the lattice of the mesh, so that the later stages read a
+    level with mesh_level instead of aggregating the mesh again.
+    :param geo_df: Geodataframe of the weighted mesh
+    :param resolution: Resolution of the mesh [m]
+    :param factors: Number of points of the lattice on each side of the
+        blocks of each level
+    :param folder: Folder where the levels are stored
+    :return levels: Dictionary with the geodataframe of each level
+    """
+    os.makedirs(folder, exist_ok=True)
+    origin = (geo_df['X'].min(), geo_df['Y'].min())
+    levels = {}
+    for factor in factors:
+        levels[factor] = aggregate_mesh(geo_df, resolution, factor, origin)
+        pd.DataFrame(levels[factor].drop(columns='geometry'))\
+            .to_csv(folder + '/level_' + str(factor) + '.csv', index=False)
+    return levels
+
+
+def mesh_level(factor, geo_df, resolution, geo_df_clustered=None,
+               folder=PYRAMID):
+    """
+    Level of the mesh pyramid nearest to the given factor: the mesh itself
+    or one of the levels stored by mesh_pyramid (built and stored if
+    missing). Population, elevation and weight of the blocks are read from
+    the stored level; with a clustered mesh, the blocks take the cluster
+    and the representative point of their points, as in aggregate_mesh.
+    :param factor: Wanted number of points of the lattice on each side of
+        a block
+    :param geo_df: Geodataframe of the weighted mesh
+    :param resolution: Resolution of the mesh [m]
+    :param geo_df_clustered: Geodataframe of the same mesh with the
+        clusters, or None
+    :param folder: Folder where the levels are stored
+    :return gdf_lr: Geodataframe of the level, as given by aggregate_mesh
+    """
+    factor = min((1,) + PYRAMID_FACTORS,
+                 key=lambda level: (abs(level - factor), level))
+    mesh = geo_df if geo_df_clustered is None else geo_df_clustered
+    columns = ['X', 'Y', 'Population', 'Elevation', 'Weight']
+    if factor == 1:
+        if geo_df_clustered is not None:
+            columns.append('Cluster')
+        gdf_lr = mesh[columns + ['ID']].reset_index(drop=True)
+        return gpd.GeoDataFrame(gdf_lr, geometry=gpd.points_from_xy(
+            gdf_lr.X, gdf_lr.Y), crs=mesh.crs)
+
+    file = folder + '/level_' + str(factor) + '.csv'
+    if os.path.isfile(file):
+        gdf_lr = pd.read_csv(file)
+    else:
+        gdf_lr = pd.DataFrame(mesh_pyramid(geo_df, resolution, (factor,),
+                                           folder)[factor])
+    gdf_lr = gdf_lr[columns + ['ID']]
+    if geo_df_clustered is not None:
+        origin = (geo_df['X'].min(), geo_df['Y'].min())
+        # the block of a level is found from its centre
+        gdf_lr.index = pd.MultiIndex.from_arrays(lattice_index(
+            gdf_lr['X'], gdf_lr['Y'], resolution * factor,
+            (origin[0] + (factor - 1) / 2 * resolution,
+             origin[1] + (factor - 1) / 2 * resolution)),
+            names=['Block_x', 'Block_y'])
+        df = mesh_blocks(geo_df_clustered, resolution, factor, origin)
+        gdf_lr = block_representatives(gdf_lr[columns].copy(), df,
+                                       geo_df_clustered['Cluster'].values)
+        gdf_lr.reset_index(drop=True, inplace=True)
+
+    return gpd.GeoDataFrame(gdf_lr, geometry=gpd.points_from_xy(gdf_lr.X,
+                                                                 gdf_lr.Y),
+                            crs=mesh.crs)
+
+
+def cluster_index(geo_df_clustered):
+    """
+    Index of the points of each cluster, computed once so that the points
+    of a cluster can be taken with cluster_points without scanning the
+    whole mesh. The rows are sorted by cluster (keeping their order inside
+    each cluster) and the table gives where each cluster starts and ends.
+    :param geo_df_clustered: Geodataframe of the points with their Cluster
+    :return order: Positions of the rows, sorted by cluster
+    :return table: Dataframe indexed by cluster, with the Start and End of
+        its rows in order, its Size, Population, bounding box (Min_x,
+        Min_y, Max_x, Max_y) and representative point (X, Y, the centroid
+        of the population, or of the points if it has no population)
+    """
+    labels = geo_df_clustered['Cluster'].values
+    order = np.argsort(labels, kind='stable')
+    clusters, start, size = np.unique(labels[order], return_index=True,
+                                      return_counts=True)
+    x = geo_df_clustered['X'].values[order].astype(float)
+    y = geo_df_clustered['Y'].values[order].astype(float)
+    population = geo_df_clustered['Population'].values[order].astype(float)
+    table = pd.DataFrame({'Start': start, 'End': start + size, 'Size': size},
+                         index=pd.Index(clusters, name='Cluster'))
+    if clusters.size == 0:
+        return order, table
+    table['Population'] = np.add.reduceat(population, start)
+    table['Min_x'] = np.minimum.reduceat(x, start)
+    table['Min_y'] = np.minimum.reduceat(y, start)
+    table['Max_x'] = np.maximum.reduceat(x, start)
+    table['Max_y'] = np.maximum.reduceat(y, start)
+    people = table['Population'].values
+    weight = np.where(people[np.repeat(np.arange(clusters.size), size)] > 0,
+                      population, 1)
+    total = np.add.reduceat(weight, start)
+    table['X'] = np.add.reduceat(x * weight, start) / total
+    table['Y'] = np.add.reduceat(y * weight, start) / total
+    return order, table
+
+
+def cluster_points(geo_df_clustered, clusters, cluster_n):
+    """
+    Points of a cluster, in the same order they have in the geodataframe.
+    :param geo_df_clustered: Geodataframe of the points with their Cluster
+    :param clusters: (order, table) of the geodataframe, as given by
+        cluster_index
+    :param cluster_n: Cluster whose points are needed
+    :return gdf_cluster: Geodataframe with the points of the cluster
+    """
+    order, table = clusters
+    if cluster_n not in table.index:
+        return geo_df_clustered.iloc[[]]
+    start = table.at[cluster_n, 'Start']
+    end = table.at[cluster_n, 'End']
+    return geo_df_clustered.iloc[order[start:end]]
+
+
 def load(clusters_list, grid_lifetime, input_profile):
     """
     Reads the input daily load profile from the input csv. Reads the number of
@@ -366,6 +1003,7 @@ def sizing(load_profile, clusters_list, geo_df_clustered, wt, years,rivers,hydro
              & (rivers['annual_disch'] < input_michele['max_flow_rate']), :]
 
 
+    clusters = cluster_index(geo_df_clustered)
     for cluster_n in clusters_list['Cluster'].astype(int):
         l()
         print('Creating the optimal Microgrid for Cluster ' + str(cluster_n))
@@ -457,7 +1095,7 @@ def sizing(load_profile, clusters_list, geo_df_clustered, wt, years,rivers,hydro
                 grid = Branches.append(Collaterals)
                 buffer = grid.geometry.buffer(max_dist_ht).unary_union
             else:
-                buffer = geo_df_clustered[geo_df_clustered['Cluster']==cluster_n].buffer(max_dist_ht).unary_union
+                buffer = cluster_points(geo_df_clustered, clusters, cluster_n).buffer(max_dist_ht).unary_union
                 grid = gpd.GeoDataFrame()
 
             rivers_inters = rivers_filtered[rivers_filtered.intersects(buffer)]
@@ -474,7 +1112,7 @@ def sizing(load_profile, clusters_list, geo_df_clustered, wt, years,rivers,hydro
             if not grid.empty:
                 grid_cluster = line_to_points(grid, geo_df_clustered)
             else: #this is a questionable fix in the case that the cluster has only one node - there could be errors
-                grid_cluster = geo_df_clustered[geo_df_clustered['Cluster']==cluster_n]
+                grid_cluster = cluster_points(geo_df_clustered, clusters, cluster_n)
 
 
             dist = []
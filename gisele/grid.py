@@ -1,9 +1,26 @@
+import logging
 from gisele.functions import *
 from gisele import Steinerman, Spiderman, dijkstra
 
+logger = logging.getLogger(__name__)
+
+# rough costs of the routing algorithms, used by routing_plan and overridden
+# by the routing_* rows of the configuration. They were measured with
+# tracemalloc (peak memory) and the wall time of steiner_tree on lattice
+# graphs of 225 to 1225 nodes with 4 neighbours and 20 terminal nodes, and of
+# the complete graph and minimum spanning tree of Spider on 200 to 800
+# terminal nodes, on a 4-core desktop computer; the values were rounded up.
+# steiner_pair_bytes: memory of each pair of nodes of the metric closure [B]
+# spider_pair_bytes: memory of each pair of terminal nodes of Spider [B]
+# steiner_step_time: time of each step of the all-pairs Dijkstra [s]
+# spider_pair_time: time of each pair of terminal nodes of Spider [s]
+routing_costs = {'steiner_pair_bytes': 250, 'spider_pair_bytes': 250,
+                 'steiner_step_time': 2.5e-7, 'spider_pair_time': 5e-6}
+
 
 def routing(geo_df_clustered, geo_df, clusters_list, resolution,
-            pop_thresh, line_bc,full_ele):
+            pop_thresh, line_bc,full_ele, memory_budget=4000,
+            time_budget=600):
     s()
     print("3. Grid Creation")
     s()
@@ -31,12 +48,14 @@ def routing(geo_df_clustered, geo_df, clusters_list, resolution,
     print('create points along roads')
     # todo -> insert a check: if there are not terminal nodes, it is not useful
     gdf_roads, roads_segments = create_roads(roads, geo_df)
+    # one graph of mesh and roads, sliced by all the routers
+    routing_graph(geo_df, resolution, gdf_roads, roads_segments)
     os.chdir(r'Output//Grids')
 
+    clusters = cluster_index(geo_df_clustered)
     for cluster_n in clusters_list.Cluster:
 
-        gdf_cluster = geo_df_clustered[
-            geo_df_clustered['Cluster'] == cluster_n]
+        gdf_cluster = cluster_points(geo_df_clustered, clusters, cluster_n)
         gdf_cluster_pop = gdf_cluster[
             gdf_cluster['Population'] >= pop_thresh]
 
@@ -52,7 +71,7 @@ def routing(geo_df_clustered, geo_df, clusters_list, resolution,
             c_grid, c_grid_cost, c_grid_length, c_grid_points = \
                 cluster_grid(geo_df, gdf_cluster_pop, resolution,
                              line_bc, n_terminal_nodes, gdf_cluster, gdf_roads,
-                             roads_segments)
+                             roads_segments, memory_budget, time_budget)
 
 
             # print('Assigning to the nearest 5 substations.. ')
@@ -158,49 +177,83 @@ def substation_assignment(cluster_n, geo_df, c_grid_points, substations,
     return assigned_substations, connecting_points
 
 
-def cluster_grid(geo_df, gdf_cluster_pop, resolution, line_bc,
-                 n_terminal_nodes, gdf_cluster, gdf_roads, roads_segments):
-    c_grid = gdf_cluster_pop
-    c_grid_cost = 0
-    c_grid_length = 0
-    c_grid_points = []
-
-    if n_terminal_nodes < resolution / 5 and gdf_cluster.length.size < 500:
+def routing_plan(geo_df, gdf_cluster_pop, memory_budget=4000,
+                 time_budget=600, costs=None):
+    """
+    Choose the routing algorithms of a cluster from an estimate of the
+    memory and time they need: Steiner builds the metric closure of all the
+    points of its box, Spider the complete graph of the terminal nodes.
+    Both are run, to keep the cheaper grid, only if they fit the budgets
+    together; otherwise the first one fitting, in order of preference.
+    :param geo_df: Point geodataframe the box of Steiner is taken from
+    :param gdf_cluster_pop: Terminal nodes of the cluster
+    :param memory_budget: Memory available for the routing [MB]
+    :param time_budget: Time available for the routing of the cluster [s]
+    :param costs: Costs of the algorithms, by default routing_costs
+    :return plan: Algorithms to run, the preferred first: ['steiner',
+        'spider'], ['steiner'] or ['spider']; Spider alone, as the lightest,
+        if none of them fits
+    """
+    df_box = create_box(gdf_cluster_pop, geo_df)
+    n_box = len(df_box)
+    sub_graph = box_graph(df_box)
+    # about 8 neighbours for each point of the mesh
+    n_edges = sub_graph[0].nnz // 2 if sub_graph is not None else 4 * n_box
+    n_terminal_nodes = len(gdf_cluster_pop)
+    costs = dict(routing_costs, **(costs or {}))
+
+    steiner = (n_box ** 2 * costs['steiner_pair_bytes'] / 1024 ** 2,
+               n_box * (n_box + n_edges) * math.log2(max(n_box, 2)) *
+               costs['steiner_step_time'])
+    spider = (n_terminal_nodes ** 2 * costs['spider_pair_bytes'] / 1024 ** 2,
+              n_terminal_nodes ** 2 * costs['spider_pair_time'])
+    # both run one after the other: the peak memory of the larger one and
+    # the sum of the times
+    estimates = {('steiner', 'spider'): (max(steiner[0], spider[0]),
+                                         steiner[1] + spider[1]),
+                 ('steiner',): steiner, ('spider',): spider}
+
+    logger.info('Box of %d points and %d edges, %d terminal nodes', n_box,
+                n_edges, n_terminal_nodes)
+    for plan, (memory, seconds) in estimates.items():
+        logger.info('%s needs about %.0f MB and %.0f s',
+                    ' and '.join(plan).capitalize(), memory, seconds)
+    # in order of preference
+    for plan, (memory, seconds) in estimates.items():
+        if memory <= memory_budget and seconds <= time_budget:
+            logger.info('Running %s within the budget of %d MB and %d s',
+                        ' and '.join(plan).capitalize(), memory_budget,
+                        time_budget)
+            return list(plan)
+    logger.info('No algorithm fits the budget of %d MB and %d s, running '
+                'Spider as the lightest', memory_budget, time_budget)
+    return ['spider']
 
-        c_grid2, c_grid_cost2, c_grid_length2, c_grid_points2 = Spiderman. \
-            spider(geo_df, gdf_cluster_pop, line_bc, resolution, gdf_roads,
-                   roads_segments)
 
-        # c_grid1, c_grid_cost1, c_grid_length1, c_grid_points1 = Steinerman. \
-        #     steiner_roads(geo_df, gdf_cluster_pop, line_bc, resolution,
-        #                   gdf_roads, roads_segments)
-
-        # c_grid2, c_grid_cost2, c_grid_length2, c_grid_points2 = Spiderman. \
-        #     spider(geo_df, gdf_cluster_pop, line_bc, resolution, gdf_roads,
-        #            roads_segments)
-        #
-        c_grid1, c_grid_cost1, c_grid_length1, c_grid_points1 = Steinerman. \
-            steiner(geo_df, gdf_cluster_pop, line_bc, resolution)
-
-        if c_grid_cost1 <= c_grid_cost2:
-            print("Steiner algorithm has the better cost")
-            c_grid = c_grid1
-            c_grid_length = c_grid_length1
-            c_grid_cost = c_grid_cost1
-            c_grid_points = c_grid_points1
-
-        elif c_grid_cost1 > c_grid_cost2:
-            print("Spider algorithm has the better cost")
-            c_grid = c_grid2
-            c_grid_length = c_grid_length2
-            c_grid_cost = c_grid_cost2
-            c_grid_points = c_grid_points2
-
-    else:
-        print("Too many points to use Steiner, running Spider.")
-        c_grid, c_grid_cost, c_grid_length, c_grid_points = Spiderman. \
-            spider(geo_df, gdf_cluster_pop, line_bc, resolution, gdf_roads,
-                   roads_segments)
+def cluster_grid(geo_df, gdf_cluster_pop, resolution, line_bc,
+                 n_terminal_nodes, gdf_cluster, gdf_roads, roads_segments,
+                 memory_budget=4000, time_budget=600):
+    plan = routing_plan(geo_df, gdf_cluster_pop, memory_budget, time_budget)
+    routes = []
+    for algorithm in plan:
+        if algorithm == 'steiner':
+            routes.append(Steinerman.steiner(geo_df, gdf_cluster_pop,
+                                             line_bc, resolution))
+        else:
+            routes.append(Spiderman.spider(geo_df, gdf_cluster_pop, line_bc,
+                                           resolution, gdf_roads,
+                                           roads_segments))
+
+    # c_grid1, c_grid_cost1, c_grid_length1, c_grid_points1 = Steinerman. \
+    #     steiner_roads(geo_df, gdf_cluster_pop, line_bc, resolution,
+    #                   gdf_roads, roads_segments)
+
+    # the cheapest grid, the preferred algorithm on ties
+    best = min(range(len(plan)), key=lambda k: routes[k][1])
+    if len(plan) > 1:
+        logger.info('%s algorithm has the better cost',
+                    plan[best].capitalize())
+    c_grid, c_grid_cost, c_grid_length, c_grid_points = routes[best]
 
     return c_grid, c_grid_cost, c_grid_length, c_grid_points
 
@@ -8,7 +8,7 @@ the initial Point geodataframe.
 """
 
 import os
-import math
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
@@ -43,7 +43,9 @@ def weighting(df, resolution, landcover_option):
     characteristics and the distance to the nearest road.
     :param df: From which part of GISEle the user is starting
     :param resolution: resolution of the dataframe df
-    :return df_weighted: Point dataframe with weight attributes assigned
+    :return df_weighted: Point dataframe with weight attributes assigned.
+        If df has a Cost column, sampled from the cost surface, it replaces
+        the slope, land cover, road and protected area terms.
     """
     df_weighted = df.dropna(subset=['Elevation'])
     df_weighted.reset_index(drop=True)
@@ -57,38 +59,30 @@ def weighting(df, resolution, landcover_option):
     landcover_csv = pd.read_csv('Landcover.csv')
     os.chdir(r'..//')
     del df
-    # Weighting section
-    # Slope conditions
-    df_weighted['Weight'] = math.e**(
-        0.01732867951 * df_weighted['Slope'])
-    # Land cover using the column Other or GLC to compute the weight
-    for i,row in landcover_csv.iterrows():
-        if landcover_option == 'GLC':
-            df_weighted.loc[
-                df_weighted['Land_cover'] == row['GLC2000'], 'Weight'] += \
-            landcover_csv.loc[i, 'WeightGLC']
-        elif landcover_option == 'GLCS':
-            df_weighted.loc[
-                df_weighted['Land_cover'] == row['GLCS'], 'Weight'] += \
-            landcover_csv.loc[i, 'WeightGLCS']
-        elif landcover_option == 'ESACCI':
-            df_weighted.loc[
-                df_weighted['Land_cover'] == row['ESACCI'], 'Weight'] += \
-            landcover_csv.loc[i, 'WeightESACCI']
-        elif landcover_option == 'Other':
-            df_weighted.loc[
-                df_weighted['Land_cover'] == row['Other'], 'Weight'] += \
-            landcover_csv.loc[i, 'WeightOther']
-    # Road distance conditions
-    df_weighted.loc[df_weighted['Road_dist'] < 1000, 'Weight'] += \
-        5 * df_weighted.loc[
-                  df_weighted[
-                      'Road_dist'] < 1000, 'Road_dist'] / 1000
-
-    df_weighted.loc[df_weighted['Road_dist'] >= 1000,'Weight'] += 5
-    df_weighted.loc[df_weighted['Road_dist'] < resolution / 2, 'Weight'] = 1.5
-    #Protected areas condition
-    df_weighted.loc[df_weighted['Protected_area'] == True, 'Weight'] += 5
+    # Weighting section, computed for all the points at once
+    road_dist = df_weighted['Road_dist'].values.astype(float)
+    protected = (df_weighted['Protected_area'] == True).values
+    if 'Cost' in df_weighted.columns:
+        # weight already sampled from the cost surface
+        weight = df_weighted['Cost'].values.astype(float)
+        weight[road_dist < resolution / 2] = 1.5
+        weight[protected & (road_dist < resolution / 2)] += 5
+    else:
+        # Slope conditions
+        weight = np.exp(0.01732867951 *
+                        df_weighted['Slope'].values.astype(float))
+        # Land cover using the column Other or GLC to compute the weight
+        lookup = landcover_lookup(landcover_csv, landcover_option)
+        land_cover = df_weighted['Land_cover'].values.astype(float)
+        valid = (land_cover >= 0) & (land_cover < lookup.size)
+        weight[valid] += lookup[land_cover[valid].astype(int)]
+        # Road distance conditions
+        weight += np.where(road_dist < 1000, 5 * road_dist / 1000,
+                           np.where(road_dist >= 1000, 5, 0))
+        weight[road_dist < resolution / 2] = 1.5
+        #Protected areas condition
+        weight[protected] += 5
+    df_weighted['Weight'] = weight.astype(np.float32)
 
     valid_fields = ['ID', 'X', 'Y', 'Population', 'Elevation', 'Weight']
     blacklist = []
@@ -102,6 +96,32 @@ def weighting(df, resolution, landcover_option):
     return df_weighted
 
 
+def landcover_lookup(landcover_csv, landcover_option):
+    """
+    Array of the land cover weights indexed by class code, so that the weight
+    of all the points is found with a single lookup. Classes listed more
+    than once add up their weights, codes not in the table weigh 0.
+    :param landcover_csv: Dataframe of the table Landcover.csv
+    :param landcover_option: Land cover classification (GLC, GLCS, ESACCI or
+        Other)
+    :return lookup: Array with the weight of each class code
+    """
+    columns = {'GLC': ('GLC2000', 'WeightGLC'), 'GLCS': ('GLCS', 'WeightGLCS'),
+               'ESACCI': ('ESACCI', 'WeightESACCI'),
+               'Other': ('Other', 'WeightOther')}
+    if landcover_option not in columns:
+        return np.zeros(0)
+    code, weight = columns[landcover_option]
+    table = landcover_csv[[code, weight]].dropna()
+    table = table[(table[code] >= 0) & (table[code] % 1 == 0)]
+    if table.empty:
+        return np.zeros(0)
+    lookup = np.zeros(int(table[code].max()) + 1)
+    np.add.at(lookup, table[code].values.astype(int),
+              table[weight].values.astype(float))
+    return lookup
+
+
 def creating_geodataframe(df_weighted, crs, unit, input_csv, step):
     """
     Based on the input weighted dataframe, creates a geodataframe assigning to
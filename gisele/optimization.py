@@ -4,7 +4,8 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 import json
-from gisele.functions import line_to_points, distance_2d, nearest
+from gisele.functions import line_to_points, distance_2d, nearest, \
+    cluster_index, cluster_points, load_routing_graph
 from gisele import dijkstra, npc_optimization
 
 
@@ -158,8 +159,10 @@ def milp_npc(geo_df_clustered, grid_resume, substations, mg, total_energy,
         nearest_id=substations.apply(nearest, df=geo_df_clustered,
                                      src_column='ID', axis=1))
     total_connections_opt = pd.DataFrame()
+    clusters = cluster_index(geo_df_clustered)
     gdf_roads = gpd.read_file('Output/Datasets/Roads/gdf_roads.shp')
     roads_segments =gpd.read_file('Output/Datasets/Roads/roads_segments.shp')
+    load_routing_graph()
 
     if branch == 'yes':
         file = 'Branch_'
@@ -198,7 +201,7 @@ def milp_npc(geo_df_clustered, grid_resume, substations, mg, total_energy,
                                          grid_1.ID2.astype(int)))
                 grid_1 = line_to_points(grid_1, geo_df_clustered)
             else:
-                grid_1=geo_df_clustered[geo_df_clustered['Cluster']==int(row[1][0].split('C')[1])]
+                grid_1=cluster_points(geo_df_clustered, clusters, int(row[1][0].split('C')[1]))
                 grid_1=grid_1[grid_1['Population']>0]
                 c_grid_points = []
         elif 'S' in row[1][0]:
@@ -215,8 +218,8 @@ def milp_npc(geo_df_clustered, grid_resume, substations, mg, total_energy,
                                           grid_2.ID2.astype(int))))
                 grid_2 = line_to_points(grid_2, geo_df_clustered)
             else:
-                grid_2 = geo_df_clustered[
-                    geo_df_clustered['Cluster'] == int(row[1][1].split('C')[1])]
+                grid_2 = cluster_points(geo_df_clustered, clusters,
+                                        int(row[1][1].split('C')[1]))
                 grid_2 = grid_2[grid_2['Population'] > 0]
 
         elif 'S' in row[1][1]:
@@ -345,9 +348,8 @@ def milp_npc(geo_df_clustered, grid_resume, substations, mg, total_energy,
                                      grid_1.ID2.astype(int)))
             grid_1 = line_to_points(grid_1, geo_df_clustered)
         else:
-            grid_1 = geo_df_clustered[
-                geo_df_clustered['Cluster'] == int(
-                    k.split('C')[1])]
+            grid_1 = cluster_points(geo_df_clustered, clusters,
+                                    int(k.split('C')[1]))
             grid_1 = grid_1[grid_1['Population'] > 0]
             c_grid_points=[]
         # find the second point of the connection
@@ -365,9 +367,8 @@ def milp_npc(geo_df_clustered, grid_resume, substations, mg, total_energy,
                                               grid_2.ID2.astype(int))))
                 grid_2 = line_to_points(grid_2, geo_df_clustered)
             else:
-                grid_2 = geo_df_clustered[
-                    geo_df_clustered['Cluster'] == int(
-                        k1.split('C')[1])]
+                grid_2 = cluster_points(geo_df_clustered, clusters,
+                                        int(k1.split('C')[1]))
                 grid_2 = grid_2[grid_2['Population'] > 0]
 
             grid_resume.loc[index, 'Connection Type'] = 'Intra cluster connection'
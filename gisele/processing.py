@@ -1,5 +1,9 @@
 import zipfile
 import os
+import sys
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import rasterio.mask
 from osgeo import gdal
 import geopandas as gpd
@@ -7,16 +11,57 @@ import numpy as np
 import pandas as pd
 import rasterio
 from rasterio.enums import Resampling
-from shapely.geometry import Point, MultiPoint, MultiPolygon
-from shapely.ops import nearest_points
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from rasterio.windows import Window, from_bounds
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+from shapely import vectorized, wkb
+from shapely.geometry import box
+from shapely.prepared import prep
 
+MESH_COLUMNS = ['ID', 'X', 'Y', 'Elevation', 'Slope', 'Population',
+                'Land_cover', 'Road_dist', 'River_flow', 'Protected_area']
 
-def create_mesh(study_area, crs, resolution, imported_pop=pd.DataFrame()):
+# compact types of the columns of the point table; integer columns with
+# missing values are kept as float32
+MESH_SCHEMA = {'ID': 'int32', 'X': 'float64', 'Y': 'float64',
+               'Elevation': 'float32', 'Slope': 'float32',
+               'Population': 'float32', 'Land_cover': 'uint8',
+               'Road_dist': 'float32', 'River_flow': 'float32',
+               'Protected_area': 'bool', 'Weight': 'float32',
+               'Cluster': 'int32'}
 
+# folders of the layers downloaded by collecting.data_gathering
+DATASETS = ['Output/Datasets/Elevation', 'Output/Datasets/LandCover',
+            'Output/Datasets/Population', 'Output/Datasets/ProtectedAreas',
+            'Output/Datasets/Roads']
+
+
+def create_mesh(study_area, crs, resolution, imported_pop=pd.DataFrame(),
+                tile_size=None):
+    """
+    Create the mesh of points of the study area and sample the layers in
+    them. With tile_size the points are built and written to the columnar
+    store one tile at a time by create_mesh_tiled; the mesh returned is
+    then read back whole, since the weighting needs all its points at
+    once: iter_mesh('Input/downloaded_mesh') goes through it one chunk at
+    a time instead.
+    :param study_area: Geodataframe with the polygon of the study area
+    :param crs: Coordinate Reference System of the electrification project
+    :param resolution: Resolution of the mesh [m]
+    :param imported_pop: Population points imported by the user, if any
+    :param tile_size: Number of mesh points on each side of a tile, None
+        or 0 to build the mesh at once
+    :return geo_df: Geodataframe of the points of the mesh
+    """
     print('Processing the imported data and creating the input csv file..')
-    df = pd.DataFrame(columns=['ID', 'X', 'Y', 'Elevation', 'Slope',
-                               'Population', 'Land_cover', 'Road_dist',
-                               'River_flow','Protected_area'])
+    if tile_size:
+        create_mesh_tiled(study_area, crs, resolution, imported_pop,
+                          tile_size)
+        df = read_mesh('Input/downloaded_mesh')
+        return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.X, df.Y),
+                                crs=crs)
 
     study_area = study_area.to_crs(crs)
     min_x, min_y, max_x, max_y = study_area.geometry.total_bounds
@@ -27,18 +72,11 @@ def create_mesh(study_area, crs, resolution, imported_pop=pd.DataFrame()):
     lon, lat = np.meshgrid(lon, lat)
 
     # improvements: add rivers and protected areas
-    df['X'] = lon.reshape((np.prod(lon.shape),))
-    df['Y'] = lat.reshape((np.prod(lat.shape),))
+    df = pd.DataFrame({'X': lon.reshape((np.prod(lon.shape),)),
+                       'Y': lat.reshape((np.prod(lat.shape),))})
 
     if not imported_pop.empty:
-        pop_data = pd.read_csv(r'Input/imported_pop.csv')
-        valid_fields = ['X', 'Y', 'Population']
-        blacklist = []
-        for x in pop_data.columns:
-            if x not in valid_fields:
-                blacklist.append(x)
-        pop_data.drop(blacklist, axis=1, inplace=True)
-        df = pd.concat([df, pop_data])
+        df = pd.concat([df, imported_points()])
 
     # create geo-data-frame out of df and clip it with the area
     geo_df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.X, df.Y),
@@ -47,23 +85,65 @@ def create_mesh(study_area, crs, resolution, imported_pop=pd.DataFrame()):
     geo_df = gpd.clip(geo_df, study_area)
     geo_df.reset_index(drop=True, inplace=True)
     geo_df['ID'] = geo_df.index
+
+    datasets = prepare_datasets(crs)
+    roads = road_index(datasets['streets'], resolution)
+
+    # sample raster data with points of the regular grid
+    print('Assigning values to each point..')
+    columns = sample_mesh(geo_df['X'].values.astype(float),
+                          geo_df['Y'].values.astype(float), resolution,
+                          datasets, roads, imported_pop.empty)
+    for column, values in columns.items():
+        geo_df[column] = values
+
+    print('\n')
+    geo_df = geo_df.reindex(columns=MESH_COLUMNS + ['geometry'])
+    geo_df.Elevation = geo_df.Elevation.astype(int)
+    geo_df = compact_mesh(geo_df)
+    pd.DataFrame(geo_df.drop(columns='geometry'))\
+        .to_csv('Input/downloaded_csv.csv', index=False)
+    write_mesh(geo_df, 'Input/downloaded_mesh')
+
+    return geo_df
+
+
+def imported_points():
+    """
+    Read the population points imported by the user, keeping only their
+    coordinates and population.
+    :return pop_data: Dataframe with columns X, Y and Population
+    """
+    pop_data = pd.read_csv(r'Input/imported_pop.csv')
+    valid_fields = ['X', 'Y', 'Population']
+    blacklist = []
+    for x in pop_data.columns:
+        if x not in valid_fields:
+            blacklist.append(x)
+    pop_data.drop(blacklist, axis=1, inplace=True)
+    return pop_data
+
+
+def prepare_datasets(crs):
+    """
+    Prepare the downloaded layers for the sampling: extract the rasters,
+    compute the slope and import roads and protected areas.
+    :param crs: Coordinate Reference System of the electrification project
+    :return datasets: Dictionary with the paths of the elevation, slope,
+        land cover and population rasters, the roads geodataframe and the
+        protected areas geodataframe (None if not available)
+    """
     # import vector files
     streets = gpd.read_file('Output/Datasets/Roads/edges.shp')
     # save again vector file with the correct name
     streets.to_file('Output/Datasets/Roads/roads.shp')
     streets = streets.to_crs(crs)
-    streets_points = []
-    for line in streets['geometry']:
-        for x in list(zip(line.xy[0], line.xy[1])):
-            streets_points.append(x)
-    streets_multipoint = MultiPoint(streets_points)
     if os.path.exists('Output/Datasets/ProtectedAreas/ProtectedAreas.shp'):
-        prot_exist=True
         protected_areas = gpd.read_file('Output/Datasets/ProtectedAreas/ProtectedAreas.shp')
         protected_areas = protected_areas.to_crs(crs)
         protected_areas = protected_areas[protected_areas['IUCN_CAT'].isin(['II','I'])]
     else:
-        prot_exist=False
+        protected_areas = None
 
     # Manage raster files and sample their values
     # extract zipped files #
@@ -79,130 +159,805 @@ def create_mesh(study_area, crs, resolution, imported_pop=pd.DataFrame()):
     file_land_cover = os.listdir('Output/Datasets/LandCover')
     file_population = os.listdir('Output/Datasets/Population')
 
-    # open files with rasterio
+    datasets = {'streets': streets, 'protected_areas': protected_areas}
     for i in range(file_elevation.__len__()):
 
         if file_elevation[i].endswith('.tif'):
-            raster_elevation = rasterio.open('Output/Datasets/Elevation/'
-                                             + file_elevation[i])
+            datasets['elevation'] = 'Output/Datasets/Elevation/' + \
+                                    file_elevation[i]
             # compute slope
             gdal.DEMProcessing('Output/Datasets/Elevation/slope.tif',
                                'Output/Datasets/Elevation/' + file_elevation[
                                    i],
                                'slope')
-            raster_slope = rasterio.open('Output/Datasets/Elevation/slope.tif')
+            datasets['slope'] = 'Output/Datasets/Elevation/slope.tif'
 
         if file_land_cover[i].endswith('.tif'):
-            raster_land_cover = rasterio.open('Output/Datasets/LandCover/'
-                                              + file_land_cover[i])
+            datasets['land_cover'] = 'Output/Datasets/LandCover/' + \
+                                     file_land_cover[i]
         if file_population[i].endswith('.tif'):
-            raster_population = rasterio.open('Output/Datasets/Population/'
-                                              + file_population[i])
-
-    # re-sample continuous raster according to the desired resolution(bilinear)
-
-    data_elevation, profile_elevation = resample(raster_elevation, resolution)
-    data_slope, profile_slope = resample(raster_slope, resolution)
-
-    # write re-sampled values in a new raster
-    with rasterio.open('Output/Datasets/Elevation/elevation_resampled.tif',
-                       'w', **profile_elevation) as dst:
-        dst.write(data_elevation)
-        # dst.write(data_elevation.astype(rasterio.int16))
-    with rasterio.open('Output/Datasets/Elevation/slope_resampled.tif', 'w',
-                       **profile_slope) as dst:
-        dst.write(data_slope)
-        # dst.write(data_slope.astype(rasterio.float32))
-    # reopen resampled values. It seems stupid, need to check for a faster way
-    raster_elevation_resampled = \
-        rasterio.open('Output/Datasets/Elevation/elevation_resampled.tif')
-    raster_slope_resampled = \
-        rasterio.open('Output/Datasets/Elevation/slope_resampled.tif')
-
-    # read arrays of raster layers
-    elevation_resampled = raster_elevation_resampled.read()
-    slope_resampled = raster_slope_resampled.read()
-    land_cover = raster_land_cover.read()
-    population = raster_population.read()
-    # get population cell size to understand how to sample it
-    affine_pop = raster_population.transform
-    pixel_x_pop = affine_pop[0]
+            datasets['population'] = 'Output/Datasets/Population/' + \
+                                     file_population[i]
 
-    # sample raster data with points of the regular grid
-    print('Assigning values to each point..')
-    for i, row in geo_df.iterrows():
-        # population
-        if imported_pop.empty:
-            if pixel_x_pop <= resolution:
-                row_min, column_max = raster_population.\
-                    index(row.X + resolution/2, row.Y + resolution/2)
-                row_max, column_min = raster_population.\
-                    index(row.X - resolution / 2, row.Y - resolution / 2)
-                value = population[0, row_min:row_max,
-                                   column_min:column_max].sum().sum()
-                geo_df.loc[i, 'Population'] = value
-            else:
-                x, y = raster_population.index(row.X, row.Y)
-                # better assign to the center
-                geo_df.loc[i, 'Population'] = \
-                    population[0, x, y]/pixel_x_pop * resolution
-        # road distance
-        nearest_geoms = nearest_points(Point(row.X, row.Y), streets_multipoint)
-        geo_df.loc[i, 'Road_dist'] = \
-            nearest_geoms[0].distance(nearest_geoms[1])
-
-        # elevation
-        x, y = raster_elevation_resampled.index(row.X, row.Y)
-        geo_df.loc[i, 'Elevation'] = elevation_resampled[0, x, y]
-
-        # slope
-        x, y = raster_slope_resampled.index(row.X, row.Y)
-        geo_df.loc[i, 'Slope'] = slope_resampled[0, x, y]
-
-        # land cover
-        x, y = raster_land_cover.index(row.X, row.Y)
-        geo_df.loc[i, 'Land_cover'] = land_cover[0, x, y]
-
-        # protected areas
-        if prot_exist:
-            geo_df.loc[i, 'Protected_area'] = \
-                protected_areas['geometry'].contains(Point(row.X,row.Y)).any()
-
-        print('\r' + str(i) + '/' + str(geo_df.index.__len__()),
-              sep=' ', end='', flush=True)
+    return datasets
+
+
+def sample_mesh(x, y, resolution, datasets, roads, sample_population=True,
+                bounds=None):
+    """
+    Assign to the mesh points the values of all the layers.
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param resolution: Resolution of the mesh [m]
+    :param datasets: Dictionary of the layers, as given by prepare_datasets
+    :param roads: Index of the road segments, as given by road_index
+    :param sample_population: False if the population was imported
+    :param bounds: (min_x, min_y, max_x, max_y) of the area to be read from
+        the rasters; if None the whole rasters are read
+    :return columns: Dictionary with an array of values for each column
+    """
+    columns = {}
+
+    # re-sample continuous raster according to the desired resolution
+    # (bilinear), keeping arrays and transforms in memory for the sampler
+    elevation, transform_elevation = read_raster(datasets['elevation'],
+                                                 bounds, resolution)
+    slope, transform_slope = read_raster(datasets['slope'], bounds,
+                                         resolution)
+    land_cover, transform_land_cover = read_raster(datasets['land_cover'],
+                                                   bounds)
+
+    # population
+    if sample_population:
+        population, affine_pop = read_raster(datasets['population'], bounds)
+        columns['Population'] = population_sum(population, affine_pop, x, y,
+                                               resolution)
+
+    # road distance
+    columns['Road_dist'] = nearest_road_distance(x, y, roads)
+
+    # elevation, slope and land cover
+    columns['Elevation'] = sample_raster(elevation, transform_elevation, x, y)
+    columns['Slope'] = sample_raster(slope, transform_slope, x, y)
+    columns['Land_cover'] = sample_raster(land_cover, transform_land_cover,
+                                          x, y)
+
+    # protected areas
+    if datasets['protected_areas'] is not None:
+        columns['Protected_area'] = protected_area_mask(
+            datasets['protected_areas'], x, y, resolution)
 
+    return columns
+
+
+def mesh_tiles(n_x, n_y, tile_size):
+    """
+    Split the lattice of the mesh in square tiles.
+    :param n_x: Number of mesh columns
+    :param n_y: Number of mesh rows
+    :param tile_size: Number of mesh points on each side of a tile
+    :return tiles: List of (first col, last col, first row, last row),
+        with the last index excluded
+    """
+    return [(i, min(i + tile_size, n_x), j, min(j + tile_size, n_y))
+            for j in range(0, n_y, tile_size)
+            for i in range(0, n_x, tile_size)]
+
+
+def clip_mask(area, x, y):
+    """
+    Find the points intersecting a prepared polygon, testing first the box
+    containing all of them so that tiles completely inside or outside the
+    polygon do not need a test per point; the other tiles are tested with
+    the vectorized predicates of shapely, the boundary only for the points
+    not contained.
+    :param area: Prepared shapely geometry of the study area
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :return value: Boolean array, True for points inside the area
+    """
+    if x.size == 0:
+        return np.zeros(0, dtype=bool)
+    tile = box(x.min(), y.min(), x.max(), y.max())
+    if not area.intersects(tile):
+        return np.zeros(x.size, dtype=bool)
+    if area.contains(tile):
+        return np.ones(x.size, dtype=bool)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inside = vectorized.contains(area, x, y)
+    outside = ~inside
+    inside[outside] = vectorized.touches(area, x[outside], y[outside])
+    return inside
+
+
+# state of each process of the pool used by create_mesh_tiled
+_tile_context = {}
+
+
+def _init_mesh_worker(context):
+    """
+    Initialize a process of the pool used by create_mesh_tiled, building
+    once the objects shared by all the tiles.
+    :param context: Dictionary with the parameters of the mesh
+    """
+    _tile_context.update(context)
+    _tile_context['area'] = prep(wkb.loads(context['area']))
+    _tile_context['roads'] = road_index(context['datasets']['streets'],
+                                        context['resolution'])
+
+
+def _mesh_tile(tile):
+    """
+    Create and sample the points of one tile of the mesh.
+    :param tile: (first col, last col, first row, last row, imported points)
+    :return df: Dataframe with the points of the tile inside the study area
+    """
+    i_0, i_1, j_0, j_1, pop_data = tile
+    resolution = _tile_context['resolution']
+    lon = _tile_context['min_x'] + resolution * np.arange(i_0, i_1)
+    lat = _tile_context['min_y'] + resolution * np.arange(j_0, j_1)
+    lon, lat = np.meshgrid(lon, lat)
+    df = pd.DataFrame({'X': lon.reshape((np.prod(lon.shape),)),
+                       'Y': lat.reshape((np.prod(lat.shape),))})
+    if pop_data is not None:
+        df = pd.concat([df, pop_data], ignore_index=True)
+
+    df = df[clip_mask(_tile_context['area'], df['X'].values,
+                      df['Y'].values)].reset_index(drop=True)
+    if df.empty:
+        return df
+    x = df['X'].values.astype(float)
+    y = df['Y'].values.astype(float)
+
+    # read only the part of the rasters around the tile
+    margin = 2 * resolution
+    bounds = (x.min() - margin, y.min() - margin,
+              x.max() + margin, y.max() + margin)
+    columns = sample_mesh(x, y, resolution, _tile_context['datasets'],
+                          _tile_context['roads'], pop_data is None, bounds)
+    for column, values in columns.items():
+        df[column] = values
+    df['Elevation'] = df['Elevation'].astype(int)
+    return df
+
+
+def create_mesh_tiled(study_area, crs, resolution,
+                      imported_pop=pd.DataFrame(), tile_size=500,
+                      n_jobs=None, out_file='Input/downloaded_csv.csv',
+                      store='Input/downloaded_mesh'):
+    """
+    Create the mesh of points of the study area one tile at a time, so that
+    the peak memory depends on the tile size and not on the study area.
+    Rasters are read only around each tile, tiles are processed by a pool of
+    processes and the points are appended to the output file as soon as
+    their tile is ready.
+    :param study_area: Geodataframe with the polygon of the study area
+    :param crs: Coordinate Reference System of the electrification project
+    :param resolution: Resolution of the mesh [m]
+    :param imported_pop: Population points imported by the user, if any
+    :param tile_size: Number of mesh points on each side of a tile
+    :param n_jobs: Number of processes (default: number of cpus)
+    :param out_file: Csv file where the points are written
+    :param store: Folder of the columnar store where the points are written
+    :return out_file: Csv file with all the points of the mesh
+    """
+    study_area = study_area.to_crs(crs)
+    min_x, min_y, max_x, max_y = study_area.geometry.total_bounds
+    n_x = np.arange(min_x, max_x, resolution).size
+    n_y = np.arange(min_y, max_y, resolution).size
+    tiles = mesh_tiles(n_x, n_y, tile_size)
+
+    # imported points are given to the tile containing them
+    pop_tiles = [None] * len(tiles)
+    if not imported_pop.empty:
+        pop_data = imported_points()
+        n_tiles_x = int(np.ceil(n_x / tile_size))
+        n_tiles_y = int(np.ceil(n_y / tile_size))
+        tile_x = np.clip(np.floor((pop_data['X'] - min_x) /
+                                  (resolution * tile_size)),
+                         0, n_tiles_x - 1).astype(int)
+        tile_y = np.clip(np.floor((pop_data['Y'] - min_y) /
+                                  (resolution * tile_size)),
+                         0, n_tiles_y - 1).astype(int)
+        for k, points in pop_data.groupby(tile_y * n_tiles_x + tile_x):
+            pop_tiles[k] = points
+    tiles = [tile + (pop_tiles[k],) for k, tile in enumerate(tiles)]
+
+    context = {'resolution': resolution, 'min_x': min_x, 'min_y': min_y,
+               'area': study_area.geometry.unary_union.wkb,
+               'datasets': prepare_datasets(crs)}
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    write_mesh(pd.DataFrame(columns=MESH_COLUMNS), store,
+               origin=(min_x, min_y))
+
+    print('Creating the mesh in ' + str(len(tiles)) + ' tiles..')
+    n_points = 0
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             initializer=_init_mesh_worker,
+                             initargs=(context,)) as executor:
+        for k, df in enumerate(executor.map(_mesh_tile, tiles)):
+            if not df.empty:
+                df['ID'] = np.arange(n_points, n_points + len(df))
+                df = compact_mesh(df.reindex(columns=MESH_COLUMNS))
+                df.to_csv(out_file, mode='a', header=n_points == 0,
+                          index=False)
+                write_mesh(df, store, append=True)
+                n_points += len(df)
+            print('\r' + str(k + 1) + '/' + str(len(tiles)),
+                  sep=' ', end='', flush=True)
     print('\n')
-    geo_df.Elevation = geo_df.Elevation.astype(int)
-    pd.DataFrame(geo_df.drop(columns='geometry'))\
-        .to_csv('Input/downloaded_csv.csv', index=False)
 
-    return geo_df
+    return out_file
+
 
+def compact_mesh(df):
+    """
+    Convert the columns of the point table to the compact types of
+    MESH_SCHEMA; other columns are left as they are.
+    :param df: Dataframe of the points
+    :return df: The same dataframe, with compact columns
+    """
+    for column, dtype in MESH_SCHEMA.items():
+        if column not in df.columns:
+            continue
+        values = pd.to_numeric(df[column], errors='coerce')
+        if dtype == 'bool':
+            values = values.fillna(0)
+        elif np.issubdtype(np.dtype(dtype), np.integer):
+            limits = np.iinfo(dtype)
+            if values.isna().any() or values.min() < limits.min \
+                    or values.max() > limits.max:
+                dtype = 'float32'
+        df[column] = values.astype(dtype)
+    return df
 
-def resample(raster, resolution):
 
+def write_mesh(df, folder, chunk_size=1000000, append=False, origin=None):
+    """
+    Write the point table in a columnar store: a .npy file for each column
+    and chunk of rows, plus a schema.json file with the columns, the length
+    of the chunks and the origin of the coordinates. X and Y are stored as
+    float32 offsets from the origin, which keeps them precise to a few
+    centimetres with half of the space.
+    :param df: Dataframe of the points (geometry and text columns are not
+        stored)
+    :param folder: Folder of the store
+    :param chunk_size: Maximum number of rows of a chunk
+    :param append: If True the rows are added to an existing store
+    :param origin: (x, y) subtracted to the coordinates, by default their
+        minimum values
+    """
+    schema_file = os.path.join(folder, 'schema.json')
+    df = compact_mesh(pd.DataFrame(df.drop(columns='geometry',
+                                           errors='ignore')))
+    # only numeric and boolean columns are stored
+    df = df.select_dtypes(include=['number', 'bool'])
+    if append and os.path.isfile(schema_file):
+        with open(schema_file) as f:
+            schema = json.load(f)
+        df = df.reindex(columns=schema['columns'])
+    else:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        if origin is None:
+            origin = (float(df['X'].min()), float(df['Y'].min())) \
+                if not df.empty else (0., 0.)
+        schema = {'columns': list(df.columns),
+                  'origin': [float(origin[0]), float(origin[1])],
+                  'chunks': []}
+
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        k = len(schema['chunks'])
+        for column in schema['columns']:
+            values = chunk[column].values
+            if column == 'X':
+                values = (values - schema['origin'][0]).astype(np.float32)
+            elif column == 'Y':
+                values = (values - schema['origin'][1]).astype(np.float32)
+            np.save(os.path.join(folder, column + '_' + str(k) + '.npy'),
+                    values, allow_pickle=False)
+        schema['chunks'].append(len(chunk))
+    with open(schema_file, 'w') as f:
+        json.dump(schema, f)
+
+
+def iter_mesh(folder, columns=None):
+    """
+    Read a columnar store of points one chunk at a time.
+    :param folder: Folder of the store
+    :param columns: Columns to be read, by default all of them
+    :return df: Generator of dataframes, one for each chunk
+    """
+    with open(os.path.join(folder, 'schema.json')) as f:
+        schema = json.load(f)
+    if columns is None:
+        columns = schema['columns']
+    for k in range(len(schema['chunks'])):
+        data = {}
+        for column in columns:
+            values = np.load(os.path.join(folder, column + '_' + str(k) +
+                                          '.npy'), allow_pickle=False)
+            if column == 'X':
+                values = schema['origin'][0] + values.astype(float)
+            elif column == 'Y':
+                values = schema['origin'][1] + values.astype(float)
+            data[column] = values
+        yield pd.DataFrame(data, columns=columns)
+
+
+def read_mesh(folder, columns=None):
+    """
+    Read a columnar store of points.
+    :param folder: Folder of the store
+    :param columns: Columns to be read, by default all of them
+    :return df: Dataframe of the points
+    """
+    chunks = list(iter_mesh(folder, columns))
+    if not chunks:
+        with open(os.path.join(folder, 'schema.json')) as f:
+            return pd.DataFrame(columns=columns or json.load(f)['columns'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_raster(path, bounds=None, resolution=None):
+    """
+    Read a raster, or only the part of it covering the given bounds, and
+    optionally re-sample it to the desired resolution.
+    :param path: Path of the raster file
+    :param bounds: (min_x, min_y, max_x, max_y) of the area to be read
+    :param resolution: Desired pixel size [m]; if None it is not re-sampled
+    :return data: Array with shape (bands, rows, cols)
+    :return transform: Affine transform of the array
+    """
+    with rasterio.open(path) as raster:
+        window = None
+        if bounds is not None:
+            window = from_bounds(*bounds, transform=raster.transform)
+            # whole pixels covering the bounds, inside the raster
+            col_min = max(int(np.floor(window.col_off)), 0)
+            row_min = max(int(np.floor(window.row_off)), 0)
+            col_max = min(int(np.ceil(window.col_off + window.width)),
+                          raster.width)
+            row_max = min(int(np.ceil(window.row_off + window.height)),
+                          raster.height)
+            window = Window(col_min, row_min, col_max - col_min,
+                            row_max - row_min)
+        if resolution is not None:
+            return resample(raster, resolution, window)
+        data = raster.read(window=window)
+        if window is None:
+            return data, raster.transform
+        return data, raster.window_transform(window)
+
+
+def raster_index(transform, x, y):
+    """
+    Vectorized version of the rasterio index method: find the row and the
+    column of the raster cells containing the given coordinates.
+    :param transform: Affine transform of the raster
+    :param x: Array of x coordinates
+    :param y: Array of y coordinates
+    :return rows, cols: Integer arrays with the indices of the cells
+    """
+    # same small shift used by rasterio.transform.rowcol, so that points
+    # lying on the edge of a cell fall in the same cell as with .index()
+    eps = sys.float_info.epsilon
+    x = np.asarray(x, dtype=float) + eps
+    y = np.asarray(y, dtype=float) - eps
+    if transform.b == 0 and transform.d == 0:
+        # north-up raster: dividing by the pixel size keeps points on the
+        # edge of a cell in the same cell also when the raster is read in
+        # windows, which the inverse transform does not guarantee
+        cols = (x - transform.c) / transform.a
+        rows = (y - transform.f) / transform.e
+    else:
+        cols, rows = ~transform * (x, y)
+    return np.floor(rows).astype(int), np.floor(cols).astype(int)
+
+
+def sample_raster(array, transform, x, y):
+    """
+    Sample the first band of a raster array in all the given points at once.
+    :param array: Array read from the raster, with shape (bands, rows, cols)
+    :param transform: Affine transform of the raster
+    :param x: Array of x coordinates
+    :param y: Array of y coordinates
+    :return values: Array with the value of the cell containing each point
+    """
+    rows, cols = raster_index(transform, x, y)
+    return array[0, rows, cols]
+
+
+def summed_area_table(array):
+    """
+    Integral image of a raster band, padded with a row and a column of zeros
+    so that the sum of any window needs only four lookups. Missing values
+    count as zero.
+    :param array: Two-dimensional array
+    :return table: Array with one more row and column than the input
+    """
+    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    table[1:, 1:] = np.nan_to_num(array.astype(float)).cumsum(axis=0)\
+        .cumsum(axis=1)
+    return table
+
+
+def population_sum(population, transform, x, y, resolution):
+    """
+    Population of the square cells of the mesh centred in the given points.
+    If the population raster is finer than the mesh, the pixels falling in
+    each cell are summed with a summed-area table; if it is coarser, each
+    cell takes from the (at most four) pixels it overlaps a share of their
+    population proportional to the overlapping area.
+    :param population: Population array, with shape (bands, rows, cols)
+    :param transform: Affine transform of the population array
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param resolution: Resolution of the mesh [m]
+    :return values: Array with the population of each cell
+    """
+    population = population[0]
+    n_rows, n_cols = population.shape
+    pixel_x_pop = transform[0]
+
+    if pixel_x_pop <= resolution:
+        table = summed_area_table(population)
+        row_min, col_max = raster_index(transform, x + resolution / 2,
+                                        y + resolution / 2)
+        row_max, col_min = raster_index(transform, x - resolution / 2,
+                                        y - resolution / 2)
+        row_min = np.clip(row_min, 0, n_rows)
+        row_max = np.clip(row_max, row_min, n_rows)
+        col_min = np.clip(col_min, 0, n_cols)
+        col_max = np.clip(col_max, col_min, n_cols)
+        return table[row_max, col_max] - table[row_min, col_max] \
+            - table[row_max, col_min] + table[row_min, col_min]
+
+    # position of the cell edges in pixel units
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    col_start = (x - resolution / 2 - transform.c) / transform.a
+    row_start = (y + resolution / 2 - transform.f) / transform.e
+    col_end = col_start + resolution / transform.a
+    row_end = row_start + resolution / abs(transform.e)
+    col = np.floor(col_start).astype(int)
+    row = np.floor(row_start).astype(int)
+    # overlap with the first pixel and with the next one, in each direction
+    col_share = [np.minimum(col_end, col + 1) - col_start,
+                 np.maximum(col_end - (col + 1), 0)]
+    row_share = [np.minimum(row_end, row + 1) - row_start,
+                 np.maximum(row_end - (row + 1), 0)]
+
+    padded = np.zeros((n_rows + 2, n_cols + 2))
+    padded[1:-1, 1:-1] = np.nan_to_num(population.astype(float))
+    values = np.zeros(x.size)
+    for i in range(2):
+        for j in range(2):
+            values += padded[np.clip(row + i + 1, 0, n_rows + 1),
+                             np.clip(col + j + 1, 0, n_cols + 1)] \
+                * row_share[i] * col_share[j]
+    return values
+
+
+def cost_surface(crs, lookup, out_file):
+    """
+    Compute the weight of the terrain as a raster, on the grid of the slope
+    raster, with the same terms used by initialization.weighting: slope,
+    land cover, distance to the nearest road and protected areas. The
+    weight of points next to a road depends on the resolution of the mesh,
+    so it is left to the weighting of the mesh.
+    :param crs: Coordinate Reference System of the electrification project
+    :param lookup: Array of land cover weights indexed by class code, as
+        given by initialization.landcover_lookup
+    :param out_file: Path of the cost surface raster
+    :return out_file: Path of the cost surface raster
+    """
+    print('Computing the cost surface..')
+    datasets = prepare_datasets(crs)
+    with rasterio.open(datasets['slope']) as raster:
+        slope = raster.read(1).astype(float)
+        transform = raster.transform
+        profile = raster.profile
+
+    # slope conditions
+    weight = np.exp(0.01732867951 * np.nan_to_num(slope))
+
+    # land cover, sampled in the centre of each cell of the surface
+    rows, cols = np.indices(slope.shape)
+    x, y = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    land_cover, transform_land_cover = read_raster(datasets['land_cover'])
+    rows, cols = raster_index(transform_land_cover, x, y)
+    inside = (rows >= 0) & (rows < land_cover.shape[1]) & (cols >= 0) & \
+        (cols < land_cover.shape[2])
+    codes = np.full(x.size, -1)
+    codes[inside] = np.nan_to_num(land_cover[0, rows[inside], cols[inside]],
+                                  nan=-1).round()
+    valid = (codes >= 0) & (codes < lookup.size)
+    weight.ravel()[valid] += lookup[codes[valid].astype(int)]
+
+    # road distance conditions, from the centre of the nearest road cell
+    roads = rasterize(((geometry, 1) for geometry in
+                       datasets['streets'].geometry if geometry is not None),
+                      out_shape=slope.shape, transform=transform, fill=0,
+                      all_touched=True, dtype='uint8')
+    if roads.any():
+        road_dist = distance_transform_edt(roads == 0,
+                                           sampling=(abs(transform.e),
+                                                     transform.a))
+        weight += np.where(road_dist < 1000, 5 * road_dist / 1000, 5)
+
+    # protected areas condition
+    if datasets['protected_areas'] is not None and \
+            not datasets['protected_areas'].empty:
+        weight += 5 * rasterize(
+            ((geometry, 1) for geometry in
+             datasets['protected_areas'].geometry if geometry is not None),
+            out_shape=slope.shape, transform=transform, fill=0,
+            dtype='uint8')
+
+    profile.update(dtype='float32', count=1, nodata=None, driver='GTiff')
+    with rasterio.open(out_file, 'w', **profile) as dest:
+        dest.write(weight.astype(np.float32), 1)
+    return out_file
+
+
+def sample_cost_surface(path, x, y, resolution):
+    """
+    Weight of the mesh points taken from a cost surface: the mean of the
+    cells falling in the cell of each point (summed-area tables of values
+    and counts), or the value of the cell containing the point if the
+    surface is coarser than the mesh.
+    :param path: Path of the cost surface raster
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param resolution: Resolution of the mesh [m]
+    :return values: Array with the weight of each point
+    """
+    surface, transform = read_raster(path)
+    surface = surface.astype(float)
+    n_rows, n_cols = surface.shape[1:]
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    row_min, col_max = raster_index(transform, x + resolution / 2,
+                                    y + resolution / 2)
+    row_max, col_min = raster_index(transform, x - resolution / 2,
+                                    y - resolution / 2)
+    row_min = np.clip(row_min, 0, n_rows)
+    row_max = np.clip(row_max, row_min, n_rows)
+    col_min = np.clip(col_min, 0, n_cols)
+    col_max = np.clip(col_max, col_min, n_cols)
+    sums = summed_area_table(surface[0])
+    counts = summed_area_table(~np.isnan(surface[0]))
+    total = sums[row_max, col_max] - sums[row_min, col_max] \
+        - sums[row_max, col_min] + sums[row_min, col_min]
+    count = counts[row_max, col_max] - counts[row_min, col_max] \
+        - counts[row_max, col_min] + counts[row_min, col_min]
+
+    # cells smaller than the surface, or at its border
+    rows, cols = raster_index(transform, x, y)
+    nearest = surface[0, np.clip(rows, 0, n_rows - 1),
+                      np.clip(cols, 0, n_cols - 1)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, nearest)
+
+
+def road_segments(streets, max_length=None):
+    """
+    Break the road lines into straight segments, optionally splitting the
+    segments longer than max_length into equal parts.
+    :param streets: Geodataframe of (multi)linestrings of the roads
+    :param max_length: Maximum length of the segments [m]
+    :return start, end: Arrays (n, 2) with the two ends of each segment
+    """
+    start = []
+    end = []
+    for line in streets['geometry']:
+        if line is None or line.is_empty:
+            continue
+        if line.geom_type == 'MultiLineString':
+            parts = line.geoms
+        else:
+            parts = [line]
+        for part in parts:
+            coords = np.asarray(part.coords)[:, :2]
+            start.append(coords[:-1])
+            end.append(coords[1:])
+    if not start:
+        return np.empty((0, 2)), np.empty((0, 2))
+    start = np.concatenate(start)
+    end = np.concatenate(end)
+
+    if max_length is not None:
+        length = np.hypot(*(end - start).T)
+        pieces = np.maximum(np.ceil(length / max_length), 1).astype(int)
+        segment = np.repeat(np.arange(start.shape[0]), pieces)
+        first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = (np.arange(segment.size) - first) / pieces[segment]
+        t1 = t0 + 1 / pieces[segment]
+        delta = end[segment] - start[segment]
+        start, end = start[segment] + delta * t0[:, np.newaxis], \
+            start[segment] + delta * t1[:, np.newaxis]
+
+    return start, end
+
+
+def segment_distance(x, y, start, end):
+    """
+    Euclidean distance between points and segments, element by element.
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param start: Array (n, 2) with the first end of the segments
+    :param end: Array (n, 2) with the second end of the segments
+    :return value: Array with the distance of each point from its segment
+    """
+    dx = end[..., 0] - start[..., 0]
+    dy = end[..., 1] - start[..., 1]
+    length2 = dx ** 2 + dy ** 2
+    t = ((x - start[..., 0]) * dx + (y - start[..., 1]) * dy) / \
+        np.where(length2 > 0, length2, 1)
+    t = np.clip(t, 0, 1)
+    return np.hypot(x - start[..., 0] - t * dx, y - start[..., 1] - t * dy)
+
+
+def road_index(streets, max_length):
+    """
+    Build the spatial index used to find the distance to the nearest road: a
+    KD-tree on the midpoints of the road segments.
+    :param streets: Geodataframe of the roads, in the same crs of the points
+    :param max_length: Roads are split in segments not longer than this [m]
+    :return roads: Dictionary with the segments and their KD-tree
+    """
+    start, end = road_segments(streets, max_length)
+    roads = {'start': start, 'end': end, 'tree': None, 'half_length': 0}
+    if start.shape[0] > 0:
+        roads['tree'] = cKDTree((start + end) / 2)
+        roads['half_length'] = np.hypot(*(end - start).T).max() / 2
+    return roads
+
+
+def nearest_road_distance(x, y, roads, k=8):
+    """
+    Distance from every point to the nearest road segment, answering all the
+    points with a bulk query of the KD-tree; the k nearest midpoints are
+    enough unless a longer segment could still be closer, in which case the
+    point is checked against all segments in range.
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param roads: Index of the road segments, as given by road_index
+    :param k: Number of nearest segments tested for each point
+    :return road_dist: Array with the distance to the nearest road [m]
+    """
+    start, end, tree = roads['start'], roads['end'], roads['tree']
+    if tree is None:
+        return np.full(np.size(x), np.nan)
+    points = np.column_stack((x, y))
+    k = min(k, start.shape[0])
+
+    mid_dist, candidates = tree.query(points, k=k)
+    mid_dist = mid_dist.reshape(points.shape[0], k)
+    candidates = candidates.reshape(points.shape[0], k)
+    road_dist = segment_distance(points[:, [0]], points[:, [1]],
+                                 start[candidates], end[candidates]).min(axis=1)
+
+    # a segment whose midpoint is farther than road_dist + half_length
+    # cannot be closer than road_dist
+    unsure = np.flatnonzero(mid_dist[:, -1] < road_dist + roads['half_length'])
+    if k < start.shape[0]:
+        for i in unsure:
+            near = tree.query_ball_point(points[i],
+                                         road_dist[i] + roads['half_length'])
+            road_dist[i] = segment_distance(points[i, 0], points[i, 1],
+                                            start[near], end[near]).min()
+    return road_dist
+
+
+def road_distance(x, y, streets, max_length, k=8):
+    """
+    Distance from every point to the nearest road segment.
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param streets: Geodataframe of the roads, in the same crs of the points
+    :param max_length: Roads are split in segments not longer than this [m]
+    :param k: Number of nearest segments tested for each point
+    :return road_dist: Array with the distance to the nearest road [m]
+    """
+    return nearest_road_distance(x, y, road_index(streets, max_length), k)
+
+
+def protected_area_mask(protected_areas, x, y, resolution):
+    """
+    Flag the points falling inside a protected area. The polygons are burned
+    once into a boolean raster with one cell per mesh point, which is then
+    sampled in all the points with array indexing.
+    :param protected_areas: Geodataframe of the protected areas polygons
+    :param x: Array of x coordinates of the points
+    :param y: Array of y coordinates of the points
+    :param resolution: Resolution of the mesh [m]
+    :return value: Boolean array, True for points inside a protected area
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shapes = [(geom, 1) for geom in protected_areas['geometry']
+              if geom is not None and not geom.is_empty]
+    if not shapes or x.size == 0:
+        return np.zeros(x.size, dtype=bool)
+
+    # cells centered on the mesh points
+    transform = Affine(resolution, 0, x.min() - resolution / 2,
+                       0, -resolution, y.max() + resolution / 2)
+    width = int(np.ceil((x.max() - x.min()) / resolution)) + 1
+    height = int(np.ceil((y.max() - y.min()) / resolution)) + 1
+    mask = rasterize(shapes, out_shape=(height, width), transform=transform,
+                     fill=0, dtype='uint8')
+    return sample_raster(mask[np.newaxis], transform, x, y).astype(bool)
+
+
+def resample(raster, resolution, window=None, block_size=512):
+    """
+    Re-sample a raster to the desired resolution with a bilinear
+    interpolation. The result stays in memory and is meant to be given
+    directly to sample_raster. The grid of the result is the one of the
+    whole raster re-sampled, also when only a window is read, and it is
+    computed in square blocks of this grid: a window gets the same values
+    of the same cells of the whole raster, so that the tiles of the mesh
+    sample the same values of a mesh built at once.
+    :param raster: Raster opened with rasterio
+    :param resolution: Desired pixel size [m]
+    :param window: Window of the raster to be read; if None, all of it
+    :param block_size: Number of re-sampled cells on each side of a block
+    :return data: Re-sampled array, with shape (bands, rows, cols)
+    :return transform: Affine transform of the re-sampled array
+    """
     # get pixel size
     affine = raster.transform
     pixel_x = affine[0]
     scale_factor = pixel_x / resolution
-    # re-sample data to target shape
-    data = raster.read(
-        out_shape=(
-            raster.count,
-            int(raster.height * scale_factor),
-            int(raster.width * scale_factor)
-        ),
-        resampling=Resampling.bilinear
-    )
+    # grid of the whole raster re-sampled
+    height = int(raster.height * scale_factor)
+    width = int(raster.width * scale_factor)
+    ratio_x = raster.width / width
+    ratio_y = raster.height / height
+    if window is None:
+        col_min, row_min, col_max, row_max = 0, 0, width, height
+    else:
+        # cells of the grid covering the window
+        col_min = max(int(np.floor(window.col_off / ratio_x)), 0)
+        row_min = max(int(np.floor(window.row_off / ratio_y)), 0)
+        col_max = min(int(np.ceil((window.col_off + window.width) /
+                                  ratio_x)), width)
+        row_max = min(int(np.ceil((window.row_off + window.height) /
+                                  ratio_y)), height)
+    data = np.empty((raster.count, max(row_max - row_min, 0),
+                     max(col_max - col_min, 0)), dtype=raster.dtypes[0])
 
-    # scale image transform
-    transform = raster.transform * raster.transform.scale(
-        (raster.width / data.shape[-1]),
-        (raster.height / data.shape[-2])
-    )
+    # re-sample data block by block, reading the part of the raster under
+    # each block
+    for block_row in range(row_min // block_size * block_size, row_max,
+                           block_size):
+        for block_col in range(col_min // block_size * block_size, col_max,
+                               block_size):
+            rows = min(block_size, height - block_row)
+            cols = min(block_size, width - block_col)
+            block = raster.read(
+                out_shape=(raster.count, rows, cols),
+                window=Window(block_col * ratio_x, block_row * ratio_y,
+                              cols * ratio_x, rows * ratio_y),
+                resampling=Resampling.bilinear
+            )
+            r_0, r_1 = max(block_row, row_min), min(block_row + rows,
+                                                    row_max)
+            c_0, c_1 = max(block_col, col_min), min(block_col + cols,
+                                                    col_max)
+            data[:, r_0 - row_min:r_1 - row_min, c_0 - col_min:c_1 - col_min] \
+                = block[:, r_0 - block_row:r_1 - block_row,
+                        c_0 - block_col:c_1 - block_col]
 
-    profile = raster.profile
-    profile.update(transform=transform, width=raster.width * scale_factor,
-                   height=raster.height * scale_factor)
+    # scale image transform
+    transform = affine * affine.scale(ratio_x, ratio_y) * \
+        Affine.translation(col_min, row_min)
 
-    return data, profile
+    return data, transform
@@ -191,8 +191,9 @@ def graph_mg(mg,geo_df_clustered, clusters_list):
     gdf_clustered_clean['NPC']=pd.Series()
     fig = go.Figure()
 
-    for cluster_n in clusters_list.Cluster:
-        gdf_clustered_clean.loc[gdf_clustered_clean['Cluster']==cluster_n,'NPC']=mg.loc[cluster_n,'Total Cost [k€]']
+    # one lookup for all the points instead of a mask per cluster
+    npc = mg.loc[clusters_list.Cluster, 'Total Cost [k€]']
+    gdf_clustered_clean['NPC'] = gdf_clustered_clean['Cluster'].map(npc)
     plot_cluster = gdf_clustered_clean
     plot_cluster = plot_cluster.to_crs(epsg=4326)
     plot_cluster.X = plot_cluster.geometry.x
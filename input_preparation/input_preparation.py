@@ -1,5 +1,7 @@
 import zipfile
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import rasterio.mask
 from osgeo import gdal
 import geopandas as gpd
@@ -7,8 +9,11 @@ import numpy as np
 import pandas as pd
 import rasterio
 from rasterio.enums import Resampling
-from shapely.geometry import Point, MultiPoint, MultiPolygon
-from shapely.ops import nearest_points
+from shapely.prepared import prep
+
+# the script runs from its own folder and shares the helpers of the gisele package of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gisele.processing import clip_mask, mesh_tiles, population_sum, road_distance, protected_area_mask
 
 
 # Define the function resample
@@ -19,7 +24,8 @@ def resample(raster, resolution,options):
     resolution -> preffered resolution of the new file
     options -> method to be used in the resampling
 
-    It returns the new raster file with the preffered resolution and options (not actually useful for anything)'''
+    It returns the array of the resampled raster together with its affine transform, so that it can be sampled in
+    memory by "sample_array" without writing it to disk.'''
     # get pixel size
     affine = raster.transform
     pixel_x = affine[0]
@@ -58,39 +64,65 @@ def resample(raster, resolution,options):
         (raster.height / data.shape[-2])
     )
 
-    profile = raster.profile
-    profile.update(transform=transform, width=raster.width * scale_factor,
-                   height=raster.height * scale_factor)
-
-    return data, profile
-
-def create_grid(crs,resolution,study_area):
+    return data, transform
+
+def sample_array(data, transform, x, y, nodata=None):
+    ''' This function samples the first band of an array returned by "resample" in all the given points at once,
+    without writing the resampled raster to disk. Points falling outside of the array get the nodata value (or 0),
+    as with the sample method of rasterio.
+    data -> array with shape (bands, rows, cols)
+    transform -> affine transform of the array
+    x, y -> arrays of coordinates of the points'''
+    eps = sys.float_info.epsilon
+    cols, rows = ~transform * (np.asarray(x, dtype=float) + eps, np.asarray(y, dtype=float) - eps)
+    rows = np.floor(rows).astype(int)
+    cols = np.floor(cols).astype(int)
+    inside = (rows >= 0) & (rows < data.shape[1]) & (cols >= 0) & (cols < data.shape[2])
+    values = np.full(rows.size, 0 if nodata is None else nodata, dtype=data.dtype)
+    values[inside] = data[0, rows[inside], cols[inside]]
+    return values
+
+def create_grid(crs,resolution,study_area,tile_size=200):
     ''' This function creates a grid of points, returning a geopandas dataframe. The input is the following:
     crs -> The preffered crs of the dataframe (according to the case study), input should be an integer.
     resolution -> The preffered resolution of the grid of points, input should be an integer.
     study_area -> This is a shapely polygon, that has to be in the preffered crs.
+    tile_size -> Number of points on each side of the square tiles of the grid clipped at a time, so that the full
+    grid is never kept in memory.
     '''
     # crs and resolution should be a numbers, while the study area is a polygon
-    df = pd.DataFrame(columns=['X', 'Y'])
     try:
         min_x=float(study_area.bounds['minx'])
         min_y=float(study_area.bounds['miny'])
         max_x=float(study_area.bounds['maxx'])
         max_y = float(study_area.bounds['maxy'])
+        area = prep(study_area.unary_union)
     except:
         min_x = float(study_area.bounds[0])
         min_y = float(study_area.bounds[1])
         max_x = float(study_area.bounds[2])
         max_y = float(study_area.bounds[3])
+        area = prep(study_area)
     # create one-dimensional arrays for x and y
     lon = np.arange(min_x, max_x, resolution)
     lat = np.arange(min_y, max_y, resolution)
-    lon, lat = np.meshgrid(lon, lat)
-    df['X'] = lon.reshape((np.prod(lon.shape),))
-    df['Y'] = lat.reshape((np.prod(lat.shape),))
-    geo_df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.X, df.Y),
+    # clip the grid one square tile at a time with "clip_mask" of gisele.processing: tiles completely inside or
+    # outside the area are not tested point by point, the others with the vectorized predicates of shapely
+    tiles = []
+    for i_0, i_1, j_0, j_1 in mesh_tiles(lon.size, lat.size, tile_size):
+        x, y = np.meshgrid(lon[i_0:i_1], lat[j_0:j_1])
+        x = x.reshape((np.prod(x.shape),))
+        y = y.reshape((np.prod(y.shape),))
+        inside = clip_mask(area, x, y)
+        if inside.any():
+            tiles.append(pd.DataFrame({'X': x[inside], 'Y': y[inside]}))
+    if tiles:
+        # points sorted by row, as in the full grid
+        df = pd.concat(tiles, ignore_index=True).sort_values(['Y', 'X'], ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=['X', 'Y'])
+    geo_df_clipped = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.X, df.Y),
                             crs=crs)
-    geo_df_clipped = gpd.clip(geo_df,study_area)
     #geo_df_clipped.to_file(r'Test\grid_of_points.shp')
     return geo_df_clipped
 
@@ -126,30 +158,16 @@ def rasters_to_points(study_area,crs,resolution_points,dir,protected_areas,stree
     # Population = rasterio.open(dir+'/Input/Population_resampled.tif')
     # ratio=Population.transform[0]/resolution_population
 
-    # Elevation
+    # Elevation, slope and land cover are already warped at the resolution of the grid by create_input_csv, so
+    # "resample" just reads them (it only interpolates rasters prepared elsewhere); they are sampled from the arrays
     elevation_Raster = rasterio.open(dir+'/Input/Elevation_' + str(crs) + '.tif')
-    data_elevation, profile_elevation = resample(elevation_Raster, resolution_points,'bilinear')
-    with rasterio.open(dir+'/Input/Elevation_resampled.tif',
-                     'w', **profile_elevation) as dst:
-        dst.write(data_elevation)
-    #resolution_elevation = elevation_Raster.transform[0]
-    Elevation = rasterio.open(dir+'/Input/Elevation_resampled.tif')
-
-    # Slope
+    data_elevation, transform_elevation = resample(elevation_Raster, resolution_points,'bilinear')
+
     slope_Raster = rasterio.open(dir+'/Input/Slope_' + str(crs) + '.tif')
-    data_slope, profile_slope = resample(slope_Raster, resolution_points,'bilinear')
-    with rasterio.open(dir+'/Input/Slope_resampled.tif',
-                     'w', **profile_slope) as dst:
-        dst.write(data_slope)
-    Slope = rasterio.open(dir+'/Input/Slope_resampled.tif')
+    data_slope, transform_slope = resample(slope_Raster, resolution_points,'bilinear')
 
-    #Landcover
     landcover_Raster = rasterio.open(dir+'/Input/LandCover_' + str(crs) + '.tif')
-    data_landcover, profile_landcover = resample(landcover_Raster, resolution_points,'mode')
-    with rasterio.open(dir+'/Input/Landcover_resampled.tif',
-                     'w', **profile_landcover) as dst:
-        dst.write(data_landcover)
-    LandCover = rasterio.open(dir+'/Input/Landcover_resampled.tif')
+    data_landcover, transform_landcover = resample(landcover_Raster, resolution_points,'mode')
     resolution_landcover=landcover_Raster.transform[0]
 
     '''Create a dataframe for the final grid of points '''
@@ -159,72 +177,36 @@ def rasters_to_points(study_area,crs,resolution_points,dir,protected_areas,stree
 
 
     '''Sample the rasters '''
-    coords = [(x, y) for x, y in zip(pointData.X, pointData.Y)]
     pointData = pointData.reset_index(drop=True)
     pointData['ID'] = pointData.index
-    pointData['Elevation'] = [x[0] for x in Elevation.sample(coords)]
+    pointData['Elevation'] = sample_array(data_elevation, transform_elevation, pointData.X.values,
+                                          pointData.Y.values, elevation_Raster.nodata)
     pointData.loc[pointData.Elevation<0,'Elevation']=0
     print('Elevation finished')
-    pointData['Slope'] = [x[0] for x in Slope.sample(coords)]
+    pointData['Slope'] = sample_array(data_slope, transform_slope, pointData.X.values,
+                                      pointData.Y.values, slope_Raster.nodata)
     print('Slope finished')
     # pointData['Population'] = [x[0]*pow(ratio,2) for x in Population.sample(coords)]
     # pointData['Population']=pointData['Population'].round(decimals=0)
-    print('Population finished')
-    pointData['Land_cover'] = [x[0] for x in LandCover.sample(coords)]
+    pointData['Land_cover'] = sample_array(data_landcover, transform_landcover, pointData.X.values,
+                                           pointData.Y.values, landcover_Raster.nodata)
     print('Land cover finished')
-    pointData['Protected_area'] = [ x for x in protected_areas['geometry'].contains(pointData.geometry)]
+    pointData['Protected_area'] = protected_area_mask(protected_areas,
+                                                      pointData.X.values,
+                                                      pointData.Y.values,
+                                                      resolution_points)
     print('Protected area finished')
     #nearest_geoms = nearest_points(pointData.geometry, streets)
     #pointData['Road_dist'] = [ x for x in nearest_geoms[0].distance(nearest_geoms[1])]
     #pointData.to_csv('Test/test.csv')
-    '''Start iterating through the points to assign values from each raster  regarding distance to roads'''
-    road_distances=[]
-    for index, point in pointData.iterrows():
-        #print(point['geometry'])
-        #print(point['geometry'].xy[0][0],point['geometry'].xy[1][0])
-        x = point['geometry'].xy[0][0]
-        y = point['geometry'].xy[1][0]
-        '''Sample population in that exact same point(maybe we will need to find it as the average of the 9 points around'''
-        #row, col = Population.index(x,y)
-        #Pop=Population.read(1)[row,col]*pow(ratio,2) # because the population was resampled according to the average value, now we need to multiply
-
-        #row, col= Elevation.index(x,y)
-        #elevation = Elevation.read(1)[row,col]
-
-        #row, col = Slope.index(x,y)
-        #slope= Slope.read(1)[row,col]
-
-        #row, col = LandCover.index(x,y)
-        #landcover=LandCover.read(1)[row,col]
-
-        #protected=protected_areas['geometry'].contains(Point(x,y)).any()
-        if resolution_population <= resolution_points:
-            row_min, column_max = population_Raster.\
-                index(x + resolution_points/2, y + resolution_points/2)
-            row_max, column_min = population_Raster.\
-                index(x - resolution_points / 2, y - resolution_points / 2)
-            value = population_array[0, row_min:row_max,
-                               column_min:column_max].sum().sum()
-            pointData.loc[index, 'Population'] = value
-        else:
-            x, y = population_Raster.index(x, y)
-            # better assign to the center
-            pointData.loc[index, 'Population'] = \
-                population_array[0, x, y]/resolution_population * resolution_points
-
-        nearest_geoms = nearest_points(Point(x,y), streets)
-        road_distance = nearest_geoms[0].distance(nearest_geoms[1])
-        road_distances.append(road_distance)
-        #print(index)
-        print('\r' + str(index) + '/' + str(pointData.index.__len__()),
-              sep=' ', end='', flush=True)
-        '''Add a point in the starting dataframe with all the information '''
-        #df2 = pd.DataFrame([[int(index),x,y,elevation,slope,round(Pop),landcover,road_distance,0,protected]],
-        #                    columns=['ID', 'X', 'Y', 'Elevation', 'Slope',
-        #                        'Population', 'Land_cover', 'Road_dist',
-        #                        'River_flow', 'Protected_area'])
-        #df=df.append(df2)
-    pointData['Road_dist']=road_distances
+    '''Population of each point, summed over the pixels falling in its cell (or shared by area with the pixels it
+    overlaps when the population raster is coarser than the grid)'''
+    pointData['Population'] = population_sum(population_array, population_Raster.transform, pointData.X.values,
+                                             pointData.Y.values, resolution_points)
+    print('Population finished')
+    pointData['Road_dist'] = road_distance(pointData.X.values,
+                                           pointData.Y.values, streets,
+                                           resolution_points)
     pointData['River_flow'] = ""
 
     geo_df = gpd.GeoDataFrame(pointData, geometry=gpd.points_from_xy(pointData.X, pointData.Y),
@@ -247,6 +229,26 @@ def locate_file(database,folder,extension):
         if extension in file:
             path = os.path.join(root, file)
             return path
+
+def warp_layer(source, output, crs_str, cutline, resolution=None, resampling='near'):
+    '''This function prepares a raster layer for the analysis in a single gdal warp: the raster is cropped to the study
+    area, re-projected and, if a resolution is given, re-sampled at the same time, without intermediate files.
+    source -> path of the raster in the database
+    output -> path of the prepared raster
+    crs_str -> target crs, as a string (e.g. epsg:21095)
+    cutline -> path (it can be a /vsimem/ path) of a vector file with the polygon used to crop the raster
+    resolution -> target resolution, if None the resolution of the source is kept
+    resampling -> gdal resampling algorithm (near, bilinear, mode, average..)'''
+    if resolution is None:
+        options = gdal.WarpOptions(format='GTiff', dstSRS=crs_str, cutlineDSName=cutline, cropToCutline=True,
+                                   resampleAlg=resampling, multithread=True)
+    else:
+        options = gdal.WarpOptions(format='GTiff', dstSRS=crs_str, cutlineDSName=cutline, cropToCutline=True,
+                                   xRes=resolution, yRes=resolution, resampleAlg=resampling, multithread=True)
+    warp = gdal.Warp(output, source, options=options)
+    warp = None  # Closes the files
+    return output
+
 '''Set parameters for the analysis - by the user'''
 
 def create_input_csv():
@@ -298,7 +300,6 @@ def create_input_csv():
     # Create a small buffer to avoid issues
     study_area_buffered=study_area.buffer((resolution*0.1/11250)/2)
 
-    study_area_buffered_list=[study_area_buffered] # this is to fix the issue with Polygon not being iterable when using rasterio
     '''Clip the protected areas'''
     protected_areas_clipped=gpd.clip(protected_areas,study_area_crs)
     streets_clipped = gpd.clip(streets,study_area_crs)
@@ -311,114 +312,24 @@ def create_input_csv():
 
     if not rivers_clipped.empty:
         rivers_clipped.to_file(dir + '/Input/Rivers.shp')
-    '''Clip the elevation and then change the crs'''
-
-    elevation_file=locate_file(database,folder='Elevation',extension='.tif')
-    with rasterio.open(elevation_file,
-
-            mode='r') as src:
-        out_image, out_transform = rasterio.mask.mask(src, study_area_buffered.to_crs(src.crs), crop=True)
-        print(src.crs)
-
-    out_meta = src.meta
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-    with rasterio.open(dir+'/Input/Elevation.tif', "w", **out_meta) as dest:
-        dest.write(out_image)
-    input_raster = gdal.Open(dir+'/Input/Elevation.tif')
-    output_raster = dir+'/Input/Elevation_' + str(crs) + '.tif'
-    warp = gdal.Warp(output_raster, input_raster, dstSRS=crs_str)
-    warp = None  # Closes the files
-
-    '''Clip the slope and then change the crs'''
-
-    slope_file = locate_file(database, folder='Slope', extension='.tif')
-    with rasterio.open(slope_file,
-
-            mode='r') as src:
-        out_image, out_transform = rasterio.mask.mask(src, study_area_buffered.to_crs(src.crs), crop=True)
-        print(src.crs)
-
-    out_meta = src.meta
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-    with rasterio.open(dir+'/Input/Slope.tif', "w", **out_meta) as dest:
-        dest.write(out_image)
-    input_raster = gdal.Open(dir+'/Input/Slope.tif')
-    output_raster = dir+'/Input/Slope_' + str(crs) + '.tif'
-    warp = gdal.Warp(output_raster, input_raster, dstSRS=crs_str)
-    warp = None  # Closes the files
-
-    '''Clip the population and then change the crs'''
-
-    population_file = locate_file(database, folder='Population', extension='.tif')
-    with rasterio.open(
-            population_file,
-
-            mode='r') as src:
-        out_image, out_transform = rasterio.mask.mask(src, study_area_buffered.to_crs(src.crs), crop=True)
-        print(src.crs)
-
-    out_meta = src.meta
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-    with rasterio.open(dir+'/Input/Population.tif', "w", **out_meta) as dest:
-        dest.write(out_image)
-    # for now there is no need since the population is already in the desired crs
-    input_raster = gdal.Open(dir+'/Input/Population.tif')
-    output_raster = dir+'/Input/Population_' + str(crs) + '.tif'
-    warp = gdal.Warp(output_raster, input_raster, dstSRS=crs_str)
-    warp = None  # Closes the files
-
-    '''Clip the land cover and then change the crs'''
-
-    landcover_file = locate_file(database, folder='LandCover', extension='.tif')
-    with rasterio.open(
-            landcover_file,
-
-            mode='r') as src:
-        out_image, out_transform = rasterio.mask.mask(src, study_area_buffered.to_crs(src.crs), crop=True)
-        print(src.crs)
-
-    out_meta = src.meta
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-    with rasterio.open(dir+'/Input/LandCover.tif', "w", **out_meta) as dest:
-        dest.write(out_image)
-    input_raster = gdal.Open(dir+'/Input/LandCover.tif')
-    output_raster = dir+'/Input/LandCover_' + str(crs) + '.tif'
-    warp = gdal.Warp(output_raster, input_raster, dstSRS=crs_str)
-    warp = None  # Closes the files
-
-    '''This part transforms the roads from lines to multi points.'''
-    streets_points = []
-    for line in streets_clipped['geometry']:
-        # print(line.geometryType)
-        if line.geometryType() == 'MultiLineString':
-            for line1 in line:
-                for x in list(zip(line1.xy[0], line1.xy[1])):
-                    # print(line1)
-                    streets_points.append(x)
-        else:
-            for x in list(zip(line.xy[0], line.xy[1])):
-                # print(line)
-                streets_points.append(x)
-    streets_multipoint = MultiPoint(streets_points)
+    '''Crop, re-project and re-sample the rasters, one gdal warp for each layer. Elevation and slope are interpolated
+    at the resolution of the grid, land cover takes the most frequent class, while population keeps its own
+    resolution, since it is aggregated later on the points.'''
+    cutline = '/vsimem/study_area_' + str(crs) + '.geojson'
+    gdal.FileFromMemBuffer(cutline, study_area_buffered.to_crs(epsg=4326).to_json())
+    layers = [('Elevation', resolution, 'bilinear'), ('Slope', resolution, 'bilinear'),
+              ('Population', None, 'near'), ('LandCover', resolution, 'mode')]
+    with ThreadPoolExecutor(max_workers=len(layers)) as executor:
+        futures = [executor.submit(warp_layer, locate_file(database, folder=folder, extension='.tif'),
+                                   dir + '/Input/' + folder + '_' + str(crs) + '.tif', crs_str, cutline,
+                                   layer_resolution, resampling)
+                   for folder, layer_resolution, resampling in layers]
+        for future in futures:
+            print(future.result())
+    gdal.Unlink(cutline)
 
     # Finally, using the "rasters_to_points" function, create and populate the grid of points for the area of interest.
-    df, geo_df = rasters_to_points(study_area_crs, crs, resolution, dir,protected_areas_clipped,streets_multipoint)
+    df, geo_df = rasters_to_points(study_area_crs, crs, resolution, dir,protected_areas_clipped,streets_clipped)
     geo_df.to_file(dir+'/Input/grid_of_points.shp')
 
     geo_df=geo_df.reset_index(drop=True)
@@ -429,15 +340,12 @@ def create_input_csv():
     df.to_csv(dir+'/Output/grid_of_points.csv', index=False)
     return
 def delete_leftover_files(dir,crs):
+    '''This function removes the intermediate rasters written by older versions of create_input_csv, which now warps
+    each layer directly from the database.'''
     folder = dir+'/Input/'
-    os.remove(folder+'Elevation.tif')
-   # os.remove(folder + 'Elevation_'+str(crs)+'.tif')
-    os.remove(folder + 'LandCover.tif')
-   # os.remove(folder + 'LandCover_'+str(crs)+'.tif')
-    os.remove(folder + 'Population.tif')
-    #os.remove(folder + 'Population_'+str(crs)+'.tif')
-    os.remove(folder + 'Slope.tif')
-    #os.remove(folder + 'Slope_' + str(crs) + '.tif')
+    for layer in ['Elevation', 'LandCover', 'Population', 'Slope']:
+        if os.path.exists(folder + layer + '.tif'):
+            os.remove(folder + layer + '.tif')
 
 if __name__ == "__main__":
     create_input_csv()
\ No newline at end of file
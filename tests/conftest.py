@@ -0,0 +1,129 @@
+"""
+Meshes, rasters and layers shared by the tests, built as GISEle builds them
+on a regular lattice in the crs of the tests.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+from sklearn.cluster import DBSCAN
+
+
+CRS = 'EPSG:32737'
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def lattice_xy(rows, cols, resolution):
+    """ Coordinates of the nodes of a regular lattice, row by row """
+    y, x = np.mgrid[0:rows, 0:cols] * float(resolution)
+    return x.ravel() + 500000, y.ravel() + 8000000
+
+
+def lattice(rows, cols, resolution, first_id=0):
+    """ Point geodataframe of a regular lattice, as the meshes of GISEle """
+    x, y = lattice_xy(rows, cols, resolution)
+    return gpd.GeoDataFrame({'ID': np.arange(x.size) + first_id,
+                             'X': x, 'Y': y},
+                            geometry=gpd.points_from_xy(x, y), crs=CRS)
+
+
+def lattice_mesh(rows, cols, resolution, seed=0):
+    """ Points of a regular lattice with clumps of population and a rough
+    elevation, as given to the clustering """
+    rng = np.random.default_rng(seed)
+    x, y = lattice_xy(rows, cols, resolution)
+    z = rng.random(x.size) * resolution / 2
+    population = np.where(rng.random(x.size) < 0.35,
+                          rng.integers(1, 40, x.size), 0).astype(float)
+    return np.column_stack([x, y, z]), population
+
+
+def clustered_geo_df(rows, cols, resolution, seed=0):
+    """ Clustered geodataframe of a lattice mesh, as read_clustered gives
+    it """
+    pop_points, population = lattice_mesh(rows, cols, resolution, seed)
+    labels = DBSCAN(eps=1.5 * resolution, min_samples=60).fit(
+        pop_points, sample_weight=population).labels_
+    geo_df = gpd.GeoDataFrame(
+        {'ID': np.arange(len(population)), 'X': pop_points[:, 0],
+         'Y': pop_points[:, 1], 'Population': population, 'Cluster': labels},
+        geometry=gpd.points_from_xy(pop_points[:, 0], pop_points[:, 1]),
+        crs=CRS)
+    clusters_list = pd.DataFrame({'Cluster': np.unique(labels[labels != -1])})
+    return geo_df, clusters_list
+
+
+def clustered_mesh(rows, cols, resolution, seed=0):
+    """ Lattice with population, elevation, weight and a few rectangular
+    clusters separated by noise, as the clustered meshes of GISEle """
+    rng = np.random.default_rng(seed)
+    geo_df = lattice(rows, cols, resolution, first_id=10)
+    x, y = geo_df['X'].values, geo_df['Y'].values
+    cluster = np.where(rng.random(x.size) < 0.3, -1,
+                       (x - x.min()) // (resolution * 7)
+                       + 3 * ((y - y.min()) // (resolution * 6)))
+    geo_df['Population'] = rng.integers(0, 30, x.size).astype(float)
+    geo_df['Elevation'] = rng.random(x.size) * 200
+    geo_df['Weight'] = rng.random(x.size) + 1
+    geo_df['Cluster'] = cluster.astype(int)
+    return geo_df[['ID', 'X', 'Y', 'Population', 'Elevation', 'Weight',
+                   'Cluster', 'geometry']]
+
+
+def weighted_mesh(rows, cols, resolution, seed=0):
+    """ Lattice moved by up to a tenth of the resolution, with elevation and
+    weight, so that the diagonals are close to the length limit """
+    geo_df = lattice(rows, cols, resolution)
+    rng = np.random.default_rng(seed)
+    geo_df['X'] += rng.uniform(-0.1, 0.1, len(geo_df)) * resolution
+    geo_df['Y'] += rng.uniform(-0.1, 0.1, len(geo_df)) * resolution
+    geo_df['Elevation'] = rng.random(len(geo_df)) * 100
+    geo_df['Weight'] = rng.random(len(geo_df)) + 1
+    geo_df['geometry'] = gpd.points_from_xy(geo_df.X, geo_df.Y)
+    return geo_df
+
+
+def mesh_points(resolution, bounds=(500700, 7991500, 511300, 7999000)):
+    """ Coordinates of a regular mesh inside the study area of the
+    datasets """
+    x, y = np.meshgrid(np.arange(bounds[0], bounds[2], resolution),
+                       np.arange(bounds[1], bounds[3], resolution))
+    return x.ravel().astype(float), y.ravel().astype(float)
+
+
+def write_raster(path, data, pixel, origin=(500000, 8000000)):
+    """ Write a one-band raster in the crs of the tests """
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[0],
+                       width=data.shape[1], count=1, dtype=data.dtype,
+                       crs=CRS, transform=from_origin(origin[0], origin[1],
+                                                     pixel, pixel)) as dest:
+        dest.write(data, 1)
+    return path
+
+
+def study_datasets(folder, seed=0):
+    """ Layers of a study area of 12 x 9 km, as given by prepare_datasets """
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:300, 0:400]
+    elevation = (200 + 80 * np.sin(rows / 23) * np.cos(cols / 31) +
+                 rng.random((300, 400))).astype('float32')
+    slope = (rng.random((300, 400)) * 20).astype('float32')
+    land_cover = rng.integers(10, 200, (90, 120)).astype('uint8')
+    population = (rng.random((900, 1200)) *
+                  (rng.random((900, 1200)) < 0.1) * 5).astype('float32')
+    streets = gpd.GeoDataFrame(geometry=[
+        LineString([(500500, 7992000), (510000, 7999500)]),
+        LineString([(503000, 7991200), (503500, 7998000),
+                    (511500, 7996000)])], crs=CRS)
+    return {'elevation': write_raster(os.path.join(folder, 'el.tif'),
+                                      elevation, 30),
+            'slope': write_raster(os.path.join(folder, 'sl.tif'), slope, 30),
+            'land_cover': write_raster(os.path.join(folder, 'lc.tif'),
+                                       land_cover, 100),
+            'population': write_raster(os.path.join(folder, 'pop.tif'),
+                                       population, 10),
+            'streets': streets, 'protected_areas': None}
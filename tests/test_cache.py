@@ -0,0 +1,121 @@
+"""
+Tests of the mesh cache: a cached mesh must be the mesh that would be
+computed again from the same inputs.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+import geopandas as gpd
+from shapely.geometry import box
+from gisele import cache
+
+
+class TestMeshCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.folder, 'Cache')
+        self.source = os.path.join(self.folder, 'Datasets')
+        os.makedirs(os.path.join(self.source, 'Mesh'))
+        self.write('Mesh/part_0.csv', 'X,Y\n1,2\n')
+        self.write('geo_df_json', '{"type": "FeatureCollection"}')
+        self.study_area = gpd.GeoDataFrame(
+            geometry=[box(500000, 7990000, 510000, 8000000)],
+            crs='EPSG:32737')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, file, text, folder=None):
+        with open(os.path.join(folder or self.source, file), 'w') as f:
+            f.write(text)
+
+    def read(self, file, folder):
+        with open(os.path.join(folder, file)) as f:
+            return f.read()
+
+    def key(self, **changes):
+        arguments = {'study_area': self.study_area, 'crs': 32737,
+                     'resolution': 200, 'landcover_option': 'GLC',
+                     'inputs': [os.path.join(self.source, 'Mesh')],
+                     'options': (0,)}
+        arguments.update(changes)
+        return cache.mesh_key(**arguments)
+
+    def test_key_follows_the_inputs(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        self.assertEqual(self.key(study_area=self.study_area.to_crs(4326)),
+                         key)
+        changed = [self.key(resolution=100), self.key(crs=21097),
+                   self.key(landcover_option='CGLS'), self.key(options=(1,)),
+                   self.key(study_area=gpd.GeoDataFrame(
+                       geometry=[box(500000, 7990000, 510000, 7999000)],
+                       crs='EPSG:32737')),
+                   self.key(inputs=[os.path.join(self.folder, 'missing')])]
+        self.write('Mesh/part_0.csv', 'X,Y\n1,3\n')
+        changed.append(self.key())
+        self.assertEqual(len(set(changed + [key])), len(changed) + 1)
+
+    def test_key_follows_the_downloaded_layers(self):
+        layers = os.path.join(self.folder, 'Layers')
+        os.makedirs(layers)
+
+        def download(text, dbf_date):
+            # a layer zipped again and a table with a new date of update
+            with zipfile.ZipFile(os.path.join(layers, 'Layer.zip'),
+                                 'w') as archive:
+                archive.writestr(zipfile.ZipInfo(
+                    'layer.tif', time.localtime()[:6]), text)
+            with open(os.path.join(layers, 'roads.dbf'), 'wb') as f:
+                f.write(b'\x03' + dbf_date + b'\x00' * 4 + text.encode())
+            return self.key(inputs=[layers])
+
+        key = download('same data', b'\x7a\x01\x01')
+        time.sleep(2)
+        self.assertEqual(download('same data', b'\x7a\x0a\x12'), key)
+        self.assertNotEqual(download('new data', b'\x7a\x0a\x12'), key)
+
+    def test_load_gives_the_stored_files(self):
+        key = self.key()
+        self.assertIsNone(cache.load_mesh(key, self.source, self.cache_dir))
+        cache.store_mesh(key, ['Mesh', 'geo_df_json'], self.source,
+                         self.cache_dir, n_points=1)
+        destination = os.path.join(self.folder, 'Output')
+        meta = cache.load_mesh(key, destination, self.cache_dir)
+        self.assertEqual(meta['n_points'], 1)
+        for file in ('Mesh/part_0.csv', 'geo_df_json'):
+            self.assertEqual(self.read(file, destination),
+                             self.read(file, self.source))
+
+    def test_least_recently_used_evicted_first(self):
+        keys = [self.key(resolution=resolution) for resolution in (1, 2, 3)]
+        for key in keys:
+            cache.store_mesh(key, ['Mesh'], self.source, self.cache_dir)
+        size = cache.entry_size(os.path.join(self.cache_dir, keys[0]))
+        # an incomplete entry, without meta file
+        os.makedirs(os.path.join(self.cache_dir, 'incomplete'))
+        # the first entry becomes the most recently used
+        for key, last_used in zip(keys, (30, 10, 20)):
+            meta_file = os.path.join(self.cache_dir, key, cache.META_FILE)
+            with open(meta_file) as f:
+                meta = json.load(f)
+            meta['last_used'] = last_used
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+        cache.evict(2 * size, self.cache_dir)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([keys[0], keys[2]]))
+        # the entry just stored is kept even if larger than the cache
+        cache.store_mesh(keys[1], ['Mesh'], self.source, self.cache_dir,
+                         max_size=0)
+        self.assertEqual(os.listdir(self.cache_dir), [keys[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
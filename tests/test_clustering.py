@@ -0,0 +1,307 @@
+"""
+Tests of the clustering engines, compared with DBSCAN on the same points.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from sklearn.cluster import DBSCAN
+from gisele import clustering
+from conftest import lattice_mesh, clustered_geo_df
+
+
+class TestLatticeClusters(unittest.TestCase):
+
+    def test_same_labels_as_dbscan(self):
+        resolution = 100
+        pop_points, population = lattice_mesh(40, 50, resolution)
+        for eps, pts in [(150, 60), (150, 100), (210, 120), (210, 150),
+                         (320, 300)]:
+            expected = DBSCAN(eps=eps, min_samples=pts).fit(
+                pop_points, sample_weight=population).labels_
+            labels = clustering.lattice_clusters(pop_points, population,
+                                                 resolution, eps, pts)
+            self.assertGreater(labels.max(), 5)
+            np.testing.assert_array_equal(labels, expected)
+
+    def test_points_off_the_lattice(self):
+        resolution = 100
+        pop_points, population = lattice_mesh(30, 30, resolution, seed=1)
+        # points a few metres away from their node, as after a reprojection
+        pop_points[:, :2] += np.random.default_rng(2).uniform(
+            -5, 5, (len(pop_points), 2))
+        expected = DBSCAN(eps=205, min_samples=120).fit(
+            pop_points, sample_weight=population).labels_
+        labels = clustering.lattice_clusters(pop_points, population,
+                                             resolution, 205, 120)
+        np.testing.assert_array_equal(labels, expected)
+
+    def test_no_core_points(self):
+        pop_points, population = lattice_mesh(10, 10, 100)
+        labels = clustering.lattice_clusters(pop_points, population, 100,
+                                             150, 10 ** 6)
+        self.assertTrue((labels == -1).all())
+
+
+class TestTiledClusters(unittest.TestCase):
+
+    def test_same_labels_as_dbscan(self):
+        pop_points, population = lattice_mesh(45, 60, 100, seed=4)
+        rng = np.random.default_rng(5)
+        pop_points[:, :2] += rng.uniform(-20, 20, (len(pop_points), 2))
+        for eps, pts, tile_length in [(150, 60, 300), (150, 60, 1000),
+                                      (210, 120, 500), (320, 300, 2000),
+                                      (320, 300, 10000)]:
+            expected = DBSCAN(eps=eps, min_samples=pts).fit(
+                pop_points, sample_weight=population).labels_
+            labels = clustering.tiled_clusters(pop_points, population, eps,
+                                               pts, tile_length, n_jobs=1)
+            self.assertGreater(labels.max(), 2)
+            np.testing.assert_array_equal(labels, expected)
+
+    def test_no_core(self):
+        pop_points, population = lattice_mesh(10, 10, 100)
+        labels = clustering.tiled_clusters(pop_points, population, 150,
+                                           10 ** 6, 500, n_jobs=1)
+        np.testing.assert_array_equal(labels, -1)
+
+
+class TestClusterMap(unittest.TestCase):
+
+    def setUp(self):
+        self.geo_df, self.clusters_list = clustered_geo_df(40, 50, 100)
+        # a cluster not listed is shown as noise
+        self.clusters_list = self.clusters_list.iloc[1:]
+
+    def markers(self, trace):
+        return np.sort(np.column_stack([trace.lon, trace.lat]), axis=0)
+
+    def test_same_points_as_one_trace_per_cluster(self):
+        fig = clustering.plot_clusters(self.geo_df, self.clusters_list)
+        clusters, population = fig.data
+        listed = self.geo_df[self.geo_df.Cluster.isin(
+            self.clusters_list.Cluster)].to_crs(epsg=4326)
+        populated = self.geo_df[self.geo_df.Population > 0]\
+            .to_crs(epsg=4326)
+        self.assertGreater(listed.Cluster.nunique(), 2)
+        np.testing.assert_allclose(
+            self.markers(clusters),
+            np.sort(np.column_stack([listed.geometry.x, listed.geometry.y]),
+                    axis=0))
+        np.testing.assert_array_equal(np.sort(clusters.text),
+                                      np.sort(listed.Cluster))
+        np.testing.assert_allclose(
+            self.markers(population),
+            np.sort(np.column_stack([populated.geometry.x,
+                                     populated.geometry.y]), axis=0))
+
+    def test_decimated_layers(self):
+        points = clustering.map_points(self.geo_df, self.clusters_list)
+        for max_points in (50, 300):
+            fig = clustering.render_clusters(points, max_points=max_points)
+            clusters, population = fig.data
+            self.assertLessEqual(len(clusters.lon), max_points)
+            self.assertLessEqual(len(population.lon), max_points)
+            self.assertEqual(set(clusters.text),
+                             set(self.clusters_list.Cluster))
+            self.assertAlmostEqual(np.sum(population.text),
+                                   self.geo_df.Population.sum(), delta=1)
+
+    def test_update_after_an_edit(self):
+        points = clustering.map_points(self.geo_df, self.clusters_list)
+        geo_df = self.geo_df.copy()
+        changed = (geo_df.Cluster == self.clusters_list.Cluster.iloc[0])\
+            .values
+        geo_df.loc[changed, 'Cluster'] = self.clusters_list.Cluster.iloc[1]
+        pd.testing.assert_frame_equal(
+            clustering.update_map_points(points, geo_df, changed),
+            clustering.map_points(geo_df, self.clusters_list))
+
+
+class TestClusterEdits(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.geo_df, clusters_list = clustered_geo_df(40, 50, 100)
+        self.geo_df['Elevation'] = 0.
+        population = self.geo_df.groupby('Cluster')['Population'].sum()
+        clusters_list['Population'] = population[clusters_list.Cluster]\
+            .values.round()
+        clusters_list['Load [kW]'] = clusters_list['Population'] * 0.7
+        clusters_list.index = clusters_list['Cluster'].values
+        self.clusters_list = clusters_list
+        self.assertGreater(len(clusters_list), 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_parse_clusters(self):
+        for value, expected in [('3-5', [3, 5]), ('3, 5,', [3, 5]),
+                                (7.0, [7]), (np.nan, []), (None, []),
+                                ('', []), (' ', [])]:
+            self.assertEqual(clustering.parse_clusters(value), expected)
+
+    def test_merge_same_as_relabelling(self):
+        c = list(self.clusters_list.Cluster)
+        merges = [(c[0], c[1]), (c[3], c[2])]
+        expected = self.geo_df['Cluster'].copy()
+        for kept, merged in merges:
+            expected[expected == merged] = kept
+        before = self.geo_df['Cluster'].values.copy()
+        clusters_list, changed = clustering.merge_clusters(
+            self.geo_df, self.clusters_list, merges)
+        np.testing.assert_array_equal(self.geo_df['Cluster'], expected)
+        np.testing.assert_array_equal(changed, before != expected.values)
+        self.assertEqual(sorted(clusters_list.Cluster),
+                         sorted(set(c) - {c[1], c[2]}))
+        self.assertEqual(clusters_list.loc[c[0], 'Population'],
+                         self.clusters_list.Population[[c[0], c[1]]].sum())
+
+    def test_merge_chain(self):
+        c = list(self.clusters_list.Cluster)
+        clusters_list, changed = clustering.merge_clusters(
+            self.geo_df, self.clusters_list, [(c[0], c[1]), (c[1], c[2])])
+        self.assertEqual(set(self.geo_df.Cluster) - {-1},
+                         set(c) - {c[1], c[2]})
+        self.assertEqual(clusters_list.loc[c[0], 'Population'],
+                         self.clusters_list.Population[c[:3]].sum())
+
+    def test_split_same_as_dbscan(self):
+        cluster = self.geo_df.Cluster.value_counts().drop(-1).index[0]
+        before = self.geo_df['Cluster'].values.copy()
+        inside = before == cluster
+        points = self.geo_df[['X', 'Y', 'Elevation']].values[inside]
+        population = self.geo_df['Population'].values[inside]
+        parts = DBSCAN(eps=100, min_samples=40).fit(
+            points, sample_weight=population).labels_
+        self.assertGreater(parts.max(), 0)
+        clusters_list, changed = clustering.split_clusters(
+            self.geo_df, self.clusters_list, [cluster], 100, 40, 0.7)
+        labels = self.geo_df['Cluster'].values
+        np.testing.assert_array_equal(labels[~inside], before[~inside])
+        np.testing.assert_array_equal(changed, labels != before)
+        # the same partition of the points DBSCAN keeps, the first part
+        # keeping the ID of the cluster
+        new = labels[inside]
+        self.assertEqual(new[parts == 0][0], cluster)
+        for part in range(parts.max() + 1):
+            self.assertEqual(len(set(new[parts == part])), 1)
+        self.assertEqual(len(set(new)), parts.max() + 1)
+        self.assertEqual(clusters_list.loc[list(set(new)),
+                                           'Population'].sum(),
+                         sum(round(population[new == n].sum())
+                             for n in set(new)))
+
+    def test_saved_edits_same_as_the_whole_file(self):
+        self.geo_df.to_file(os.path.join(self.folder,
+                                         'geo_df_clustered.json'),
+                            driver='GeoJSON')
+        # IDs in another order than the points
+        self.geo_df = self.geo_df.iloc[::-1]
+        c = list(self.clusters_list.Cluster)
+        clusters_list = clustering.merge_clusters(
+            self.geo_df, self.clusters_list, [(c[0], c[1])])[0]
+        edits = pd.DataFrame({'Action': ['merge'], 'Cluster': [c[0]],
+                              'Clusters': [str(c[1])]})
+        clustering.save_edits(self.geo_df, clusters_list, edits,
+                              self.folder)
+        clustering.save_edits(self.geo_df, clusters_list, edits,
+                              self.folder)
+        expected = os.path.join(self.folder, 'expected.json')
+        self.geo_df.sort_index().to_file(expected, driver='GeoJSON')
+        pd.testing.assert_frame_equal(
+            clustering.read_clustered(self.folder), gpd.read_file(expected),
+            check_dtype=False)
+        self.assertEqual(len(pd.read_csv(os.path.join(self.folder,
+                                                      'edits.csv'))), 2)
+        # without the edits, the clusters are the ones of the whole file
+        clustering.clear_edits(self.folder)
+        self.assertIn(c[1], clustering.read_clustered(self.folder)
+                      .Cluster.values)
+
+
+def dbscan_statistics(pop_points, population, resolution, eps, pts):
+    """ Statistics of a combination of the sensitivity analysis computed as
+    the original sensitivity did, with a DBSCAN run """
+    labels = DBSCAN(eps=eps, min_samples=pts, metric='euclidean').fit(
+        pop_points, sample_weight=population).labels_
+    n_clusters_ = int(len(set(labels)) - (1 if -1 in labels else 0))
+    total_people = int(population.sum())
+    noise_people = round(sum(population[labels == -1]), 0)
+    clustered_area = (len(labels) - (labels == -1).sum()) * \
+        (resolution / 1000) ** 2
+    perc_area = int(clustered_area / len(labels) * 100)
+    clustered_people = int((1 - noise_people / total_people) * 100)
+    if clustered_area != 0:
+        people_area = (total_people - noise_people) / clustered_area
+    else:
+        people_area = 0
+    return n_clusters_, clustered_people, perc_area, people_area
+
+
+class TestSensitivity(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.folder, 'results.csv')
+        self.resolution = 100
+        self.pop_points, self.population = lattice_mesh(25, 30,
+                                                        self.resolution)
+        self.geo_df = pd.DataFrame({'Population': self.population})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def steps(self, span_eps, span_pts, engine='dbscan'):
+        return list(clustering.sensitivity_steps(
+            self.resolution, self.pop_points, self.geo_df, span_eps,
+            span_pts, engine, n_jobs=1, cache_file=self.cache_file))
+
+    def check_engine(self, engine):
+        span_eps, span_pts = [100, 150, 200, 230, 320], [20, 60, 120, 300]
+        results = {}
+        for step in self.steps(span_eps, span_pts, engine):
+            results.update(step)
+        self.assertEqual(len(results), len(span_eps) * len(span_pts))
+        for cell, result in results.items():
+            expected = dbscan_statistics(self.pop_points, self.population,
+                                         self.resolution, *cell)
+            self.assertEqual(tuple(result)[:3], expected[:3], cell)
+            self.assertAlmostEqual(result[3], expected[3])
+
+    def test_shared_graph_same_as_dbscan(self):
+        self.check_engine('dbscan')
+
+    def test_reachability_same_as_dbscan(self):
+        self.check_engine('reachability')
+
+    def test_repeated_values(self):
+        span_eps, span_pts = clustering.sensitivity_spans([150, 151],
+                                                          [60, 61], 4)
+        results = {}
+        for step in self.steps(span_eps, span_pts):
+            results.update(step)
+        tables = clustering.sensitivity_tables(results, span_eps, span_pts)
+        self.assertEqual(tables[0].shape, (2, 2))
+        fig = clustering.sensitivity_plot(*tables)
+        self.assertEqual(sum(len(trace.x) for trace in fig.data), 4)
+
+    def test_cached_results_first(self):
+        self.steps([150, 210], [60, 100])
+        steps = self.steps([150, 210, 260], [60, 100])
+        self.assertEqual(set(steps[0]), {(150, 60), (150, 100), (210, 60),
+                                         (210, 100)})
+        self.assertEqual(set(steps[1]), {(260, 60), (260, 100)})
+        for cell, result in steps[0].items():
+            expected = dbscan_statistics(self.pop_points, self.population,
+                                         self.resolution, *cell)
+            self.assertEqual(tuple(result)[:3], expected[:3])
+            self.assertAlmostEqual(result[3], expected[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+"""
+Tests of the helpers of gisele.functions, compared with the straightforward
+implementations they replaced.
+"""
+
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, box
+from gisele import functions
+from conftest import clustered_mesh
+
+
+def aggregate_loop(geo_df, resolution, factor):
+    """ Same aggregation of aggregate_mesh, with a polygon per block and a
+    point-in-polygon test as in the old reduce_resolution """
+    x0, y0 = geo_df['X'].min(), geo_df['Y'].min()
+    side = factor * resolution
+    rows = []
+    for bx in range(int((geo_df['X'].max() - x0) // side) + 1):
+        for by in range(int((geo_df['Y'].max() - y0) // side) + 1):
+            cell = box(x0 + bx * side - resolution / 2,
+                       y0 + by * side - resolution / 2,
+                       x0 + (bx + 1) * side - resolution / 2,
+                       y0 + (by + 1) * side - resolution / 2)
+            inner = geo_df[geo_df.within(cell)]
+            if inner.empty:
+                continue
+            centre = cell.centroid
+            clustered = inner[inner.Cluster != -1]
+            if clustered.empty:
+                cluster = -1
+                candidates = inner
+            else:
+                counts = clustered.Cluster.value_counts()
+                cluster = counts[counts == counts.max()].index.min()
+                candidates = inner[inner.Cluster == cluster]
+            nearest = candidates.distance(centre).idxmin()
+            rows.append({'X': centre.x, 'Y': centre.y,
+                         'Population': inner.Population.sum(),
+                         'Elevation': inner.Elevation.mean(),
+                         'Weight': inner.Weight.mean(),
+                         'Cluster': cluster,
+                         'ID': candidates.loc[nearest, 'ID']})
+    return pd.DataFrame(rows)
+
+
+class TestAggregateMesh(unittest.TestCase):
+
+    def test_same_blocks_as_the_loop(self):
+        resolution = 100
+        geo_df = clustered_mesh(23, 31, resolution)
+        columns = ['X', 'Y', 'Population', 'Elevation', 'Weight', 'Cluster',
+                   'ID']
+        for factor in [1, 2, 3, 5]:
+            gdf_lr = functions.aggregate_mesh(geo_df, resolution, factor)
+            expected = aggregate_loop(geo_df, resolution, factor)
+            gdf_lr = pd.DataFrame(gdf_lr[columns]).sort_values(['X', 'Y'])
+            expected = expected[columns].sort_values(['X', 'Y'])
+            pd.testing.assert_frame_equal(gdf_lr.reset_index(drop=True),
+                                          expected.reset_index(drop=True),
+                                          check_dtype=False)
+            self.assertAlmostEqual(gdf_lr.Population.sum(),
+                                   geo_df.Population.sum())
+
+    def test_points_of_the_blocks_are_on_the_geometry(self):
+        geo_df = clustered_mesh(10, 12, 50, seed=1)
+        gdf_lr = functions.aggregate_mesh(geo_df, 50, 4)
+        np.testing.assert_allclose(gdf_lr.geometry.x, gdf_lr.X)
+        np.testing.assert_allclose(gdf_lr.geometry.y, gdf_lr.Y)
+        self.assertEqual(gdf_lr.crs, geo_df.crs)
+
+
+class TestMeshPyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.resolution = 100
+        self.clustered = clustered_mesh(31, 40, self.resolution, seed=2)
+        self.geo_df = self.clustered.drop(columns='Cluster')
+        functions.mesh_pyramid(self.geo_df, self.resolution,
+                               folder=self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def level(self, factor, geo_df_clustered=None):
+        return functions.mesh_level(factor, self.geo_df, self.resolution,
+                                    geo_df_clustered, self.folder)
+
+    def test_levels_same_as_aggregate(self):
+        for factor in (1, 3, 9):
+            for mesh in (self.geo_df, self.clustered):
+                clustered = mesh if 'Cluster' in mesh.columns else None
+                gdf_lr = self.level(factor, clustered)
+                self.assertEqual(gdf_lr.crs, mesh.crs)
+                expected = functions.aggregate_mesh(mesh, self.resolution,
+                                                    factor)
+                self.assertEqual(list(gdf_lr.columns),
+                                 list(expected.columns))
+                gdf_lr, expected = [
+                    pd.DataFrame(df.drop(columns='geometry'))
+                    .sort_values(['X', 'Y']).reset_index(drop=True)
+                    for df in (gdf_lr, expected)]
+                pd.testing.assert_frame_equal(gdf_lr, expected,
+                                              check_dtype=False)
+
+    def test_stored_levels_not_aggregated_again(self):
+        with mock.patch.object(functions, 'aggregate_mesh',
+                               side_effect=AssertionError):
+            for factor in (1, 3, 9):
+                self.level(factor, self.clustered)
+
+    def test_nearest_level(self):
+        sizes = {factor: len(self.level(factor)) for factor in (1, 3, 9)}
+        for factor, level in [(2, 1), (4, 3), (6, 3), (7, 9), (20, 9)]:
+            self.assertEqual(len(self.level(factor, self.clustered)),
+                             sizes[level])
+
+    def test_missing_level_built_and_stored(self):
+        shutil.rmtree(self.folder)
+        gdf_lr = self.level(3, self.clustered)
+        self.assertEqual(len(gdf_lr), len(functions.aggregate_mesh(
+            self.geo_df, self.resolution, 3)))
+        with mock.patch.object(functions, 'aggregate_mesh',
+                               side_effect=AssertionError):
+            self.level(3, self.clustered)
+
+
+class TestClusterIndex(unittest.TestCase):
+
+    def test_same_points_as_the_masks(self):
+        geo_df = clustered_mesh(30, 40, 100, seed=4)
+        # rows not sorted and an index not starting from 0
+        geo_df = geo_df.sample(frac=1, random_state=0)
+        geo_df.index = geo_df.index * 3 + 7
+        geo_df.loc[geo_df.Cluster == 2, 'Population'] = 0
+        clusters = functions.cluster_index(geo_df)
+        table = clusters[1]
+        self.assertEqual(list(table.index),
+                         sorted(geo_df.Cluster.unique()))
+        for cluster_n in list(table.index) + [1000]:
+            expected = geo_df[geo_df['Cluster'] == cluster_n]
+            pd.testing.assert_frame_equal(
+                functions.cluster_points(geo_df, clusters, cluster_n),
+                expected)
+            if expected.empty:
+                continue
+            self.assertEqual(table.at[cluster_n, 'Size'], len(expected))
+            self.assertAlmostEqual(table.at[cluster_n, 'Population'],
+                                   expected.Population.sum())
+            self.assertEqual(table.at[cluster_n, 'Min_x'], expected.X.min())
+            self.assertEqual(table.at[cluster_n, 'Max_y'], expected.Y.max())
+            weight = expected.Population if expected.Population.sum() > 0 \
+                else np.ones(len(expected))
+            self.assertAlmostEqual(table.at[cluster_n, 'X'],
+                                   np.average(expected.X, weights=weight))
+            self.assertAlmostEqual(table.at[cluster_n, 'Y'],
+                                   np.average(expected.Y, weights=weight))
+
+    def test_empty(self):
+        geo_df = clustered_mesh(3, 3, 100).iloc[[]]
+        clusters = functions.cluster_index(geo_df)
+        self.assertTrue(clusters[1].empty)
+        self.assertTrue(functions.cluster_points(geo_df, clusters, 0).empty)
+
+
+def create_box_within(limits, df):
+    """ create_box with the within test on the whole dataframe """
+    x_min, x_max = min(limits.X), max(limits.X)
+    y_min, y_max = min(limits.Y), max(limits.Y)
+    dist = Point(x_min, y_min).distance(Point(x_max, y_max))
+    if dist < 5000:
+        extension = dist
+    elif dist < 15000:
+        extension = dist * 0.6
+    else:
+        extension = dist / 4
+    bubble = box(minx=x_min - extension, maxx=x_max + extension,
+                 miny=y_min - extension, maxy=y_max + extension)
+    df_box = df[df.within(bubble)]
+    df_box.index = pd.Series(range(0, len(df_box.index)))
+    return df_box
+
+
+class TestCreateBox(unittest.TestCase):
+
+    def setUp(self):
+        functions.spatial_indexes.clear()
+        self.geo_df = clustered_mesh(80, 90, 100, seed=2)
+        rng = np.random.default_rng(3)
+        self.limits = [self.geo_df.iloc[rng.integers(0, len(self.geo_df),
+                                                     rng.integers(2, 6))]
+                       for _ in range(12)]
+
+    def check(self, df):
+        for limits in self.limits + self.limits:
+            pd.testing.assert_frame_equal(functions.create_box(limits, df),
+                                          create_box_within(limits, df))
+
+    def test_same_boxes_as_within(self):
+        self.check(self.geo_df)
+        self.check(self.geo_df.iloc[::-1])
+        self.check(self.geo_df[self.geo_df.Cluster != -1])
+
+    def test_in_place_changes(self):
+        self.check(self.geo_df)
+        self.geo_df.sort_values('Population', inplace=True)
+        self.check(self.geo_df)
+        self.geo_df.reset_index(drop=True, inplace=True)
+        self.check(self.geo_df)
+        self.geo_df['geometry'] = self.geo_df.translate(250, -120)
+        self.check(self.geo_df)
+
+    def test_no_dataframes_in_the_cache(self):
+        for i in range(functions.SPATIAL_INDEXES + 3):
+            self.check(self.geo_df.iloc[i:])
+        self.assertEqual(len(functions.spatial_indexes),
+                         functions.SPATIAL_INDEXES)
+        for entry in functions.spatial_indexes.values():
+            for value in entry.values():
+                self.assertNotIsInstance(value, pd.DataFrame)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests of the weighting of the mesh, compared with the weighting done one
+land cover class at a time.
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from gisele import initialization
+from conftest import REPOSITORY
+
+
+def weighting_loop(df, resolution, landcover_option, landcover_csv):
+    """ Weights of the points computed as weighting did before being
+    vectorized """
+    df_weighted = df.copy()
+    df_weighted['Land_cover'] = df_weighted['Land_cover'].round(0)
+    df_weighted['Weight'] = math.e ** (0.01732867951 * df_weighted['Slope'])
+    columns = {'GLC': ('GLC2000', 'WeightGLC'), 'GLCS': ('GLCS', 'WeightGLCS'),
+               'ESACCI': ('ESACCI', 'WeightESACCI'),
+               'Other': ('Other', 'WeightOther')}
+    code, weight = columns[landcover_option]
+    for i, row in landcover_csv.iterrows():
+        df_weighted.loc[df_weighted['Land_cover'] == row[code], 'Weight'] += \
+            landcover_csv.loc[i, weight]
+    df_weighted.loc[df_weighted['Road_dist'] < 1000, 'Weight'] += \
+        5 * df_weighted.loc[df_weighted['Road_dist'] < 1000,
+                            'Road_dist'] / 1000
+    df_weighted.loc[df_weighted['Road_dist'] >= 1000, 'Weight'] += 5
+    df_weighted.loc[df_weighted['Road_dist'] < resolution / 2, 'Weight'] = 1.5
+    df_weighted.loc[df_weighted['Protected_area'] == True, 'Weight'] += 5
+    return df_weighted['Weight'].values
+
+
+class TestWeighting(unittest.TestCase):
+
+    def setUp(self):
+        # weighting reads Input/Landcover.csv from the working directory
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.folder, 'Input'))
+        shutil.copy(os.path.join(REPOSITORY, 'Input', 'Landcover.csv'),
+                    os.path.join(self.folder, 'Input'))
+        self.landcover_csv = pd.read_csv(os.path.join(self.folder, 'Input',
+                                                      'Landcover.csv'))
+        os.chdir(self.folder)
+        rng = np.random.default_rng(0)
+        n = 5000
+        self.df = pd.DataFrame({
+            'ID': np.arange(n), 'X': rng.random(n) * 1e4,
+            'Y': rng.random(n) * 1e4, 'Population': rng.random(n) * 20,
+            'Elevation': rng.random(n) * 2000, 'Slope': rng.random(n) * 40,
+            'Land_cover': rng.integers(0, 230, n).astype(float),
+            'Road_dist': rng.random(n) * 2000,
+            'Protected_area': rng.random(n) < 0.2})
+        self.df.loc[::7, 'Road_dist'] = rng.random(self.df.loc[::7].shape[0]) \
+            * 100
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_weights_as_the_loop(self):
+        for landcover_option in ('GLC', 'GLCS', 'ESACCI', 'Other'):
+            expected = weighting_loop(self.df, 200, landcover_option,
+                                      self.landcover_csv)
+            df_weighted = initialization.weighting(self.df.copy(), 200,
+                                                   landcover_option)
+            self.assertEqual(list(df_weighted.columns),
+                             ['ID', 'X', 'Y', 'Population', 'Elevation',
+                              'Weight'])
+            np.testing.assert_allclose(df_weighted['Weight'], expected,
+                                       rtol=1e-6)
+
+    def test_cost_surface_replaces_the_terms(self):
+        df = self.df.copy()
+        df['Cost'] = np.linspace(1, 20, len(df))
+        df_weighted = initialization.weighting(df, 200, 'GLC')
+        near = (self.df['Road_dist'] < 100).values
+        protected = self.df['Protected_area'].values
+        expected = np.where(near, 1.5 + 5 * protected, df['Cost'])
+        self.assertTrue((near & protected).any())
+        np.testing.assert_allclose(df_weighted['Weight'], expected,
+                                   rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
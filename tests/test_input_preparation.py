@@ -0,0 +1,109 @@
+"""
+Tests of the preparation of the input layers, compared with re-projecting
+the whole source raster on the same grid.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import reproject
+from rasterio.enums import Resampling
+from shapely.geometry import Point, Polygon
+from input_preparation import input_preparation
+from conftest import CRS, write_raster
+
+
+class TestWarpLayer(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        rows, cols = np.mgrid[0:300, 0:400]
+        self.data = (200 + 80 * np.sin(rows / 23) * np.cos(cols / 31) +
+                     rng.random((300, 400))).astype('float32')
+        self.transform = from_origin(500000, 8000000, 30, 30)
+        self.source = os.path.join(self.folder, 'source.tif')
+        write_raster(self.source, self.data, 30)
+        self.area = Polygon([(502000, 7992500), (509000, 7993500),
+                             (508000, 7998000), (503000, 7997000)])
+        # the cutline is given in geographic coordinates, as in
+        # create_input_csv
+        self.cutline = os.path.join(self.folder, 'study_area.geojson')
+        with open(self.cutline, 'w') as file:
+            file.write(gpd.GeoSeries([self.area], crs=CRS).to_crs(epsg=4326)
+                       .to_json())
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check(self, resolution, resampling, reference):
+        output = input_preparation.warp_layer(
+            self.source, os.path.join(self.folder, 'output.tif'),
+            'epsg:32737', self.cutline, resolution, resampling)
+        with rasterio.open(output) as raster:
+            warped = raster.read(1)
+            transform = raster.transform
+            self.assertEqual(raster.crs, rasterio.crs.CRS.from_string(CRS))
+        pixel = resolution or self.transform.a
+        self.assertAlmostEqual(transform.a, pixel, delta=pixel * 0.01)
+        # the output covers the study area
+        left, top = transform * (0, 0)
+        right, bottom = transform * (warped.shape[1], warped.shape[0])
+        min_x, min_y, max_x, max_y = self.area.bounds
+        self.assertLess(abs(left - min_x), 2 * pixel)
+        self.assertLess(abs(right - max_x), 2 * pixel)
+        self.assertLess(abs(top - max_y), 2 * pixel)
+        self.assertLess(abs(bottom - min_y), 2 * pixel)
+
+        expected = np.zeros(warped.shape, dtype='float32')
+        reproject(self.data, expected, src_transform=self.transform,
+                  src_crs=CRS, dst_transform=transform, dst_crs=CRS,
+                  resampling=reference)
+        rows, cols = np.indices(warped.shape)
+        x, y = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+        centres = gpd.GeoSeries(gpd.points_from_xy(x, y), crs=CRS)
+        inside = centres.within(self.area.buffer(-2 * pixel)).values\
+            .reshape(warped.shape)
+        outside = ~centres.within(self.area.buffer(2 * pixel)).values\
+            .reshape(warped.shape)
+        self.assertTrue(inside.any() and outside.any())
+        np.testing.assert_allclose(warped[inside], expected[inside],
+                                   atol=1e-3)
+        self.assertTrue((warped[outside] == 0).all())
+
+    def test_resampled_layer(self):
+        for resolution in (60, 100):
+            self.check(resolution, 'bilinear', Resampling.bilinear)
+
+    def test_native_resolution(self):
+        self.check(None, 'near', Resampling.nearest)
+
+
+class TestCreateGrid(unittest.TestCase):
+
+    def test_same_points_as_the_point_loop(self):
+        # a border through the points of the grid
+        study_area = gpd.GeoDataFrame(geometry=[Polygon(
+            [(502000, 7992500), (509000, 7993500), (508000, 7998000),
+             (503000, 7997000)])], crs=CRS)
+        area = study_area.unary_union
+        min_x, min_y, max_x, max_y = area.bounds
+        for resolution, tile_size in [(100, 7), (100, 200), (250, 3)]:
+            x, y = np.meshgrid(np.arange(min_x, max_x, resolution),
+                               np.arange(min_y, max_y, resolution))
+            inside = [area.intersects(Point(x_k, y_k))
+                      for x_k, y_k in zip(x.ravel(), y.ravel())]
+            grid = input_preparation.create_grid(32737, resolution,
+                                                 study_area, tile_size)
+            np.testing.assert_array_equal(grid.X, x.ravel()[inside])
+            np.testing.assert_array_equal(grid.Y, y.ravel()[inside])
+            self.assertEqual(grid.crs, study_area.crs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,495 @@
+"""
+Tests of the mesh builder, compared with the results of a mesh built at
+once.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from shapely.geometry import LineString, MultiLineString, MultiPolygon, \
+    Point, Polygon, box
+from shapely.prepared import prep
+from gisele import processing, initialization
+from conftest import CRS, REPOSITORY, mesh_points, write_raster, \
+    study_datasets
+
+
+class TestTiledMesh(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.datasets = study_datasets(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def single_and_tiled(self, resolution, tile_size):
+        """ Points sampled at once, as in create_mesh, and one tile at a
+        time, as in create_mesh_tiled """
+        area = box(500700, 7991500, 511300, 7999000)
+        min_x, min_y, max_x, max_y = area.bounds
+        n_x = np.arange(min_x, max_x, resolution).size
+        n_y = np.arange(min_y, max_y, resolution).size
+        x, y = np.meshgrid(min_x + resolution * np.arange(n_x),
+                           min_y + resolution * np.arange(n_y))
+        single = pd.DataFrame({'X': x.ravel(), 'Y': y.ravel()})
+        roads = processing.road_index(self.datasets['streets'], resolution)
+        columns = processing.sample_mesh(single['X'].values,
+                                         single['Y'].values, resolution,
+                                         self.datasets, roads)
+        for column, values in columns.items():
+            single[column] = values
+
+        processing._init_mesh_worker({'resolution': resolution,
+                                      'min_x': min_x, 'min_y': min_y,
+                                      'area': area.wkb,
+                                      'datasets': self.datasets})
+        tiled = pd.concat([processing._mesh_tile(tile + (None,)) for tile
+                           in processing.mesh_tiles(n_x, n_y, tile_size)])
+        single['Elevation'] = single['Elevation'].astype(int)
+        columns = list(single.columns)
+        return [df[columns].sort_values(['Y', 'X']).reset_index(drop=True)
+                for df in (single, tiled)]
+
+    def test_tiles_equal_single_pass(self):
+        for resolution, tile_size in [(100, 17), (200, 8), (90, 50),
+                                      (25, 120)]:
+            single, tiled = self.single_and_tiled(resolution, tile_size)
+            self.assertEqual(len(single), len(tiled))
+            pd.testing.assert_frame_equal(single, tiled, check_dtype=False)
+
+    def test_resample_window_on_the_global_grid(self):
+        with rasterio.open(self.datasets['elevation']) as raster:
+            for resolution in (100, 77, 20):
+                whole, transform = processing.resample(raster, resolution,
+                                                       block_size=64)
+                window = rasterio.windows.Window(37.4, 51.2, 120.5, 90.1)
+                part, part_transform = processing.resample(
+                    raster, resolution, window, block_size=64)
+                col, row = ~transform * (part_transform.c,
+                                         part_transform.f)
+                col, row = int(round(col)), int(round(row))
+                np.testing.assert_array_equal(
+                    part, whole[:, row:row + part.shape[1],
+                                col:col + part.shape[2]])
+
+
+class TestClipMask(unittest.TestCase):
+
+    def test_same_points_as_intersects(self):
+        # edges and vertices on the points of the mesh, and a hole
+        area = MultiPolygon([
+            Polygon([(501000, 7992000), (508000, 7992000), (509000, 7997000),
+                     (502000, 7998500)],
+                    [[(504000, 7994000), (506000, 7994000),
+                      (506000, 7995000), (504000, 7995000)]]),
+            box(509500, 7991500, 510500, 7992500)])
+        prepared = prep(area)
+        x, y = mesh_points(250)
+        n_x = np.unique(x).size
+        n_y = np.unique(y).size
+        for tile_size in (7, 16, 100):
+            for i_0, i_1, j_0, j_1 in processing.mesh_tiles(n_x, n_y,
+                                                            tile_size):
+                tile = np.zeros((n_y, n_x), dtype=bool)
+                tile[j_0:j_1, i_0:i_1] = True
+                tile = tile.ravel()
+                expected = [area.intersects(Point(x_k, y_k))
+                            for x_k, y_k in zip(x[tile], y[tile])]
+                np.testing.assert_array_equal(
+                    processing.clip_mask(prepared, x[tile], y[tile]),
+                    expected)
+        inside = processing.clip_mask(prepared, x, y)
+        self.assertTrue(inside.any() and not inside.all())
+        on_border = [area.boundary.intersects(Point(x_k, y_k))
+                     for x_k, y_k in zip(x, y)]
+        self.assertTrue(np.any(on_border))
+        self.assertTrue(inside[on_border].all())
+
+
+class TestSampleRaster(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.datasets = study_datasets(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_cells_as_index(self):
+        # points on the edges of the cells of the pixels multiple of 10 m
+        bounds = (500600, 7991600, 511300, 7999000)
+        for layer in ('elevation', 'land_cover', 'population'):
+            with rasterio.open(self.datasets[layer]) as raster:
+                data = raster.read()
+                for resolution in (30, 100, 77):
+                    x, y = mesh_points(resolution, bounds)
+                    expected = [data[(0,) + raster.index(x[k], y[k])]
+                                for k in range(x.size)]
+                    np.testing.assert_array_equal(
+                        processing.sample_raster(data, raster.transform,
+                                                 x, y), expected)
+
+    def test_same_cells_in_a_window(self):
+        with rasterio.open(self.datasets['elevation']) as raster:
+            data = raster.read()
+            x, y = mesh_points(90, (503000, 7993000, 507000, 7996000))
+            part, transform = processing.read_raster(
+                self.datasets['elevation'], (502950, 7992950, 507050, 7996050))
+            np.testing.assert_array_equal(
+                processing.sample_raster(part, transform, x, y),
+                processing.sample_raster(data, raster.transform, x, y))
+
+
+class TestRoadDistance(unittest.TestCase):
+
+    def check(self, streets, x, y, max_length):
+        lines = streets.unary_union
+        expected = [Point(x[k], y[k]).distance(lines) for k in range(x.size)]
+        np.testing.assert_allclose(
+            processing.road_distance(x, y, streets, max_length), expected,
+            rtol=1e-9, atol=1e-6)
+
+    def test_same_distance_as_shapely(self):
+        streets = gpd.GeoDataFrame(geometry=[
+            LineString([(500500, 7992000), (510000, 7999500)]),
+            LineString([(503000, 7991200), (503500, 7998000),
+                        (511500, 7996000)]),
+            MultiLineString([[(505000, 7993000), (505100, 7993050),
+                              (505150, 7993400)],
+                             [(508000, 7992000), (508010, 7992010)]])],
+            crs=CRS)
+        x, y = mesh_points(150)
+        for max_length in (25, 100, 1000, None):
+            self.check(streets, x, y, max_length)
+
+    def test_long_segment_far_from_the_others(self):
+        # the nearest midpoints all belong to the short segments
+        streets = gpd.GeoDataFrame(geometry=[
+            LineString([(500000, 7990000), (520000, 7990000)]),
+            LineString([(505000 + 10 * i, 7999000) for i in range(50)])],
+            crs=CRS)
+        x, y = mesh_points(200)
+        self.check(streets, x, y, None)
+
+    def test_no_roads(self):
+        x, y = mesh_points(1000)
+        roads = processing.road_index(gpd.GeoDataFrame(geometry=[], crs=CRS),
+                                      100)
+        self.assertTrue(np.isnan(processing.nearest_road_distance(
+            x, y, roads)).all())
+
+
+class TestProtectedAreas(unittest.TestCase):
+
+    def test_same_flags_as_contains(self):
+        # vertices away from the points, so that no point is on a border
+        protected_areas = gpd.GeoDataFrame(geometry=[
+            Polygon([(501013, 7992031), (504987, 7992507),
+                     (503511, 7996993)]),
+            Polygon([(506003, 7992003), (510997, 7992003),
+                     (510997, 7997997), (506003, 7997997)],
+                    [[(507503, 7993503), (509497, 7993503),
+                      (509497, 7996497), (507503, 7996497)]]),
+            MultiPolygon([box(500001, 7998001, 500999, 7998999),
+                          box(505001, 7998101, 505099, 7998899)]),
+            None], crs=CRS)
+        polygons = protected_areas.dropna()
+        for resolution in (100, 150, 333):
+            x, y = mesh_points(resolution)
+            expected = [polygons['geometry'].contains(Point(x[k], y[k]))
+                        .any() for k in range(x.size)]
+            flags = processing.protected_area_mask(protected_areas, x, y,
+                                                   resolution)
+            self.assertTrue(flags.any())
+            np.testing.assert_array_equal(flags, expected)
+            # the points of a part of the mesh, as in a tile
+            part = (x > 504000) & (y < 7995000)
+            np.testing.assert_array_equal(
+                processing.protected_area_mask(protected_areas, x[part],
+                                               y[part], resolution),
+                flags[part])
+
+    def test_no_protected_areas(self):
+        x, y = mesh_points(500)
+        flags = processing.protected_area_mask(
+            gpd.GeoDataFrame(geometry=[], crs=CRS), x, y, 500)
+        self.assertEqual(flags.dtype, bool)
+        self.assertFalse(flags.any())
+
+
+def resample_to_disk(path, resolution, out_file):
+    """ Re-sampled raster written to disk and opened again, as create_mesh
+    did before re-sampling in memory """
+    with rasterio.open(path) as raster:
+        scale_factor = raster.transform[0] / resolution
+        data = raster.read(out_shape=(raster.count,
+                                      int(raster.height * scale_factor),
+                                      int(raster.width * scale_factor)),
+                           resampling=rasterio.enums.Resampling.bilinear)
+        transform = raster.transform * raster.transform.scale(
+            (raster.width / data.shape[-1]), (raster.height / data.shape[-2]))
+        profile = raster.profile
+    profile.update(transform=transform, width=data.shape[-1],
+                   height=data.shape[-2])
+    with rasterio.open(out_file, 'w', **profile) as dest:
+        dest.write(data)
+    return rasterio.open(out_file)
+
+
+class TestResample(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.datasets = study_datasets(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def compare(self, layer, resolution, block_size=512, **tolerance):
+        x, y = mesh_points(resolution)
+        with resample_to_disk(self.datasets[layer], resolution,
+                              os.path.join(self.folder, 'resampled.tif')) \
+                as raster:
+            expected = raster.read()
+            transform = raster.transform
+            sampled = [expected[(0,) + raster.index(x[k], y[k])]
+                       for k in range(x.size)]
+        with rasterio.open(self.datasets[layer]) as raster:
+            data, data_transform = processing.resample(raster, resolution,
+                                                       block_size=block_size)
+        self.assertEqual(data.shape, expected.shape)
+        np.testing.assert_allclose(data_transform, transform)
+        np.testing.assert_allclose(data, expected, **tolerance)
+        # points on the edge of a cell, within the rounding of the
+        # transform, may fall in either cell
+        cols, rows = ~transform * (x, y)
+        near_edge = (np.abs(cols - np.rint(cols)) < 1e-6) | \
+            (np.abs(rows - np.rint(rows)) < 1e-6)
+        exact = np.allclose([transform.a, -transform.e], resolution,
+                            rtol=0, atol=1e-9)
+        inside = ~near_edge | exact
+        self.assertGreater(inside.mean(), 0.9)
+        np.testing.assert_allclose(
+            processing.sample_raster(data, data_transform, x, y)[inside],
+            np.array(sampled)[inside], **tolerance)
+
+    def test_same_values_as_the_file(self):
+        for layer in ('elevation', 'slope'):
+            for resolution in (100, 45, 33):
+                self.compare(layer, resolution, rtol=0, atol=0)
+
+    def test_blocks(self):
+        # the blocks read their own part of the raster
+        for resolution in (100, 20):
+            self.compare('elevation', resolution, block_size=64,
+                         rtol=1e-4)
+
+
+class TestPopulationSum(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.datasets = study_datasets(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_fine_raster_same_as_slicing(self):
+        with rasterio.open(self.datasets['population']) as raster:
+            population = raster.read()
+            for resolution in (100, 75, 10):
+                x, y = mesh_points(resolution,
+                                   (503000, 7993000, 506000, 7996000))
+                expected = []
+                for k in range(x.size):
+                    row_min, column_max = raster.index(x[k] + resolution / 2,
+                                                       y[k] + resolution / 2)
+                    row_max, column_min = raster.index(x[k] - resolution / 2,
+                                                       y[k] - resolution / 2)
+                    expected.append(population[0, row_min:row_max,
+                                               column_min:column_max].sum())
+                np.testing.assert_allclose(
+                    processing.population_sum(population, raster.transform,
+                                              x, y, resolution),
+                    expected, rtol=1e-6, atol=1e-3)
+
+    def test_coarse_raster_shares_the_pixels(self):
+        with rasterio.open(self.datasets['land_cover']) as raster:
+            population = raster.read().astype(float)
+            transform = raster.transform
+        for resolution in (25, 40, 90):
+            x, y = mesh_points(resolution, (504000, 7994000, 505000, 7995000))
+            expected = []
+            for k in range(x.size):
+                cell = box(x[k] - resolution / 2, y[k] - resolution / 2,
+                           x[k] + resolution / 2, y[k] + resolution / 2)
+                value = 0
+                col_0, row_0 = ~transform * (x[k], y[k])
+                for row in range(int(row_0) - 1, int(row_0) + 2):
+                    for col in range(int(col_0) - 1, int(col_0) + 2):
+                        left, top = transform * (col, row)
+                        pixel = box(left, top - 100, left + 100, top)
+                        if pixel.intersects(cell):
+                            value += population[0, row, col] * \
+                                pixel.intersection(cell).area / pixel.area
+                expected.append(value)
+            np.testing.assert_allclose(
+                processing.population_sum(population, transform, x, y,
+                                          resolution), expected, rtol=1e-9)
+
+
+class TestMeshStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        x, y = mesh_points(100)
+        self.df = pd.DataFrame({
+            'ID': np.arange(x.size), 'X': x, 'Y': y,
+            'Elevation': rng.integers(0, 3000, x.size),
+            'Slope': rng.random(x.size) * 30,
+            'Population': rng.random(x.size) * 50,
+            'Land_cover': rng.integers(10, 210, x.size),
+            'Road_dist': rng.random(x.size) * 5000,
+            'River_flow': rng.random(x.size),
+            'Protected_area': rng.random(x.size) < 0.1,
+            'Weight': rng.random(x.size) * 10 + 1})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_table_as_the_csv(self):
+        self.df.to_csv(os.path.join(self.folder, 'mesh.csv'), index=False)
+        expected = pd.read_csv(os.path.join(self.folder, 'mesh.csv'))
+        store = os.path.join(self.folder, 'Mesh')
+        processing.write_mesh(self.df.copy(), store, chunk_size=1000)
+        df = processing.read_mesh(store)
+        self.assertEqual(list(df.columns), list(expected.columns))
+        self.assertEqual(df['Land_cover'].dtype, np.uint8)
+        # offsets of float32 are precise to a few millimetres here
+        for column in ('X', 'Y'):
+            self.assertEqual(df[column].dtype, np.float64)
+            np.testing.assert_allclose(df[column], expected[column],
+                                       rtol=0, atol=5e-3)
+        for column in expected.columns.drop(['X', 'Y']):
+            np.testing.assert_allclose(df[column].astype(float),
+                                       expected[column].astype(float),
+                                       rtol=1e-6)
+        pd.testing.assert_frame_equal(
+            pd.concat(processing.iter_mesh(store, ['ID', 'Weight']),
+                      ignore_index=True), df[['ID', 'Weight']])
+
+    def test_append(self):
+        store = os.path.join(self.folder, 'Mesh')
+        processing.write_mesh(pd.DataFrame(columns=processing.MESH_COLUMNS),
+                              store, origin=(500000, 7990000))
+        self.assertTrue(processing.read_mesh(store).empty)
+        df = self.df.drop(columns='Weight')
+        for start in range(0, len(df), 2500):
+            processing.write_mesh(df.iloc[start:start + 2500], store,
+                                  append=True)
+        df = processing.read_mesh(store)
+        self.assertEqual(list(df.columns), processing.MESH_COLUMNS)
+        np.testing.assert_array_equal(df['ID'], self.df['ID'])
+        np.testing.assert_allclose(df['Y'], self.df['Y'], rtol=0, atol=5e-3)
+
+    def test_compact_types(self):
+        df = processing.compact_mesh(pd.DataFrame({
+            'ID': [1, 2, 3], 'Land_cover': [10, np.nan, 200],
+            'Cluster': [-1, 0, 2 ** 40], 'Protected_area': [1, None, 0],
+            'Name': ['a', 'b', 'c']}))
+        self.assertEqual(df['ID'].dtype, np.int32)
+        self.assertEqual(df['Land_cover'].dtype, np.float32)
+        self.assertEqual(df['Cluster'].dtype, np.float32)
+        self.assertEqual(df['Protected_area'].tolist(), [True, False, False])
+        self.assertEqual(df['Name'].tolist(), ['a', 'b', 'c'])
+
+
+class TestCostSurface(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.datasets = study_datasets(self.folder)
+        # vertices away from the centres of the cells
+        self.datasets['protected_areas'] = gpd.GeoDataFrame(geometry=[
+            Polygon([(501007, 7992011), (504993, 7992511),
+                     (503509, 7996989)])], crs=CRS)
+        landcover_csv = pd.read_csv(os.path.join(REPOSITORY, 'Input',
+                                                 'Landcover.csv'))
+        self.lookup = initialization.landcover_lookup(landcover_csv, 'GLC')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_surface_same_as_the_point_weights(self):
+        surface = os.path.join(self.folder, 'cost_surface.tif')
+        with mock.patch.object(processing, 'prepare_datasets',
+                               return_value=self.datasets):
+            processing.cost_surface(CRS, self.lookup, surface)
+        with rasterio.open(surface) as raster:
+            cost = raster.read(1).ravel()
+            transform = raster.transform
+            shape = raster.shape
+        with rasterio.open(self.datasets['slope']) as raster:
+            slope = raster.read(1).ravel()
+            self.assertEqual(raster.transform, transform)
+        # weights of points in the centres of the cells, as in weighting
+        rows, cols = np.indices(shape)
+        x, y = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+        land_cover, transform_land_cover = processing.read_raster(
+            self.datasets['land_cover'])
+        codes = processing.sample_raster(land_cover, transform_land_cover,
+                                         x, y).astype(int)
+        road_dist = processing.road_distance(x, y, self.datasets['streets'],
+                                             None)
+        protected = gpd.GeoSeries(gpd.points_from_xy(x, y), crs=CRS)\
+            .within(self.datasets['protected_areas'].geometry[0]).values
+        weight = np.exp(0.01732867951 * slope) + \
+            np.where(codes < self.lookup.size,
+                     self.lookup[np.minimum(codes, self.lookup.size - 1)], 0)\
+            + np.where(road_dist < 1000, 5 * road_dist / 1000, 5) + \
+            5 * protected
+        self.assertTrue(protected.any())
+        # the surface measures the road distance from the cells crossed by
+        # the roads, less than a diagonal of a cell away
+        np.testing.assert_allclose(cost, weight, rtol=0,
+                                   atol=5 * np.hypot(30, 30) / 1000 + 1e-4)
+        far = road_dist > 1000 + np.hypot(30, 30)
+        self.assertTrue(far.any())
+        np.testing.assert_allclose(cost[far], weight[far], rtol=1e-6)
+
+    def test_sample_same_as_the_cells(self):
+        rng = np.random.default_rng(1)
+        surface = (rng.random((300, 400)) * 10).astype('float32')
+        surface[rng.random((300, 400)) < 0.1] = np.nan
+        path = write_raster(os.path.join(self.folder, 'cost.tif'), surface,
+                            30)
+        with rasterio.open(path) as raster:
+            for resolution in (100, 60, 20):
+                x, y = mesh_points(resolution,
+                                   (503000, 7993000, 506000, 7996000))
+                expected = []
+                for k in range(x.size):
+                    row_min, col_max = raster.index(x[k] + resolution / 2,
+                                                    y[k] + resolution / 2)
+                    row_max, col_min = raster.index(x[k] - resolution / 2,
+                                                    y[k] - resolution / 2)
+                    cells = surface[row_min:row_max, col_min:col_max]
+                    if (~np.isnan(cells)).any():
+                        expected.append(np.nanmean(cells))
+                    else:
+                        expected.append(surface[raster.index(x[k], y[k])])
+                np.testing.assert_allclose(
+                    processing.sample_cost_surface(path, x, y, resolution),
+                    expected, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
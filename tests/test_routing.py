@@ -0,0 +1,429 @@
+"""
+Tests of the choice and the inputs of the routing algorithms, compared with
+the dense matrices the routers built before.
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from gisele import functions, grid
+from conftest import lattice, weighted_mesh
+
+
+class TestRoutingPlan(unittest.TestCase):
+
+    def setUp(self):
+        functions.routing_graphs.clear()
+        self.geo_df = lattice(60, 60, 100)
+        # terminal nodes in the middle of the mesh
+        self.terminal = self.geo_df[
+            self.geo_df.X.between(502000, 503000) &
+            self.geo_df.Y.between(8002000, 8003000)].iloc[::3]
+        n_box = len(functions.create_box(self.terminal, self.geo_df))
+        n_terminal = len(self.terminal)
+        costs = grid.routing_costs
+        # estimates of routing_plan, without a routing graph (4 edges for
+        # each point of the box)
+        self.steiner = (
+            n_box ** 2 * costs['steiner_pair_bytes'] / 1024 ** 2,
+            n_box * 5 * n_box * math.log2(n_box) * costs['steiner_step_time'])
+        self.spider = (n_terminal ** 2 * costs['spider_pair_bytes'] / 1024 ** 2,
+                       n_terminal ** 2 * costs['spider_pair_time'])
+        self.assertGreater(self.steiner[0], self.spider[0])
+        self.assertGreater(self.steiner[1], self.spider[1])
+
+    def plan(self, memory, seconds, costs=None):
+        return grid.routing_plan(self.geo_df, self.terminal, memory, seconds,
+                                 costs)
+
+    def test_both_fit(self):
+        # one after the other: the memory of Steiner and both times
+        self.assertEqual(self.plan(self.steiner[0] * 1.01,
+                                   (self.steiner[1] + self.spider[1]) * 1.01),
+                         ['steiner', 'spider'])
+
+    def test_steiner_alone(self):
+        self.assertEqual(self.plan(self.steiner[0] * 1.01,
+                                   self.steiner[1] + self.spider[1] / 2),
+                         ['steiner'])
+
+    def test_steiner_over_memory(self):
+        self.assertEqual(self.plan(self.steiner[0] * 0.99,
+                                   self.steiner[1] * 1.01), ['spider'])
+
+    def test_steiner_over_time(self):
+        self.assertEqual(self.plan(self.steiner[0] * 1.01,
+                                   self.steiner[1] * 0.99), ['spider'])
+
+    def test_none_fits(self):
+        self.assertEqual(self.plan(self.spider[0] * 0.99,
+                                   self.spider[1] * 0.99), ['spider'])
+
+    def test_costs(self):
+        # free Steiner fits any budget, the default Spider does not
+        free = {'steiner_pair_bytes': 0, 'steiner_step_time': 0}
+        self.assertEqual(self.plan(0, 0, free), ['steiner'])
+        # the configured costs are used when none are given
+        default = dict(grid.routing_costs)
+        try:
+            grid.routing_costs.update(free)
+            self.assertEqual(self.plan(0, 0), ['steiner'])
+        finally:
+            grid.routing_costs.update(default)
+        self.assertEqual(self.plan(0, 0), ['spider'])
+
+
+class TestClusterGrid(unittest.TestCase):
+
+    setUp = TestRoutingPlan.setUp
+
+    def route(self, memory, seconds, steiner_cost, spider_cost):
+        """ Run cluster_grid with routers giving grids of the given costs,
+        and return the grid with the routers that ran """
+        with mock.patch.object(grid.Steinerman, 'steiner', return_value=(
+                'steiner grid', steiner_cost, 10, [1])) as steiner, \
+                mock.patch.object(grid.Spiderman, 'spider', return_value=(
+                    'spider grid', spider_cost, 20, [2])) as spider:
+            c_grid = grid.cluster_grid(self.geo_df, self.terminal, 100, 10,
+                                       len(self.terminal), self.geo_df, None,
+                                       None, memory, seconds)
+        return c_grid, steiner.call_count, spider.call_count
+
+    def test_spider_budget(self):
+        c_grid, steiner, spider = self.route(
+            self.steiner[0] * 0.99, self.steiner[1] * 1.01, 1, 2)
+        self.assertEqual((steiner, spider), (0, 1))
+        self.assertEqual(c_grid, ('spider grid', 2, 20, [2]))
+
+    def test_steiner_budget(self):
+        c_grid, steiner, spider = self.route(
+            self.steiner[0] * 1.01, self.steiner[1] + self.spider[1] / 2, 2, 1)
+        self.assertEqual((steiner, spider), (1, 0))
+        self.assertEqual(c_grid, ('steiner grid', 2, 10, [1]))
+
+    def test_both_budget(self):
+        budget = (self.steiner[0] * 1.01,
+                  (self.steiner[1] + self.spider[1]) * 1.01)
+        for steiner_cost, spider_cost, expected in [
+                (1, 2, 'steiner grid'), (2, 1, 'spider grid'),
+                (1, 1, 'steiner grid')]:
+            c_grid, steiner, spider = self.route(*budget, steiner_cost,
+                                                 spider_cost)
+            self.assertEqual((steiner, spider), (1, 1))
+            self.assertEqual(c_grid[0], expected)
+
+
+def dense_cost_matrix(df_box, line_bc, resolution, branch_points=()):
+    """ Cost matrix of a box as Steinerman.steiner built it before being
+    sparse: dense distances and costs, with the pairs farther than the
+    length limit dropped """
+    dist_2d_matrix = functions.distance_2d(df_box, df_box, 'X', 'Y')
+    dist_3d_matrix = functions.distance_3d(df_box, df_box, 'X', 'Y',
+                                           'Elevation')
+    edges_matrix = functions.cost_matrix(df_box, dist_3d_matrix, line_bc)
+    edges_matrix[dist_2d_matrix > math.ceil(resolution * 1.5)] = 0
+    for i in branch_points:
+        if i[0] in edges_matrix.index.values and \
+                i[1] in edges_matrix.index.values:
+            edges_matrix.loc[i[0], i[1]] = 0.001
+            edges_matrix.loc[i[1], i[0]] = 0.001
+    return edges_matrix.values
+
+
+class TestSparseCostMatrix(unittest.TestCase):
+
+    def setUp(self):
+        functions.routing_graphs.clear()
+        self.resolution = 100
+        self.geo_df = weighted_mesh(30, 30, self.resolution)
+        self.df_box = self.geo_df[self.geo_df.X.between(500500, 502000) &
+                                  self.geo_df.Y.between(8000300, 8001800)]
+        self.df_box.index = pd.Series(range(len(self.df_box)))
+        ids = self.df_box.ID.values
+        # neighbours, pairs farther than the length limit and pairs with a
+        # point outside the box
+        self.branch_points = [(ids[0], ids[1]), (ids[20], ids[5]),
+                              (ids[3], ids[-1]), (ids[7], 10 ** 6)]
+
+    def check(self, branch_points):
+        expected = dense_cost_matrix(self.df_box, 10000, self.resolution,
+                                     branch_points)
+        overlay = functions.edge_overlay(branch_points)
+        value = functions.sparse_cost_matrix(
+            self.df_box, 10000, math.ceil(self.resolution * 1.5), overlay)
+        np.testing.assert_allclose(value.toarray(), expected)
+        value = functions.box_cost_matrix(self.df_box, 10000,
+                                          self.resolution, overlay)
+        np.testing.assert_allclose(value.toarray(), expected)
+
+    def test_same_matrix_as_the_dense_one(self):
+        self.check([])
+        self.check(self.branch_points)
+
+    def test_same_matrix_from_the_routing_graph(self):
+        functions.routing_graphs['current'] = functions.routing_graph(
+            self.geo_df, self.resolution, file=None)
+        self.check([])
+        self.check(self.branch_points)
+        # the graph is not changed by the branches of a box
+        self.assertGreater(functions.box_graph(self.df_box)[0].data.min(), 0.001)
+
+
+def road_network(geo_df, first_id):
+    """ Vertices and segments of two roads crossing the mesh, as given by
+    create_roads: one with vertices closer than the resolution and one with
+    segments longer than the length limit """
+    vertices = [np.column_stack([500050 + 63 * np.arange(30),
+                                 8000030 + 41 * np.arange(30)]),
+                np.column_stack([502930 - 230 * np.arange(12),
+                                 8000170 + 190 * np.arange(12)])]
+    xy = np.concatenate(vertices)
+    gdf_roads = gpd.GeoDataFrame({
+        'ID': np.arange(len(xy)) + first_id, 'X': xy[:, 0], 'Y': xy[:, 1],
+        'Weight': 1, 'Elevation': geo_df.Elevation.mean()},
+        geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=geo_df.crs)
+    ends = np.cumsum([len(road) for road in vertices])
+    first = np.setdiff1d(np.arange(len(xy) - 1), ends - 1)
+    roads_segments = pd.DataFrame({
+        'ID1': first + first_id, 'ID2': first + 1 + first_id,
+        'length': np.hypot(*(xy[first + 1] - xy[first]).T) / 1000})
+    return gdf_roads, roads_segments
+
+
+def dense_road_matrices(df_box, n, df_box_segments, line_bc, resolution,
+                        c_grid_points=(), branch_points=None):
+    """ Cost and routing matrices of a box of mesh points and road vertices
+    as dijkstra_connection_roads built them before the routing graph: the
+    segments of the grid keep their length for the routing, the branches
+    get a negligible one (steiner_roads passed its branches as grid
+    segments) """
+    df_box_segments = df_box_segments.copy()
+    n_roads = df_box.shape[0] - n
+    dist_2d_matrix = functions.distance_2d(df_box, df_box, 'X', 'Y')
+    dist_3d_matrix = functions.distance_3d(df_box, df_box, 'X', 'Y',
+                                           'Elevation')
+    if branch_points is not None:
+        for i in branch_points:
+            for j, row in df_box_segments.iterrows():
+                if i[0] == row.ID1 and i[1] == row.ID2:
+                    df_box_segments.loc[j, 'length'] = 0.001
+                elif i[0] == row.ID2 and i[1] == row.ID1:
+                    df_box_segments.loc[j, 'length'] = 0.001
+    costs_matrix = functions.cost_matrix(df_box, dist_3d_matrix, line_bc)
+    edges_matrix = costs_matrix.copy()
+    for i in c_grid_points:
+        if i[0] in costs_matrix.index.values and \
+                i[1] in costs_matrix.index.values:
+            costs_matrix.loc[i[0], i[1]] = 0.001
+            costs_matrix.loc[i[1], i[0]] = 0.001
+            edges_matrix.loc[i[0], i[1]] = dist_3d_matrix.loc[i[0], i[1]]
+            edges_matrix.loc[i[1], i[0]] = dist_3d_matrix.loc[i[0], i[1]]
+    if branch_points is not None:
+        for i in branch_points:
+            if i[0] in edges_matrix.index.values and \
+                    i[1] in edges_matrix.index.values:
+                edges_matrix.loc[i[0], i[1]] = 0.001
+                edges_matrix.loc[i[1], i[0]] = 0.001
+                costs_matrix.loc[i[0], i[1]] = 0.001
+                costs_matrix.loc[i[1], i[0]] = 0.001
+    edges_matrix[dist_2d_matrix > math.ceil(resolution * 1.5)] = 0
+    edges_matrix.iloc[n:n + n_roads, n:n + n_roads] = 0
+    edges = edges_matrix.to_numpy(copy=True)
+    for x in range(df_box_segments.shape[0]):
+        # the segments added to the graph, with weight=distance[km]
+        first = np.flatnonzero(df_box['ID'] ==
+                               df_box_segments.loc[x, 'ID1'])[0]
+        second = np.flatnonzero(df_box['ID'] ==
+                                df_box_segments.loc[x, 'ID2'])[0]
+        edges[first, second] = edges[second, first] = \
+            df_box_segments.loc[x, 'length'] * line_bc
+    return costs_matrix.values, edges
+
+
+def road_box(resolution, seed=1):
+    """ Mesh and roads of the tests, with the box of the routers: the mesh
+    points of a part of the mesh followed by the road vertices within it """
+    geo_df = weighted_mesh(30, 30, resolution, seed=seed)
+    gdf_roads, roads_segments = road_network(geo_df, len(geo_df))
+    inside = geo_df.X.between(500000, 502500) & \
+        geo_df.Y.between(8000000, 8001500)
+    roads_inside = gdf_roads.X.between(500000, 502500) & \
+        gdf_roads.Y.between(8000000, 8001500)
+    df_box = pd.concat([geo_df[inside], gdf_roads[roads_inside]])
+    df_box.index = pd.Series(range(len(df_box)))
+    ids = gdf_roads.ID[roads_inside].values
+    df_box_segments = roads_segments[
+        roads_segments.ID1.isin(ids) &
+        roads_segments.ID2.isin(ids)].reset_index(drop=True)
+    return geo_df, gdf_roads, roads_segments, df_box, inside.sum(), \
+        df_box_segments
+
+
+class TestRoutingGraph(unittest.TestCase):
+
+    def setUp(self):
+        functions.routing_graphs.clear()
+        self.folder = tempfile.mkdtemp()
+        self.resolution = 100
+        self.geo_df, self.gdf_roads, self.roads_segments, self.df_box, \
+            self.n, self.df_box_segments = road_box(self.resolution)
+        self.assertGreater(len(self.df_box_segments), 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check(self, graph):
+        weighted, distance, road = functions.box_graph(self.df_box, graph)
+        expected_costs, expected_edges = dense_road_matrices(
+            self.df_box, self.n, self.df_box_segments, 10000,
+            self.resolution)
+        np.testing.assert_allclose((weighted * 10000).toarray(),
+                                   expected_edges)
+        np.testing.assert_array_equal(distance.toarray() != 0,
+                                      expected_edges != 0)
+        np.testing.assert_array_equal(road,
+                                      np.arange(len(self.df_box)) >= self.n)
+
+    def test_same_edges_as_the_dense_matrices(self):
+        # graph of the box alone and of the whole study area
+        self.check(functions.routing_graph(
+            self.df_box.iloc[:self.n], self.resolution,
+            self.df_box.iloc[self.n:], self.df_box_segments, file=None))
+        self.check(functions.routing_graph(
+            self.geo_df, self.resolution, self.gdf_roads,
+            self.roads_segments, file=None))
+
+    def test_stored_graph(self):
+        file = os.path.join(self.folder, 'routing_graph.npz')
+        self.assertIsNone(functions.box_graph(self.df_box))
+        functions.routing_graph(self.geo_df, self.resolution, self.gdf_roads,
+                                self.roads_segments, file=file)
+        functions.routing_graphs.clear()
+        self.assertIsNone(functions.load_routing_graph(
+            os.path.join(self.folder, 'missing.npz')))
+        functions.load_routing_graph(file)
+        self.check(None)
+        # a box of another study area is not in the graph
+        moved = self.df_box.copy()
+        moved['X'] += 1000000
+        self.assertIsNone(functions.box_graph(moved))
+
+
+class TestRoadBoxMatrices(unittest.TestCase):
+
+    def setUp(self):
+        functions.routing_graphs.clear()
+        self.resolution = 100
+        self.geo_df, self.gdf_roads, self.roads_segments, self.df_box, \
+            self.n, self.df_box_segments = road_box(self.resolution)
+
+    def check(self, c_grid_points=(), branch_points=None, overlay=None):
+        costs, edges = functions.road_box_matrices(
+            self.df_box, self.n, self.df_box_segments, 10000,
+            self.resolution, overlay)
+        expected_costs, expected_edges = dense_road_matrices(
+            self.df_box, self.n, self.df_box_segments, 10000,
+            self.resolution, c_grid_points, branch_points)
+        np.testing.assert_allclose(edges.toarray(), expected_edges)
+        # the costs are those of the edges of the graph
+        self.assertEqual((costs.toarray() != 0).sum(), edges.nnz)
+        np.testing.assert_allclose(costs.toarray()[expected_edges != 0],
+                                   expected_costs[expected_edges != 0])
+
+    def test_same_matrices_as_the_dense_ones(self):
+        self.check()
+        ids = self.df_box.ID.values
+        # a segment of a road, neighbours and pairs farther than the limit
+        c_grid_points = [tuple(self.df_box_segments.loc[3, ['ID1', 'ID2']]),
+                         (ids[0], ids[1]), (ids[self.n + 2], ids[7]),
+                         (ids[4], ids[self.n - 1])]
+        self.check(c_grid_points,
+                   overlay=functions.edge_overlay(c_grid_points))
+
+    def test_same_matrices_from_the_routing_graph(self):
+        self.assertIsNone(functions.box_graph(self.df_box))
+        functions.routing_graphs['current'] = functions.routing_graph(
+            self.geo_df, self.resolution, self.gdf_roads, self.roads_segments,
+            file=None)
+        self.assertIsNotNone(functions.box_graph(self.df_box))
+        self.test_same_matrices_as_the_dense_ones()
+        self.test_grid_and_branches()
+
+    def test_grid_and_branches(self):
+        ids = self.df_box.ID.values
+        segments = self.df_box_segments[['ID1', 'ID2']].values
+        # segments of the roads in both lists and in the reversed order,
+        # pairs of the grid also among the branches
+        c_grid_points = [tuple(segments[3]), tuple(segments[5]),
+                         (ids[0], ids[1]), (ids[30], ids[31]),
+                         (ids[self.n + 2], ids[7])]
+        branch_points = [tuple(segments[5][::-1]), tuple(segments[8]),
+                         (ids[31], ids[30]), (ids[45], ids[46]),
+                         (ids[4], ids[self.n - 1])]
+        overlay = functions.edge_overlay(
+            branch_points, length=0.001,
+            overlay=functions.edge_overlay(c_grid_points))
+        self.check(c_grid_points, branch_points, overlay)
+        self.check([], branch_points, functions.edge_overlay(
+            branch_points, length=0.001))
+
+
+class TestEdgeOverlay(unittest.TestCase):
+
+    def setUp(self):
+        functions.routing_graphs.clear()
+        self.resolution = 100
+        self.df_box = weighted_mesh(12, 15, self.resolution, seed=2)
+        ids = self.df_box.ID.values
+        self.c_grid_points = [(ids[0], ids[1]), (ids[40], ids[41]),
+                              (ids[9], ids[100])]
+        self.branch_points = [(ids[41], ids[40]), (ids[60], ids[75]),
+                              (ids[2], 10 ** 6)]
+
+    def test_pairs(self):
+        overlay = functions.edge_overlay([(5, 3), [(1, 2), (2, 4)], (7, 8)],
+                                         length=0.001)
+        overlay = functions.edge_overlay([(8, 7)], cost=2, overlay=overlay)
+        # nested lists of pairs are skipped, repeated pairs replaced
+        self.assertEqual(set(overlay), {(3, 5), (7, 8)})
+        self.assertEqual(overlay[(3, 5)], (0.001, 0.001))
+        self.assertEqual(overlay[(7, 8)][0], 2)
+        self.assertTrue(np.isnan(overlay[(7, 8)][1]))
+
+    def test_same_matrix_as_the_dijkstra_loops(self):
+        # dijkstra_connection set the grid and then the branches to 0.001
+        expected = dense_cost_matrix(self.df_box, 10000, self.resolution,
+                                     self.c_grid_points + self.branch_points)
+        overlay = functions.edge_overlay(
+            self.branch_points,
+            overlay=functions.edge_overlay(self.c_grid_points))
+        np.testing.assert_allclose(functions.box_cost_matrix(
+            self.df_box, 10000, self.resolution, overlay).toarray(), expected)
+
+    def test_same_matrix_as_the_spider_loop(self):
+        df = self.df_box.iloc[::4].copy()
+        df.index = pd.Series(range(len(df)))
+        dist_3d_matrix = functions.distance_3d(df, df, 'X', 'Y', 'Elevation')
+        edges_matrix = functions.cost_matrix(df, dist_3d_matrix, 10000)
+        expected = edges_matrix.copy()
+        branch_points = [tuple(df.ID.values[[1, 2]]),
+                         tuple(df.ID.values[[30, 5]])] + self.branch_points
+        for i in branch_points:
+            if i[0] in expected.index.values and \
+                    i[1] in expected.index.values:
+                expected.loc[i[0], i[1]] = 0.001
+                expected.loc[i[1], i[0]] = 0.001
+        value = functions.set_edges(edges_matrix, df,
+                                    functions.edge_overlay(branch_points))
+        pd.testing.assert_frame_equal(value, expected)
+        self.assertEqual((value.values == 0.001).sum(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()